@@ -0,0 +1,143 @@
+"""
+Benchmark of the in-place dataset builder of Measurement (allocate_var / fill_var) against the previous way of
+building the dataset (xr.merge of the cloud fields, new arrays assigned for the SNR and flags), on a large synthetic
+BankExport file (euliaa_proc.synthetic_bankexport).
+
+The stages add_noise_and_snr, add_quality_flag, add_clouds, add_flag_below_cloud_top and add_flag_missing_data are
+run on the same ingested dataset with both implementations, and timed separately (min over the repeats) with the
+traced memory peak of each stage. The datasets built by the two implementations are checked to be equal.
+
+Usage:
+    python benchmarks/bench_dataset_builder.py [--n_time 720] [--n_alt 800] [--n_repeat 3]
+"""
+import os
+import copy
+import time
+import logging
+import argparse
+import tempfile
+import warnings
+import tracemalloc
+import numpy as np
+import xarray as xr
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'euliaa_proc', 'config')
+STAGES = ['add_noise_and_snr', 'add_quality_flag', 'add_clouds', 'add_flag_below_cloud_top', 'add_flag_missing_data']
+
+
+def get_merge_measurement_class():
+    """Measurement with the stages as before the dataset builder (reference of the benchmark)"""
+    from euliaa_proc.measurement import Measurement
+    from euliaa_proc.utils.data_utils import flag_var, get_noise_vect_from_da
+    from euliaa_proc.utils.cloud_detection import in_house_cloud_detection
+
+    class MergeMeasurement(Measurement):
+
+        def add_noise_and_snr(self, scat_list=['mie', 'ray']):
+            for scat in scat_list:
+                self.data[f'noise_level_{scat}'] = get_noise_vect_from_da(self.data[f'signal_{scat}'])
+                self.data[f'snr_{scat}'] = self.data[f'signal_{scat}']/self.data[f'noise_level_{scat}']
+
+        def add_clouds(self, **kwargs):
+            data_zen = self.data.backscatter_coef.copy(deep=True)
+            data_zen = data_zen.where(self.data.backscatter_coef_flag==0, np.nan)
+            cloud_ds_list = [in_house_cloud_detection(data_zen[:,:,i], **kwargs) for i in range(len(self.data.line_of_sight))]
+            self.data = xr.merge([self.data, xr.concat(cloud_ds_list, dim='line_of_sight')])
+
+        def add_quality_flag(self, var_list=['u_mie', 'v_mie', 'w_mie', 'temperature_int', 'backscatter_coef']):
+            for var in var_list:
+                scat = 'mie' if any('_mie' in d for d in self.data[var].dims) else 'ray'
+                snr_los = 'all' if 'line_of_sight' in self.data[var].dims else self.conf['variables'][var]['attributes'].get('line_of_sight')
+                flag_invalid = flag_var(self.data, var, var_min_thres=self.qc_conf['THRES_MIN'][var], var_max_thres=self.qc_conf['THRES_MAX'][var])
+                flag_snr = flag_var(self.data, var, snr_key=f'snr_{scat}', snr_thres=self.qc_conf['SNR_THRES'][var], snr_los=snr_los)
+                flag_err = flag_var(self.data, var, err_key=f'{var}_err', var_err_thres=self.qc_conf['ERR_THRES'][var])
+                self.data[f'{var}_flag'] = flag_err + flag_snr + flag_invalid
+
+        def add_flag_below_cloud_top(self, var_list=['temperature_int']):
+            cloud_flag = xr.where(self.data['below_cloud_top'] > 0, 8, 0)
+            for var in var_list:
+                self.data[f'{var}_flag'] += cloud_flag
+
+        def add_flag_missing_data(self):
+            for var in self.data.data_vars.keys():
+                if f'{var}_flag' in self.data.keys():
+                    self.data[f'{var}_flag'] = self.data[f'{var}_flag'].where(~xr.ufuncs.isnan(self.data[var]), -9)
+
+    return MergeMeasurement
+
+
+def run_stages(meas_class, ingested, config, config_qc):
+    """
+    Run the stages on a copy of the ingested dataset
+    Output: dict {stage: (wall time (s), traced peak (MB))}, processed dataset
+    """
+    meas = meas_class(config, conf_qc_file=config_qc)
+    meas.data = copy.deepcopy(ingested)
+    results = {}
+    for stage in STAGES:
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        getattr(meas, stage)()
+        elapsed = time.perf_counter() - t0
+        results[stage] = (elapsed, tracemalloc.get_traced_memory()[1]/1e6)
+        tracemalloc.stop()
+    return results, meas.data
+
+
+def check_equal(data_ref, data):
+    """variables whose values differ between the two datasets (the dimensions may be ordered differently)"""
+    return [var for var in data_ref.data_vars
+            if var not in data or not data_ref[var].equals(data[var].transpose(*data_ref[var].dims))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the in-place dataset builder against merging/assigning new arrays')
+    parser.add_argument('--n_time', type=int, default=720, help='Number of profiles of the synthetic file')
+    parser.add_argument('--n_alt', type=int, default=800, help='Number of Mie and Rayleigh gates')
+    parser.add_argument('--n_repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic file')
+    parser.add_argument('--config', default=os.path.join(CONFIG_DIR, 'config_nc.yaml'))
+    parser.add_argument('--config_qc', default=os.path.join(CONFIG_DIR, 'config_qc1.yaml'))
+    args = parser.parse_args()
+
+    from euliaa_proc.log import logger
+    from euliaa_proc.measurement import Measurement, H5Reader
+    from euliaa_proc.synthetic_bankexport import generate_bankexport
+    logger.setLevel(logging.ERROR)
+    warnings.filterwarnings('ignore', message='All-NaN slice encountered')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdf5_file = generate_bankexport(tmp_dir, n_time=args.n_time, n_alt_mie=args.n_alt, n_alt_ray=args.n_alt, seed=args.seed)
+        reader = H5Reader(args.config, hdf5_file, conf_qc_file=args.config_qc)
+        reader.read_hdf5_file()
+        reader.load_attrs()
+        reader.load_data()
+        reader.add_lat_lon()
+        reader.add_time_bnds()
+        ingested = reader.data.load()
+
+    implementations = {'merge': get_merge_measurement_class(), 'builder': Measurement}
+    runs = {name: [] for name in implementations}
+    for _ in range(args.n_repeat):
+        for name, meas_class in implementations.items():
+            results, data = run_stages(meas_class, ingested, args.config, args.config_qc)
+            runs[name].append(results)
+            if name == 'merge':
+                data_ref = data
+            else:
+                differing = check_equal(data_ref, data)
+
+    print(f'{args.n_time} profiles x {args.n_alt} gates, min over {args.n_repeat} repeats')
+    print(f'{"stage":28s} {"merge (ms)":>11s} {"builder (ms)":>13s} {"merge peak (MB)":>16s} {"builder peak (MB)":>18s}')
+    for stage in STAGES + ['total']:
+        row = {}
+        for name in implementations:
+            if stage == 'total':
+                row[name] = (min(sum(run[s][0] for s in STAGES) for run in runs[name]), max(max(run[s][1] for s in STAGES) for run in runs[name]))
+            else:
+                row[name] = (min(run[stage][0] for run in runs[name]), max(run[stage][1] for run in runs[name]))
+        print(f"{stage:28s} {row['merge'][0]*1e3:11.1f} {row['builder'][0]*1e3:13.1f} {row['merge'][1]:16.1f} {row['builder'][1]:18.1f}")
+    if differing:
+        print(f'Datasets differ: {differing}')
+        raise SystemExit(1)
+    print('Datasets equal')
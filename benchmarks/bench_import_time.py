@@ -0,0 +1,65 @@
+"""
+Import-time benchmark of the euliaa_proc entry points, from `python -X importtime` (cumulative time, fresh interpreter).
+Reports the total import time of each entry point, its heaviest imported packages and whether the
+heavy optional dependencies (matplotlib, eccodes, aprofiles, ...) were loaded.
+With --max_ms, exits with an error if an entry point takes longer (regression check).
+
+Usage:
+    python benchmarks/bench_import_time.py [--modules euliaa_proc.main ...] [--n_repeat 5] [--max_ms 500]
+"""
+import os
+import re
+import subprocess
+import sys
+import argparse
+
+ENTRY_POINTS = ['euliaa_proc.log', 'euliaa_proc.main', 'euliaa_proc.processing_manager', 'euliaa_proc.measurement']
+HEAVY_MODULES = ['xarray', 'netCDF4', 'matplotlib', 'eccodes', 'aprofiles', 'scipy', 'seaborn', 'boto3', 'fsspec']
+LINE_PATTERN = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def import_times(module):
+    """
+    Import module in a fresh interpreter with -X importtime
+    Output: dict {imported module: (self us, cumulative us, nesting level)}
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'), env.get('PYTHONPATH', '')])
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise RuntimeError(f'Import of {module} failed:\n{result.stderr[-2000:]}')
+    times = {}
+    for line in result.stderr.splitlines():
+        match = LINE_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            times[name] = (int(self_us), int(cumulative_us), (len(indent)-1)//2)
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import-time benchmark of the euliaa_proc entry points')
+    parser.add_argument('--modules', nargs='+', default=ENTRY_POINTS)
+    parser.add_argument('--n_repeat', type=int, default=5, help='Number of imports per module (the median is reported)')
+    parser.add_argument('--n_top', type=int, default=8, help='Number of heaviest top-level imports listed')
+    parser.add_argument('--max_ms', type=float, default=None, help='Fail if an entry point takes longer to import (ms)')
+    args = parser.parse_args()
+
+    startup = import_times('sys') # imports of the interpreter start-up (site, ...), not listed
+    too_slow = []
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.n_repeat)]
+        total_ms = sorted(run[module][1] for run in runs)[len(runs)//2]/1e3
+        times = runs[len(runs)//2]
+        loaded = [heavy for heavy in HEAVY_MODULES if heavy in times]
+        print(f'{module}: {total_ms:.0f} ms (median of {args.n_repeat}), heavy modules loaded: {", ".join(loaded) or "none"}')
+        # heaviest imports directly below the entry point's own package
+        top = sorted(((name, t[1]) for name, t in times.items() if t[2] <= 1 and name != module and name not in startup), key=lambda item: -item[1])
+        for name, cumulative_us in top[:args.n_top]:
+            print(f'    {name:<40} {cumulative_us/1e3:8.1f} ms')
+        if args.max_ms is not None and total_ms > args.max_ms:
+            too_slow.append(module)
+
+    if too_slow:
+        print(f'Import time above {args.max_ms} ms: {too_slow}')
+        sys.exit(1)
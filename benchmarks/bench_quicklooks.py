@@ -0,0 +1,68 @@
+"""
+Benchmark of the quicklook renderer: render time and RSS over consecutive renders.
+The RSS should stay flat (no figure accumulates between renders).
+
+Usage:
+    python benchmarks/bench_quicklooks.py --n_renders 1000 --resolution medium [--l2a_file L2A.nc]
+"""
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+from euliaa_proc.quicklooks import render_quicklooks, close_quicklook_templates, QUICKLOOK_RESOLUTIONS
+
+
+def get_rss_mb():
+    """current resident set size of the process (MB)"""
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss/1e6
+    except ImportError:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/1e6
+
+
+def make_l2a_like_dataset(n_time=60, n_alt=400, n_los=3, seed=0):
+    """small in-memory dataset with the variables and flags used by the quicklooks"""
+    rng = np.random.default_rng(seed)
+    time_arr = pd.date_range('2025-05-22 12:00', periods=n_time, freq='1min').values.astype('datetime64[ns]')
+    alt = np.arange(n_alt)*150.+200
+    ds = xr.Dataset(coords={'time': time_arr, 'altitude_mie': alt, 'line_of_sight': np.arange(n_los)})
+    dims_los = ('time', 'altitude_mie', 'line_of_sight')
+    dims = ('time', 'altitude_mie')
+    ds['backscatter_coef'] = (dims_los, 1e-6*np.exp(-alt/8000.)[None, :, None]*(1+0.1*rng.standard_normal((n_time, n_alt, n_los))))
+    ds['temperature_int'] = (dims_los, (288-6.5e-3*alt)[None, :, None]+rng.standard_normal((n_time, n_alt, n_los)))
+    for var in ['w_mie', 'u_mie', 'v_mie']:
+        ds[var] = (dims, 5*rng.standard_normal((n_time, n_alt)))
+    for var in ['backscatter_coef', 'temperature_int', 'w_mie', 'u_mie', 'v_mie']:
+        ds[f'{var}_flag'] = (ds[var].dims, np.where(rng.random(ds[var].shape) < 0.1, 2, 0))
+    return ds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the quicklook renderer')
+    parser.add_argument('--n_renders', type=int, default=1000, help='Number of consecutive renders')
+    parser.add_argument('--resolution', type=str, default='medium', choices=list(QUICKLOOK_RESOLUTIONS))
+    parser.add_argument('--l2a_file', type=str, default=None, help='L2A file to render (synthetic data if not given)')
+    parser.add_argument('--report_every', type=int, default=100)
+    args = parser.parse_args()
+
+    ds_ref = xr.load_dataset(args.l2a_file) if args.l2a_file else make_l2a_like_dataset()
+
+    rss_start = get_rss_mb()
+    durations = []
+    for i in range(args.n_renders):
+        ds = ds_ref.copy()
+        t0 = time.perf_counter()
+        png = render_quicklooks(ds, f'render {i}', resolution=args.resolution)
+        durations.append(time.perf_counter()-t0)
+        if (i+1) % args.report_every == 0:
+            print(f'{i+1:5d} renders: last {durations[-1]*1e3:7.1f} ms, RSS {get_rss_mb():8.1f} MB, png {len(png)/1e3:.0f} kB')
+    close_quicklook_templates()
+
+    durations = np.array(durations)
+    print(f'resolution={args.resolution}: median {np.median(durations)*1e3:.1f} ms, '
+          f'p95 {np.percentile(durations, 95)*1e3:.1f} ms, first {durations[0]*1e3:.1f} ms')
+    print(f'RSS start {rss_start:.1f} MB, end {get_rss_mb():.1f} MB')
@@ -0,0 +1,174 @@
+"""
+Benchmark of the pipeline stages at several data sizes, on synthetic BankExport files (euliaa_proc.synthetic_bankexport).
+
+Each repeat runs the stages in the pipeline order on a fresh measurement and times them separately:
+read_hdf5_file, load_data, add_noise_and_snr, add_quality_flag, add_clouds, EProfileMeasurement.load_data,
+Writer.write_nc (L2A), plot_quicklooks and write_bufr for each BUFR type. The results (min and median over the repeats)
+are saved as JSON with the commit they were measured at, e.g. benchmarks/results/stages_<commit>.json, and can be
+compared to the results of another commit: the script then exits with status 1 if a stage is slower than
+--max_slowdown times the baseline, so that it can be used as a regression gate.
+
+Usage:
+    python benchmarks/bench_stages.py [--sizes small medium large] [--n_repeat 5] [--output results.json]
+    python benchmarks/bench_stages.py --compare benchmarks/results/stages_<baseline commit>.json [--max_slowdown 1.25]
+"""
+import os
+import json
+import time
+import logging
+import warnings
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'euliaa_proc', 'config')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# (n_time, n_alt_mie, n_alt_ray) of the synthetic files; medium is close to an operational 1 h file
+SIZES = {
+    'small': (30, 200, 200),
+    'medium': (60, 400, 400),
+    'large': (240, 800, 800),
+}
+
+
+def get_commit():
+    """short hash of the checked-out commit (suffixed with -dirty if the tree has local changes), None outside git"""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=cwd, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=cwd, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def run_stages(hdf5_file, out_dir, config, config_qc, config_eprofile, bufr_types, resolution):
+    """
+    Run the stages once on hdf5_file, in the pipeline order
+    Output: dict {stage: wall time (s)}
+    """
+    from euliaa_proc.measurement import H5Reader
+    from euliaa_proc.eprofile import EProfileMeasurement
+    from euliaa_proc.write_netcdf import Writer
+    from euliaa_proc.quicklooks import plot_quicklooks
+    from euliaa_proc.nc2bufr import write_bufr
+
+    timings = {}
+
+    def timed(stage, func, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[stage] = timings.get(stage, 0.) + time.perf_counter() - t0
+        return result
+
+    meas = H5Reader(config, hdf5_file, conf_qc_file=config_qc)
+    timed('read_hdf5_file', meas.read_hdf5_file)
+    timed('load_data', meas.load_attrs)
+    timed('load_data', meas.load_data)
+    meas.add_lat_lon()
+    meas.add_time_bnds()
+    timed('add_noise_and_snr', meas.add_noise_and_snr)
+    timed('add_quality_flag', meas.add_quality_flag)
+    timed('add_clouds', meas.add_clouds)
+    meas.add_flag_below_cloud_top()
+    meas.add_flag_missing_data()
+
+    eprofile_meas = EProfileMeasurement(config_eprofile, meas.data, conf_qc_file=config_qc)
+    timed('EProfileMeasurement.load_data', eprofile_meas.load_data)
+
+    l2a_file = os.path.join(out_dir, 'L2A_bench.nc')
+    timed('Writer.write_nc', Writer(meas, output_file=l2a_file).write_nc)
+    timed('plot_quicklooks', plot_quicklooks, l2a_file, out_dir, 'L2A_bench', resolution=resolution)
+
+    meas.subsel_stripped_profile() # as for the L2B, which is encoded in BUFR
+    meas.set_invalid_to_nan()
+    for bufr_type in bufr_types:
+        timed(f'write_bufr[{bufr_type}]', write_bufr, meas.data, os.path.join(out_dir, f'bench_{bufr_type}.bufr'), bufr_type=bufr_type)
+    return timings
+
+
+def benchmark_size(size, n_repeat, args):
+    """results of the stages for one data size: {stage: {min, median, n_repeat}} (s)"""
+    from euliaa_proc.synthetic_bankexport import generate_bankexport
+    n_time, n_alt_mie, n_alt_ray = SIZES[size]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdf5_file = generate_bankexport(tmp_dir, n_time=n_time, n_alt_mie=n_alt_mie, n_alt_ray=n_alt_ray, seed=args.seed)
+        # first run not recorded: imports, config parsing and quicklook template are one-off costs (see bench_worker_startup.py)
+        run_stages(hdf5_file, tmp_dir, args.config, args.config_qc, args.config_eprofile, args.bufr_types, args.resolution)
+        runs = [run_stages(hdf5_file, tmp_dir, args.config, args.config_qc, args.config_eprofile, args.bufr_types, args.resolution)
+                for _ in range(n_repeat)]
+    return {stage: {'min': round(min(run[stage] for run in runs), 6),
+                    'median': round(float(np.median([run[stage] for run in runs])), 6),
+                    'n_repeat': n_repeat}
+            for stage in runs[0]}
+
+
+def compare(results, baseline, max_slowdown, min_time):
+    """
+    Print the ratio of the median times to the baseline
+    Output: list of (size, stage, ratio) slower than max_slowdown (stages faster than min_time s in both runs are ignored)
+    """
+    regressions = []
+    print(f"\nComparison to {baseline['commit']} (median ratio, > {max_slowdown} flagged)")
+    for size, stages in results['results'].items():
+        for stage, result in stages.items():
+            ref = baseline['results'].get(size, {}).get(stage)
+            if ref is None:
+                print(f'{size:8s} {stage:32s} {"new":>8s}')
+                continue
+            ratio = result['median']/ref['median'] if ref['median'] > 0 else float('inf')
+            regression = ratio > max_slowdown and max(result['median'], ref['median']) >= min_time
+            print(f"{size:8s} {stage:32s} {ratio:8.2f} {'REGRESSION' if regression else ''}")
+            if regression:
+                regressions.append((size, stage, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages at several data sizes')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium', 'large'], choices=list(SIZES))
+    parser.add_argument('--n_repeat', type=int, default=5)
+    parser.add_argument('--config', default=os.path.join(CONFIG_DIR, 'config_nc.yaml'))
+    parser.add_argument('--config_qc', default=os.path.join(CONFIG_DIR, 'config_qc1.yaml'))
+    parser.add_argument('--config_eprofile', default=os.path.join(CONFIG_DIR, 'config_eprofile.yaml'))
+    parser.add_argument('--bufr_types', nargs='+', default=['wind', 'temperature', 'wind_and_temperature'])
+    parser.add_argument('--resolution', default='high', help='Quicklook resolution tier (low, medium, high)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic files')
+    parser.add_argument('--output', default=None, help='Results file (default: benchmarks/results/stages_<commit>.json)')
+    parser.add_argument('--compare', default=None, help='Results file of the baseline commit')
+    parser.add_argument('--max_slowdown', type=float, default=1.25, help='Median ratio to the baseline flagged as a regression')
+    parser.add_argument('--min_time', type=float, default=0.01, help='Stages faster than this (s) are not flagged')
+    args = parser.parse_args()
+
+    from euliaa_proc.log import logger
+    logger.setLevel(logging.ERROR) # the log I/O is not part of the stages
+    warnings.filterwarnings('ignore', message='All-NaN slice encountered')
+
+    commit = get_commit()
+    results = {'commit': commit, 'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'machine': platform.node(), 'n_repeat': args.n_repeat,
+               'sizes': {size: dict(zip(['n_time', 'n_alt_mie', 'n_alt_ray'], SIZES[size])) for size in args.sizes},
+               'results': {}}
+    for size in args.sizes:
+        results['results'][size] = benchmark_size(size, args.n_repeat, args)
+        print(f'\n{size} {SIZES[size]} (n_time, n_alt_mie, n_alt_ray)')
+        for stage, result in results['results'][size].items():
+            print(f"  {stage:32s} min {result['min']*1e3:9.1f} ms   median {result['median']*1e3:9.1f} ms")
+
+    output = args.output or os.path.join(RESULTS_DIR, f'stages_{commit or "nogit"}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nResults saved to {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_slowdown, args.min_time)
+        if regressions:
+            print(f'{len(regressions)} stage(s) slower than {args.max_slowdown}x the baseline')
+            raise SystemExit(1)
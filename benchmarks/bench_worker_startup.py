@@ -0,0 +1,82 @@
+"""
+Benchmark of the worker start-up: latency of the first file processed by a cold worker (spawned, nothing imported)
+and by a warm worker (preloaded with processing_manager.preload_worker before the file arrives).
+
+Both runs go through processing_manager.run_processing_pipeline on a local BankExport file (outputs in a
+temporary directory; the 2 s wait of the S3 notifications is not included). The warm-up time of the warm worker is reported separately:
+it is paid when the worker starts, before any notification.
+
+Usage:
+    python benchmarks/bench_worker_startup.py BankExport_20250522_120000.h5 [--config_main config_main.yaml] [--n_repeat 3]
+"""
+import os
+import time
+import yaml
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'euliaa_proc', 'config', 'config_main.yaml')
+
+
+def run_file(hdf5_file, config_template):
+    from euliaa_proc.processing_manager import run_processing_pipeline
+    return run_processing_pipeline(hdf5_file, config_template)
+
+
+def first_file_latency(hdf5_file, config_template, warm):
+    """
+    Start a one-worker pool and process one file
+    Output: (warm-up time, time from the file submission to its end) in s
+    """
+    from euliaa_proc.processing_manager import preload_worker
+    t0 = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=preload_worker if warm else None, initargs=(config_template,) if warm else ())
+    t_ready = 0.
+    if warm: # the worker is started and preloaded before the first notification
+        executor.submit(os.getpid).result()
+        t_ready = time.perf_counter()-t0
+    t1 = time.perf_counter()
+    success = executor.submit(run_file, hdf5_file, config_template).result()
+    latency = time.perf_counter()-t1
+    executor.shutdown()
+    if not success:
+        raise RuntimeError(f'Processing of {hdf5_file} failed, see the log')
+    return t_ready, latency
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the first-file latency of cold and warm workers')
+    parser.add_argument('hdf5_file', help='Local BankExport file (name with YYYYmmdd_HHMMSS)')
+    parser.add_argument('--config_main', default=DEFAULT_CONFIG, help='Main config used as template (output directories are replaced)')
+    parser.add_argument('--config', default=None, help='Override of the netCDF config path of the template')
+    parser.add_argument('--config_qc', default=None, help='Override of the QC config path of the template')
+    parser.add_argument('--config_eprofile', default=None, help='Override of the eprofile config path of the template')
+    parser.add_argument('--n_repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.config_main) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for key in ['config', 'config_qc', 'config_eprofile']:
+            if getattr(args, key):
+                config[key] = os.path.abspath(getattr(args, key))
+        for key in ['output_nc_dir', 'output_bufr_dir', 'fig_dir']:
+            config[key] = os.path.join(tmp_dir, key)
+            os.makedirs(config[key])
+        for key in ['daily_cache_dir', 'daily_fig_dir', 'eprofile_state_dir', 'processed_index_db']:
+            config[key] = None
+        config_template = os.path.join(tmp_dir, 'config_main.yaml')
+        with open(config_template, 'w') as f:
+            yaml.dump(config, f)
+
+        hdf5_file = os.path.abspath(args.hdf5_file)
+        for warm in [False, True]:
+            results = [first_file_latency(hdf5_file, config_template, warm) for _ in range(args.n_repeat)]
+            t_ready = sorted(r[0] for r in results)[len(results)//2]
+            latency = sorted(r[1] for r in results)[len(results)//2]
+            label = 'warm' if warm else 'cold'
+            print(f'{label}: first-file latency {latency:.2f} s (median of {args.n_repeat})' +
+                  (f', worker warm-up {t_ready:.2f} s before the first file' if warm else ''))
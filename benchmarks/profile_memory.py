@@ -0,0 +1,174 @@
+"""
+Peak-memory profile of the processing pipeline, to size the memory of the workers.
+
+The Runner processes synthetic BankExport files (euliaa_proc.synthetic_bankexport) of growing size, each in a fresh
+process, with tracemalloc tracing: the stage records (see instrumentation.StageRecorder) give for each stage the change
+of the peak RSS, the change and the peak of the traced memory, and the top allocation sites of the memory it retains.
+The report gives, per stage:
+    - the scaling of the traced peak with the number of elements n_time x n_alt x n_los: bytes per element (linear fit)
+      and exponent (log-log fit)
+    - the transient memory (peak minus memory retained at the end of the stage) in units of one full
+      (time, altitude_mie, line_of_sight) float32 array; stages with transient copies of at least --copy_threshold
+      full arrays are flagged (e.g. the deep copy of add_clouds, xr.merge, set_invalid_to_nan)
+and a linear fit of the peak RSS of the worker, a + b x n_time x n_alt x n_los.
+
+Tracing slows the stages down (tracemalloc hooks and snapshots, a few minutes per size): use bench_stages.py for timings.
+The pipeline only supports the 3 LOS of the config, so the sizes vary n_time and n_alt (Mie and Rayleigh gates).
+
+Usage:
+    python benchmarks/profile_memory.py [--sizes 30x200 60x400 120x800 240x800] [--output memory.json] [--n_top 5]
+"""
+import os
+import json
+import logging
+import argparse
+import tempfile
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'euliaa_proc', 'config')
+N_LOS = 3
+
+
+def profile_size(n_time, n_alt, config, n_frames=10, n_top=5):
+    """
+    Run the Runner stages on a synthetic file of n_time profiles and n_alt gates, with tracemalloc tracing
+    (to be run in a fresh process, so that the peak RSS is the one of this file). The file is processed once
+    without tracing first, so that the traced run is the one of a warm worker.
+    Output: dict with the stage records and the peak RSS (MB) of the process
+    """
+    import tracemalloc
+    import yaml
+    from euliaa_proc.log import logger
+    from euliaa_proc.main import Runner
+    from euliaa_proc.instrumentation import StageRecorder, get_peak_rss_mb
+    from euliaa_proc.processing_manager import get_file_args, preload_worker
+    from euliaa_proc.synthetic_bankexport import generate_bankexport
+    logger.setLevel(logging.ERROR)
+    warnings.filterwarnings('ignore', message='All-NaN slice encountered')
+
+    def run_pipeline(runner):
+        runner.run_processing()
+        runner.write_dwl_eprofile()
+        runner.write_l2a_and_l2b()
+        runner.encode_bufr()
+        runner.make_quicklooks()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdf5_file = generate_bankexport(tmp_dir, n_time=n_time, n_alt_mie=n_alt, n_alt_ray=n_alt)
+        config = dict(config, output_nc_dir=tmp_dir, output_bufr_dir=tmp_dir, fig_dir=tmp_dir)
+        config_file = os.path.join(tmp_dir, 'config_main.yaml')
+        with open(config_file, 'w') as f:
+            yaml.dump(config, f)
+        # the lazily imported modules and one-off initialisations are not part of the stages (as in a preloaded worker)
+        preload_worker(config_file)
+        run_pipeline(Runner(get_file_args(config, hdf5_file)))
+
+        runner = Runner(get_file_args(config, hdf5_file))
+        tracemalloc.start(n_frames)
+        runner.recorder = StageRecorder(os.path.basename(hdf5_file), trace_memory=True, n_top_allocators=n_top)
+        run_pipeline(runner)
+        tracemalloc.stop()
+    return {'n_time': n_time, 'n_alt': n_alt, 'n_los': N_LOS, 'n_elements': n_time*n_alt*N_LOS,
+            'peak_rss_mb': get_peak_rss_mb(), 'records': runner.recorder.records}
+
+
+def stage_memory(profile):
+    """
+    Memory of each stage of one profile (maximum over the calls of a stage called several times)
+    Output: dict {stage: {peak_mb, transient_mb, transient_arrays, peak_rss_delta_mb, top_allocators, leaf}}
+    """
+    array_mb = profile['n_elements']*4/1e6 # one full (time, altitude_mie, line_of_sight) float32 array
+    parents = {record['parent'] for record in profile['records']}
+    stages = {}
+    for record in profile['records']:
+        transient = record['traced_peak_delta_mb'] - max(record['traced_delta_mb'], 0.)
+        stage = stages.setdefault(record['stage'], {'peak_mb': -np.inf, 'transient_mb': -np.inf, 'peak_rss_delta_mb': 0.,
+                                                    'top_allocators': [], 'leaf': record['stage'] not in parents})
+        stage['peak_rss_delta_mb'] = max(stage['peak_rss_delta_mb'], record['peak_rss_delta_mb'])
+        stage['peak_mb'] = max(stage['peak_mb'], record['traced_peak_delta_mb'])
+        if transient > stage['transient_mb']:
+            stage['transient_mb'] = round(transient, 2)
+            stage['top_allocators'] = record.get('top_allocators', [])
+    for stage in stages.values():
+        stage['transient_arrays'] = round(stage['transient_mb']/array_mb, 2)
+    return stages
+
+
+def fit_scaling(n_elements, values_mb):
+    """(bytes per element, offset in MB) of a linear fit, and exponent of a log-log fit (None if not enough positive values)"""
+    n_elements, values_mb = np.asarray(n_elements, dtype=float), np.asarray(values_mb, dtype=float)
+    slope, offset = np.polyfit(n_elements, values_mb, 1) if len(n_elements) > 1 else (np.nan, np.nan)
+    positive = values_mb > 0
+    exponent = np.polyfit(np.log(n_elements[positive]), np.log(values_mb[positive]), 1)[0] if positive.sum() > 1 else None
+    return slope*1e6, offset, exponent
+
+
+def report(profiles, copy_threshold):
+    """print the scaling of the stages and the copies flagged; returns the report dict"""
+    n_elements = [profile['n_elements'] for profile in profiles]
+    memories = [stage_memory(profile) for profile in profiles]
+    largest = memories[-1]
+    result = {'stages': {}, 'flagged': []}
+
+    print(f"\n{'stage':46s} {'B/elem':>8s} {'exp':>5s} " + ' '.join(f"{str(p['n_time'])+'x'+str(p['n_alt']):>10s}" for p in profiles)
+          + '   transient arrays (largest)')
+    for stage in largest:
+        peaks = [memory.get(stage, {}).get('peak_mb', np.nan) for memory in memories]
+        bytes_per_element, _, exponent = fit_scaling(n_elements, peaks)
+        transient_arrays = largest[stage]['transient_arrays']
+        flagged = largest[stage]['leaf'] and transient_arrays >= copy_threshold
+        result['stages'][stage] = {'peak_mb': peaks, 'bytes_per_element': round(bytes_per_element, 2),
+                                   'exponent': None if exponent is None else round(exponent, 2),
+                                   'transient_arrays': transient_arrays, 'flagged': bool(flagged)}
+        print(f"{stage:46s} {bytes_per_element:8.1f} {exponent if exponent is not None else np.nan:5.2f} "
+              + ' '.join(f'{peak:10.1f}' for peak in peaks) + f"   {transient_arrays:6.1f} {'COPY' if flagged else ''}")
+        if flagged:
+            result['flagged'].append(stage)
+
+    rss = [profile['peak_rss_mb'] for profile in profiles]
+    rss_per_element, rss_offset, _ = fit_scaling(n_elements, rss)
+    result['peak_rss_mb'] = rss
+    result['peak_rss_fit'] = {'offset_mb': round(rss_offset, 1), 'bytes_per_element': round(rss_per_element, 1)}
+    print('\nPeak RSS of the worker: ' + ', '.join(f"{p['n_time']}x{p['n_alt']}x{p['n_los']}: {p['peak_rss_mb']:.0f} MB" for p in profiles))
+    print(f'  ~ {rss_offset:.0f} MB + {rss_per_element:.0f} B x n_time x n_alt x n_los')
+
+    if result['flagged']:
+        print(f'\nStages with transient copies of >= {copy_threshold} full arrays, top allocation sites at the largest size:')
+        for stage in result['flagged']:
+            print(f"  {stage}: {largest[stage]['transient_mb']:.1f} MB transient")
+            for site, size_mb in largest[stage]['top_allocators']:
+                print(f'      {size_mb:+8.2f} MB retained  {site}')
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak-memory profile of the pipeline stages on synthetic inputs of growing size')
+    parser.add_argument('--sizes', nargs='+', default=['30x200', '60x400', '120x800', '240x800'], help='n_time x n_alt of the inputs')
+    parser.add_argument('--config', default=os.path.join(CONFIG_DIR, 'config_nc.yaml'))
+    parser.add_argument('--config_qc', default=os.path.join(CONFIG_DIR, 'config_qc1.yaml'))
+    parser.add_argument('--config_eprofile', default=os.path.join(CONFIG_DIR, 'config_eprofile.yaml'))
+    parser.add_argument('--bufr_types', nargs='+', default=['wind', 'temperature'])
+    parser.add_argument('--n_frames', type=int, default=10, help='Frames kept by tracemalloc per allocation')
+    parser.add_argument('--n_top', type=int, default=5, help='Top allocation sites per stage (0: no snapshots)')
+    parser.add_argument('--copy_threshold', type=float, default=1., help='Transient memory (in full arrays) flagged as a copy')
+    parser.add_argument('--output', default=None, help='JSON file of the profiles and report')
+    args = parser.parse_args()
+
+    config = {'config': args.config, 'config_qc': args.config_qc, 'config_eprofile': args.config_eprofile,
+              'bufr_types': args.bufr_types, 'quicklook_resolution': 'low', 'instrumentation': True}
+    sizes = sorted((tuple(int(n) for n in size.split('x')) for size in args.sizes), key=lambda size: size[0]*size[1])
+    profiles = []
+    for n_time, n_alt in sizes:
+        # one process per size: the peak RSS is per process
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            profiles.append(executor.submit(profile_size, n_time, n_alt, config, args.n_frames, args.n_top).result())
+        print(f"{n_time}x{n_alt}x{N_LOS}: peak RSS {profiles[-1]['peak_rss_mb']:.0f} MB")
+
+    result = report(profiles, args.copy_threshold)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'profiles': profiles, 'report': result}, f, indent=1)
+        print(f'\nProfiles saved to {args.output}')
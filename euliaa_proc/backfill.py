@@ -0,0 +1,136 @@
+import datetime
+import glob
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from euliaa_proc.log import logger, get_worker_log_queue, init_worker_logging
+from euliaa_proc.processed_index import ProcessedIndex
+from euliaa_proc.processing_manager import run_processing_batch, preload_worker
+
+DATE_PATTERN = re.compile(r"([0-9]{4}[0-9]{2}[0-9]{2}_[0-9]{2}[0-9]{2}[0-9]{2})")
+
+
+def get_file_time(filepath):
+    """measurement time of a BankExport file from its name (YYYYmmdd_HHMMSS), None if the name has no date"""
+    date_str = DATE_PATTERN.search(os.path.basename(filepath))
+    if date_str is None:
+        return None
+    return datetime.datetime.strptime(date_str.group(1), '%Y%m%d_%H%M%S')
+
+
+def list_files(source, start=None, end=None):
+    """
+    HDF5 files of a local directory (recursively) or of an S3 prefix (s3://bucket/prefix), with start <= file time < end
+    Output: sorted list of paths (s3:// URLs for S3)
+    """
+    if source.startswith('s3://'):
+        import fsspec
+        fs = fsspec.filesystem('s3')
+        files = ['s3://' + path for path in fs.find(source[len('s3://'):]) if path.endswith('.h5')]
+    else:
+        files = glob.glob(os.path.join(source, '**', '*.h5'), recursive=True)
+    selected = []
+    for filepath in files:
+        file_time = get_file_time(filepath)
+        if file_time is None:
+            logger.warning(f'No date in the name of {filepath}, skipping')
+            continue
+        if (start is None or file_time >= start) and (end is None or file_time < end):
+            selected.append(filepath)
+    return sorted(selected, key=get_file_time)
+
+
+def split_path(filepath):
+    """(bucket, key) of an S3 URL, ('', absolute path) of a local file: the identifiers of the checkpoint index"""
+    if filepath.startswith('s3://'):
+        bucket, _, key = filepath[len('s3://'):].partition('/')
+        return bucket, key
+    return '', os.path.abspath(filepath)
+
+
+def backfill_task(filepaths, config_template, checkpoint_db):
+    """
+    Process a chunk of files in a worker, recording their status in the checkpoint index
+    Output: list of (filepath, success, stage summary)
+    """
+    index = ProcessedIndex(checkpoint_db)
+    for filepath in filepaths:
+        index.mark_running(*split_path(filepath))
+    summaries = []
+    results = run_processing_batch(filepaths, config_template, summaries=summaries)
+    for filepath, success in zip(filepaths, results):
+        if success:
+            index.mark_done(*split_path(filepath))
+        else:
+            index.mark_failed(*split_path(filepath), error='processing error, see log')
+    return list(zip(filepaths, results, summaries))
+
+
+def run_backfill(source, config_template, checkpoint_db, start=None, end=None, n_workers=4, chunk_size=1):
+    """
+    Reprocess the archive files of source within [start, end) over a pool of n_workers processes.
+    Files are checkpointed in the SQLite index checkpoint_db: the files already done in a previous (interrupted) run
+    are skipped and the failed ones are retried. Files are handed to the workers in chunks of chunk_size,
+    which share the config loading and the S3 downloads.
+    Output: report dict (counts, elapsed time, throughput)
+    """
+    files = list_files(source, start, end)
+    # stale_after=0: entries left queued/running by an interrupted run are claimed again
+    index = ProcessedIndex(checkpoint_db, stale_after=0)
+    todo = [filepath for filepath in files if index.claim(*split_path(filepath))]
+    logger.info(f'Backfill of {source}: {len(files)} files in the time range, {len(files)-len(todo)} already done, {len(todo)} to process')
+
+    t0 = time.time()
+    n_done, n_failed, bytes_read = 0, 0, 0
+    chunks = [todo[i:i+chunk_size] for i in range(0, len(todo), chunk_size)]
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker_logging, initargs=(get_worker_log_queue(), preload_worker, (config_template,))) as executor:
+        futures = {executor.submit(backfill_task, chunk, config_template, checkpoint_db): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.error(f'Backfill task {futures[future]} failed: {e}')
+                for filepath in futures[future]:
+                    index.mark_failed(*split_path(filepath), error=str(e))
+                results = [(filepath, False, None) for filepath in futures[future]]
+            for filepath, success, summary in results:
+                n_done += success
+                n_failed += not success
+                if summary is not None:
+                    bytes_read += summary.get('bytes_read', 0)
+            elapsed = time.time() - t0
+            logger.info(f'Backfill progress: {n_done+n_failed}/{len(todo)} files ({n_failed} failed), '
+                        f'{3600*(n_done+n_failed)/elapsed:.0f} files/hour')
+
+    elapsed = time.time() - t0
+    processed = todo and elapsed > 0
+    return {'n_files': len(files), 'n_skipped': len(files)-len(todo), 'n_done': n_done, 'n_failed': n_failed,
+            'elapsed': elapsed, 'files_per_hour': 3600*(n_done+n_failed)/elapsed if processed else None,
+            'mb_read_per_s': bytes_read/1e6/elapsed if processed else None}
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Reprocess archived BankExport files in parallel (resumable)')
+    parser.add_argument('source', help='Local directory or S3 prefix (s3://bucket/prefix) of the HDF5 files')
+    parser.add_argument('--config_main', type=str, help='Main config (as for the processing manager)',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config/config_main.yaml'))
+    parser.add_argument('--start', type=str, default=None, help='First file time, e.g. 2025-05-22 or 2025-05-22T12:00 (inclusive)')
+    parser.add_argument('--end', type=str, default=None, help='Last file time (exclusive)')
+    parser.add_argument('--n_workers', type=int, default=4, help='Number of worker processes')
+    parser.add_argument('--chunk_size', type=int, default=1, help='Number of files per worker task')
+    parser.add_argument('--checkpoint', type=str, default='backfill_checkpoint.sqlite', help='SQLite checkpoint of the processed files')
+    args = parser.parse_args()
+
+    start = datetime.datetime.fromisoformat(args.start) if args.start else None
+    end = datetime.datetime.fromisoformat(args.end) if args.end else None
+    report = run_backfill(args.source, args.config_main, args.checkpoint, start=start, end=end,
+                          n_workers=args.n_workers, chunk_size=args.chunk_size)
+    print(f"Files in range: {report['n_files']}, skipped (already done): {report['n_skipped']}, "
+          f"processed: {report['n_done']}, failed: {report['n_failed']}")
+    if report['files_per_hour'] is not None:
+        print(f"Elapsed: {report['elapsed']:.1f} s, throughput: {report['files_per_hour']:.0f} files/hour, "
+              f"{report['mb_read_per_s']:.2f} MB/s read")
@@ -0,0 +1,157 @@
+import os
+import functools
+import numpy as np
+import xarray as xr
+from types import SimpleNamespace
+from netCDF4 import Dataset
+from euliaa_proc.log import logger, get_worker_log_queue, init_worker_logging
+from euliaa_proc.measurement import Measurement, H5Reader
+from euliaa_proc.stage_graph import STAGES, run_stage
+
+# dask is only needed by this module (multi-day processing): it is imported by the functions that use it
+
+
+def process_files(hdf5_files, config, config_qc, precision='float64', **reader_kwargs):
+    """
+    Ingest and process a group of consecutive BankExport files as in Runner.run_processing (all stages),
+    concatenated along time. Every stage works profile by profile, so a group is processed independently of the others
+    reader_kwargs: other options of the H5Reader (altitude_window, noise_full_profile)
+    Output: processed dataset
+    """
+    datasets = []
+    for hdf5_file in hdf5_files:
+        meas = H5Reader(config, hdf5_file, conf_qc_file=config_qc, precision=precision, **reader_kwargs)
+        meas.read_hdf5_file()
+        meas.load_attrs()
+        meas.load_data()
+        datasets.append(meas.data)
+    meas.data = xr.concat(datasets, dim='time', data_vars='minimal', coords='minimal', compat='override', join='outer') \
+        if len(datasets) > 1 else datasets[0]
+    for stage in STAGES:
+        run_stage(meas, stage)
+    return meas.data
+
+
+def get_n_time(hdf5_file, conf):
+    """number of profiles of a BankExport file, from the shape of its time variable (without reading the data)"""
+    specs = conf['variables']['time']['original_hdf5']
+    with Dataset(hdf5_file) as nc:
+        return nc.groups[specs['hdf5_group']].variables[specs['hdf5_var_name']].shape[0]
+
+
+def get_values(data, var):
+    return data[var].values
+
+
+class ChunkedMeasurement(Measurement):
+    """
+    Measurement of many consecutive BankExport files (e.g. days of data) whose data is dask-backed along time.
+
+    The files are grouped in chunks of files_per_chunk files; each chunk is one dask task ingesting and processing its
+    files (process_files), and the variables of self.data are lazy dask arrays of these tasks. Nothing is read before
+    a part of the data is computed, e.g. by write_nc_streamed, which computes and writes the chunks n_workers at a time,
+    so that the memory used is bounded by n_workers chunks whatever the number of files.
+    All files must have the same altitude grids and lines of sight: the variables without a time dimension are
+    taken from the first file.
+    """
+
+    def __init__(self, conf_file, hdf5_files, conf_qc_file=None, precision='float64', files_per_chunk=1, reader_kwargs=None):
+        super().__init__(conf_file, conf_qc_file=conf_qc_file, precision=precision)
+        self.conf_file = conf_file
+        self.conf_qc_file = conf_qc_file
+        self.reader_kwargs = reader_kwargs or {}
+        self.hdf5_files = list(hdf5_files)
+        self.chunk_files = [self.hdf5_files[i:i+files_per_chunk] for i in range(0, len(self.hdf5_files), files_per_chunk)]
+        self.chunk_sizes = []
+
+    def load_data(self):
+        """build the lazy dataset: structure from the processing of the first file, one dask chunk per group of files"""
+        import dask
+        import dask.array as da
+        sample = process_files(self.hdf5_files[:1], self.conf_file, self.conf_qc_file, self.precision, **self.reader_kwargs)
+        self.chunk_sizes = [sum(get_n_time(hdf5_file, self.conf) for hdf5_file in files) for files in self.chunk_files]
+        tasks = [dask.delayed(process_files)(files, self.conf_file, self.conf_qc_file, self.precision, **self.reader_kwargs)
+                 for files in self.chunk_files]
+
+        variables = {}
+        for var in sample.variables:
+            dims = sample[var].dims
+            if 'time' not in dims:
+                variables[var] = sample[var].variable
+                continue
+            axis = dims.index('time')
+            blocks = []
+            for task, n_time in zip(tasks, self.chunk_sizes):
+                shape = tuple(n_time if dim == 'time' else size for dim, size in zip(dims, sample[var].shape))
+                blocks.append(da.from_delayed(dask.delayed(get_values)(task, var), shape=shape, dtype=sample[var].dtype))
+            variables[var] = xr.Variable(dims, da.concatenate(blocks, axis=axis), attrs=sample[var].attrs)
+        self.data = xr.Dataset({var: variable for var, variable in variables.items() if var not in sample.coords},
+                               coords={var: variables[var] for var in sample.coords}, attrs=sample.attrs)
+        logger.info(f'Chunked measurement of {len(self.hdf5_files)} files, {sum(self.chunk_sizes)} profiles in {len(tasks)} chunks')
+
+    def write_nc_streamed(self, output_file, n_workers=1):
+        """
+        Compute the chunks n_workers at a time (dask processes scheduler) and write them to the netCDF file output_file:
+        the first ones with the Writer, the next ones appended along the unlimited time dimension
+        """
+        from euliaa_proc.write_netcdf import Writer
+        bounds = np.concatenate([[0], np.cumsum(self.chunk_sizes)])
+        initializer = functools.partial(init_worker_logging, get_worker_log_queue()) # worker records written by this process
+        for i in range(0, len(self.chunk_sizes), n_workers):
+            start, stop = bounds[i], bounds[min(i+n_workers, len(self.chunk_sizes))]
+            part = self.data.isel(time=slice(start, stop)).compute(scheduler='processes', num_workers=n_workers, initializer=initializer)
+            if i == 0:
+                Writer(SimpleNamespace(conf=self.conf, data=part), output_file=output_file).write_nc()
+            else:
+                append_along_time(part, output_file, start)
+            logger.info(f'Wrote profiles {start}-{stop} of {bounds[-1]} to {output_file}')
+
+
+def append_along_time(data, output_file, offset):
+    """write the time-dependent variables of data to output_file (written by the Writer) from the time index offset"""
+    with Dataset(output_file, 'a') as nc:
+        for var, nc_var in nc.variables.items():
+            if 'time' not in nc_var.dimensions or var not in data.variables:
+                continue
+            values = data[var].transpose(*nc_var.dimensions).values
+            if np.issubdtype(values.dtype, np.floating):
+                values = np.ma.masked_invalid(values) # NaN written as _FillValue, as by the Writer
+            index = tuple(slice(offset, offset + data.sizes['time']) if dim == 'time' else slice(None) for dim in nc_var.dimensions)
+            nc_var.set_auto_scale(False)
+            nc_var[index] = values.astype(nc_var.dtype)
+
+
+def run_chunked(hdf5_files, config, output_file, files_per_chunk=1, n_workers=1):
+    """
+    Process hdf5_files (sorted in time) into one L2A file, chunk by chunk
+    config: main config (as for the processing manager)
+    """
+    reader_kwargs = {'altitude_window': {scat: config.get(f'altitude_window_{scat}') for scat in ['mie', 'ray']},
+                     'noise_full_profile': config.get('noise_full_profile') is not False}
+    meas = ChunkedMeasurement(config['config'], hdf5_files, conf_qc_file=config['config_qc'],
+                              precision=config.get('precision') or 'float64', files_per_chunk=files_per_chunk, reader_kwargs=reader_kwargs)
+    meas.load_data()
+    meas.write_nc_streamed(output_file, n_workers=n_workers)
+    return meas
+
+
+if __name__=='__main__':
+    import argparse
+    import datetime
+    from euliaa_proc.backfill import list_files
+    from euliaa_proc.utils.conf_utils import get_conf
+    parser = argparse.ArgumentParser(description='Process days of BankExport files into one L2A file, chunk by chunk within a fixed memory')
+    parser.add_argument('source', help='Local directory of the HDF5 files')
+    parser.add_argument('output_file', help='Output L2A netCDF file')
+    parser.add_argument('--config_main', type=str, help='Main config (as for the processing manager): config, config_qc, precision, altitude windows',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config/config_main.yaml'))
+    parser.add_argument('--start', type=str, default=None, help='First file time, e.g. 2025-05-22 (inclusive)')
+    parser.add_argument('--end', type=str, default=None, help='Last file time (exclusive)')
+    parser.add_argument('--files_per_chunk', type=int, default=1, help='Number of files per time chunk')
+    parser.add_argument('--n_workers', type=int, default=1, help='Number of chunks processed in parallel (memory ~ n_workers chunks)')
+    args = parser.parse_args()
+
+    start = datetime.datetime.fromisoformat(args.start) if args.start else None
+    end = datetime.datetime.fromisoformat(args.end) if args.end else None
+    run_chunked(list_files(args.source, start, end), get_conf(args.config_main), args.output_file,
+                files_per_chunk=args.files_per_chunk, n_workers=args.n_workers)
@@ -0,0 +1,223 @@
+import xarray as xr
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import matplotlib.dates as mdates
+import numpy as np
+import threading
+import fcntl
+import os
+from io import BytesIO
+from euliaa_proc.quicklooks import QUICKLOOK_PANELS, QUICKLOOK_RESOLUTIONS, mask_flagged
+from euliaa_proc.log import logger
+from euliaa_proc.instrumentation import count_bytes
+
+_TEMPLATE = {}
+_TEMPLATE_LOCK = threading.Lock()
+
+
+class DailyRaster():
+    """
+    Downsampled (time, altitude) raster of one day for each quicklook panel.
+    Sums and counts are accumulated per cell, so each new L2A file is merged in constant time
+    and the daily image is the cell mean (sum/count).
+    The contribution of each source file (sums and counts over the time bins it touches) is kept, so that a
+    reprocessed or redelivered file replaces its previous contribution instead of being counted twice.
+    """
+
+    def __init__(self, day, time_res=120, alt_res=250, alt_max=50000):
+        self.day = np.datetime64(day, 'D')
+        self.time_res = time_res
+        self.alt_res = alt_res
+        self.alt_max = alt_max
+        self.n_time = int(np.ceil(86400/time_res))
+        self.n_alt = int(np.ceil(alt_max/alt_res))
+        self.sums = {var: np.zeros((self.n_alt, self.n_time)) for var, _, _ in QUICKLOOK_PANELS}
+        self.counts = {var: np.zeros((self.n_alt, self.n_time), dtype=np.int32) for var, _, _ in QUICKLOOK_PANELS}
+        self.contributions = {} # {source: (first time bin, {var: sum}, {var: count})}
+
+    @classmethod
+    def load(cls, cache_file, day, **kwargs):
+        """load the raster from the cache file, or create an empty one if missing or incompatible"""
+        raster = cls(day, **kwargs)
+        if not os.path.exists(cache_file):
+            return raster
+        with np.load(cache_file) as cache:
+            if (cache['time_res'] != raster.time_res) or (cache['alt_res'] != raster.alt_res) or (cache['alt_max'] != raster.alt_max):
+                logger.warning(f'Daily raster {cache_file} has a different grid, starting a new one')
+                return raster
+            for var in raster.sums:
+                raster.sums[var] = cache[f'{var}_sum']
+                raster.counts[var] = cache[f'{var}_count']
+            sources = cache['sources'] if 'sources' in cache else []
+            for i, source in enumerate(sources):
+                raster.contributions[str(source)] = (int(cache['source_first_bin'][i]),
+                                                     {var: cache[f'source{i}_{var}_sum'] for var in raster.sums},
+                                                     {var: cache[f'source{i}_{var}_count'] for var in raster.sums})
+        return raster
+
+    def save(self, cache_file):
+        """write the raster to the cache file (atomic replace)"""
+        tmp_file = cache_file + '.tmp.npz'
+        arrays = {'time_res': self.time_res, 'alt_res': self.alt_res, 'alt_max': self.alt_max}
+        for var in self.sums:
+            arrays[f'{var}_sum'] = self.sums[var]
+            arrays[f'{var}_count'] = self.counts[var]
+        arrays['sources'] = np.array(list(self.contributions), dtype=str)
+        arrays['source_first_bin'] = np.array([first_bin for first_bin, _, _ in self.contributions.values()], dtype=np.int64)
+        for i, (_, sums, counts) in enumerate(self.contributions.values()):
+            for var in self.sums:
+                arrays[f'source{i}_{var}_sum'] = sums[var]
+                arrays[f'source{i}_{var}_count'] = counts[var]
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, cache_file)
+
+    def merge(self, ds, source=None):
+        """
+        add the profiles of ds (masked L2A, profiles of this day only) to the raster
+        source: name of the file of ds; if it already contributed, its previous contribution is replaced
+        """
+        if source in self.contributions:
+            logger.info(f'{source} already in the daily raster, replacing its contribution')
+            self.remove(source)
+        seconds = (ds['time'].values - self.day.astype('datetime64[ns]'))/np.timedelta64(1, 's')
+        it = np.clip((seconds//self.time_res).astype(int), 0, self.n_time-1)
+        first_bin = int(it.min())
+        n_bins = int(it.max()) - first_bin + 1
+        iz = (ds['altitude_mie'].values//self.alt_res).astype(int)
+        valid_z = (iz >= 0) & (iz < self.n_alt)
+        # flat index of each (altitude, time) sample in the time bins touched by ds
+        cell = (iz[valid_z][:, None]*n_bins + (it - first_bin)[None, :]).ravel()
+        sums, counts = {}, {}
+        for var, los, _ in QUICKLOOK_PANELS:
+            da = ds[var]
+            if los is not None:
+                da = da.sel(line_of_sight=los)
+            values = da.transpose('altitude_mie', 'time').values[valid_z].ravel()
+            finite = np.isfinite(values)
+            sums[var] = np.bincount(cell[finite], weights=values[finite], minlength=self.n_alt*n_bins).reshape(self.n_alt, n_bins)
+            counts[var] = np.bincount(cell[finite], minlength=self.n_alt*n_bins).reshape(self.n_alt, n_bins).astype(np.int32)
+            self.sums[var][:, first_bin:first_bin+n_bins] += sums[var]
+            self.counts[var][:, first_bin:first_bin+n_bins] += counts[var]
+        if source is not None:
+            self.contributions[source] = (first_bin, sums, counts)
+
+    def remove(self, source):
+        """subtract the contribution of the file source from the raster"""
+        first_bin, sums, counts = self.contributions.pop(source)
+        for var in self.sums:
+            n_bins = sums[var].shape[1]
+            self.sums[var][:, first_bin:first_bin+n_bins] -= sums[var]
+            self.counts[var][:, first_bin:first_bin+n_bins] -= counts[var]
+
+    def mean(self, var):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts[var] > 0, self.sums[var]/self.counts[var], np.nan)
+
+
+class DailyQuicklookTemplate():
+    """Agg-only figure for the daily quicklook; the images are created once and only their data is updated"""
+
+    def __init__(self, figsize=(12, 14)):
+        self.fig = Figure(figsize=figsize)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.fig.subplots_adjust(left=0.08, right=0.93, bottom=0.04, top=0.97, hspace=0.35)
+        self.axs = self.fig.subplots(len(QUICKLOOK_PANELS))
+        self.images = [None]*len(QUICKLOOK_PANELS)
+        self.lock = threading.Lock()
+
+    def render(self, raster, fig_title):
+        t0 = mdates.date2num(raster.day.astype('datetime64[ns]'))
+        extent = [t0, t0+1, 0, raster.n_alt*raster.alt_res]
+        for i, (var, _, kwargs) in enumerate(QUICKLOOK_PANELS):
+            ax = self.axs[i]
+            values = raster.mean(var) + kwargs.get('offset', 0)
+            if self.images[i] is None:
+                norm = kwargs.get('norm')
+                self.images[i] = ax.imshow(values, origin='lower', aspect='auto', interpolation='nearest', extent=extent,
+                                           norm=norm, cmap=kwargs['cmap'], vmin=None if norm else kwargs.get('vmin'),
+                                           vmax=None if norm else kwargs.get('vmax'))
+                self.fig.colorbar(self.images[i], ax=ax, extend=kwargs.get('extend', 'neither'), label=kwargs.get('label', var))
+                ax.xaxis_date()
+                ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+                ax.set_xlabel('Time [UTC]')
+                ax.set_ylabel('Altitude [m]')
+            else:
+                self.images[i].set_data(values)
+                self.images[i].set_extent(extent)
+            if kwargs.get('norm') is None and 'vmin' not in kwargs and np.any(np.isfinite(values)):
+                self.images[i].set_clim(np.nanmin(values), np.nanmax(values))
+            ax.set_xlim(t0, t0+1)
+        self.axs[0].set_title(fig_title)
+
+
+def get_daily_template():
+    with _TEMPLATE_LOCK:
+        if 'daily' not in _TEMPLATE:
+            _TEMPLATE['daily'] = DailyQuicklookTemplate()
+        return _TEMPLATE['daily']
+
+
+def update_daily_quicklook(fname, cache_dir, fig_dir, time_res=120, alt_res=250, ylim=50000, resolution='high'):
+    """
+    Merge the profiles of the L2A file fname into the cached daily rasters and re-encode the daily quicklook(s)
+    Inputs:
+        fname: path to the L2A file
+        cache_dir: local directory where the daily rasters are kept (one .npz per day)
+        fig_dir: directory (local or s3://) for the daily quicklooks, named L2A_daily_YYYY-MM-DD.png
+        time_res, alt_res: resolution of the daily raster (s, m)
+        ylim: top of the daily raster (m)
+        resolution: one of QUICKLOOK_RESOLUTIONS keys
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    if not os.path.exists(fig_dir) and not fig_dir.startswith('s3://'):
+        os.makedirs(fig_dir)
+
+    with xr.load_dataset(fname, engine='h5netcdf') as ds:
+        ds = mask_flagged(ds)
+        days = np.unique(ds['time'].values.astype('datetime64[D]'))
+        for day in days:
+            day_str = str(day)
+            cache_file = os.path.join(cache_dir, f'daily_raster_{day_str}.npz')
+            # lock the cache file so that concurrent workers do not lose updates
+            with open(cache_file + '.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                raster = DailyRaster.load(cache_file, day, time_res=time_res, alt_res=alt_res, alt_max=ylim)
+                ds_day = ds.isel(time=(ds['time'].values.astype('datetime64[D]') == day))
+                raster.merge(ds_day, source=os.path.basename(fname))
+                raster.save(cache_file)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+            template = get_daily_template()
+            with template.lock:
+                template.render(raster, f'L2A daily {day_str}')
+                with BytesIO() as buffer:
+                    template.fig.savefig(buffer, dpi=QUICKLOOK_RESOLUTIONS[resolution], facecolor='w', format='png')
+                    png = buffer.getvalue()
+
+            fig_name = os.path.join(fig_dir, f'L2A_daily_{day_str}.png')
+            count_bytes(written=len(png))
+            if fig_name.startswith('s3://'):
+                import boto3
+                s3 = boto3.client('s3')
+                bucket_name = fig_name.split('/')[2]
+                key = '/'.join(fig_name.split('/')[3:])
+                with BytesIO(png) as buffer:
+                    s3.upload_fileobj(buffer, bucket_name, key)
+            else:
+                with open(fig_name, 'wb') as f:
+                    f.write(png)
+            logger.info(f'Daily quicklook updated: {fig_name}')
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Add L2A files to the daily quicklooks')
+    parser.add_argument('l2a_files', nargs='+', help='Path(s) to the L2A file(s)')
+    parser.add_argument('--cache_dir', type=str, help='Directory of the cached daily rasters')
+    parser.add_argument('--fig_dir', type=str, help='Path to the directory where daily quicklooks are saved')
+    parser.add_argument('--ylim', type=int, default=50000, help='Y-axis limit for the plots')
+    parser.add_argument('--resolution', type=str, default='high', choices=list(QUICKLOOK_RESOLUTIONS))
+    args = parser.parse_args()
+
+    for l2a_file in args.l2a_files:
+        update_daily_quicklook(l2a_file, args.cache_dir, args.fig_dir, ylim=args.ylim, resolution=args.resolution)
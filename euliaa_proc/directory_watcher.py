@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+from euliaa_proc.log import logger
+from euliaa_proc.job_queue import JobQueue
+from euliaa_proc.processed_index import ProcessedIndex
+from euliaa_proc.processing_manager import run_processing_pipeline, preload_worker
+from euliaa_proc.utils.conf_utils import get_conf
+
+
+class DirectoryWatcher(FileSystemEventHandler):
+    """
+    Watches a local directory for new HDF5 files and queues each of them once it is complete.
+
+    A file is considered complete when its size and modification time have not changed for stable_time seconds
+    (checked every check_interval seconds), so that files still being written or copied are not processed.
+    Every created, moved-in, modified or closed file restarts its stability wait.
+    If the queue is full, the file stays pending and is queued again at a later check.
+    """
+
+    def __init__(self, job_queue, config_template, input_file_extension='.h5', stable_time=5., check_interval=1., index=None):
+        self.job_queue = job_queue
+        self.config_template = config_template
+        self.input_file_extension = input_file_extension
+        self.stable_time = stable_time
+        self.check_interval = check_interval
+        self.index = index
+        self.pending = {}
+        self.submitted = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.checker = threading.Thread(target=self._check_pending, daemon=True, name='stability-checker')
+        self.checker.start()
+
+    def track(self, filepath):
+        if not filepath.endswith(self.input_file_extension):
+            return
+        with self._lock:
+            if filepath not in self.pending:
+                logger.info(f'New file {filepath}, waiting for it to be stable')
+            self.pending[filepath] = (None, time.time())
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.track(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.track(event.dest_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.track(event.src_path)
+
+    def on_closed(self, event):
+        if not event.is_directory:
+            self.track(event.src_path)
+
+    def _check_pending(self):
+        while not self._stop.wait(self.check_interval):
+            with self._lock:
+                pending = list(self.pending.items())
+            now = time.time()
+            for filepath, (last_stat, t_change) in pending:
+                try:
+                    stat = os.stat(filepath)
+                except FileNotFoundError:
+                    logger.warning(f'{filepath} disappeared before processing')
+                    with self._lock:
+                        self.pending.pop(filepath, None)
+                    continue
+                file_stat = (stat.st_size, stat.st_mtime)
+                if file_stat != last_stat:
+                    with self._lock:
+                        self.pending[filepath] = (file_stat, now)
+                elif now - t_change >= self.stable_time and self.submit(filepath, file_stat):
+                    with self._lock:
+                        if self.pending.get(filepath, (None,))[0] == file_stat:
+                            del self.pending[filepath]
+
+    def submit(self, filepath, file_stat):
+        """queue a stable file; returns False if it must stay pending (queue full)"""
+        if self.submitted.get(filepath) == file_stat: # e.g. attribute change when the file is read
+            return True
+        etag = f'{file_stat[0]}-{file_stat[1]:.0f}' # a rewritten file is processed again
+        self.submitted[filepath] = file_stat
+        if self.index is not None and not self.index.claim('', filepath, etag):
+            return True
+        if not self.job_queue.submit(filepath, etag, self.config_template):
+            del self.submitted[filepath]
+            if self.index is not None:
+                self.index.mark_failed('', filepath, etag, error='queue full')
+            return False
+        return True
+
+    def scan(self, watch_path):
+        """track the files already in watch_path (e.g. written while the watcher was down)"""
+        for root, _, files in os.walk(watch_path):
+            for fname in sorted(files):
+                self.track(os.path.join(root, fname))
+
+    def stop(self):
+        self._stop.set()
+        self.checker.join()
+
+
+def process_local_file(filepath, etag, config_template):
+    """Run the processing pipeline for a local file (in a worker process), keeping its status in the processed-files index"""
+    config = get_conf(config_template)
+    index = ProcessedIndex(config['processed_index_db']) if config.get('processed_index_db') else None
+    if index is not None:
+        index.mark_running('', filepath, etag)
+    success = run_processing_pipeline(filepath, config_template)
+    if index is not None:
+        if success:
+            index.mark_done('', filepath, etag)
+        else:
+            index.mark_failed('', filepath, etag, error='processing error, see log')
+    return success
+
+
+def start_watcher(watch_path, config_template, polling=False, scan_existing=False):
+    """
+    Watch watch_path (recursively) and process the new files with a pool of workers, until interrupted.
+    The observer uses inotify where available (Linux), other native APIs otherwise; polling=True forces
+    a polling observer, e.g. for network file systems that do not deliver inotify events.
+    Config keys (main config): n_workers, queue_size, queue_put_timeout, max_tasks_per_worker, preload_workers,
+    watch_stable_time (s), processed_index_db
+    """
+    config = get_conf(config_template)
+    initializer = preload_worker if config.get('preload_workers', True) else None
+    job_queue = JobQueue(process_local_file, n_workers=config.get('n_workers', 2), queue_size=config.get('queue_size', 100),
+                         put_timeout=config.get('queue_put_timeout', 1.), max_tasks_per_worker=config.get('max_tasks_per_worker'),
+                         initializer=initializer, initargs=(config_template,))
+    index = None
+    if config.get('processed_index_db'):
+        index = ProcessedIndex(config['processed_index_db'], stale_after=config.get('processed_index_stale_after', 3600))
+
+    watcher = DirectoryWatcher(job_queue, config_template, stable_time=config.get('watch_stable_time', 5.), index=index)
+    observer = PollingObserver() if polling else Observer()
+    observer.schedule(watcher, watch_path, recursive=True)
+    observer.start()
+    logger.info(f'Watching {watch_path} with {type(observer).__name__} and {job_queue.n_workers} workers')
+    if scan_existing:
+        watcher.scan(watch_path)
+
+    try:
+        while observer.is_alive():
+            observer.join(1.)
+    except KeyboardInterrupt:
+        logger.info('Stopping the directory watcher')
+    finally:
+        observer.stop()
+        observer.join()
+        watcher.stop()
+        job_queue.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Process the new HDF5 files of a local directory')
+    parser.add_argument('--watch_dir', type=str, default=None, help='Directory to watch (watch_dir of the main config if not set)')
+    parser.add_argument('--config_main', type=str, help='Main config (as for the processing manager)',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config/config_main.yaml'))
+    parser.add_argument('--polling', action='store_true', help='Poll the directory instead of using inotify')
+    parser.add_argument('--scan_existing', action='store_true', help='Also process the files already in the directory')
+    args = parser.parse_args()
+
+    watch_dir = args.watch_dir or get_conf(args.config_main)['watch_dir']
+    start_watcher(watch_dir, args.config_main, polling=args.polling, scan_existing=args.scan_existing)
@@ -2,64 +2,160 @@ import numpy as np
 import xarray as xr
 from euliaa_proc.utils.data_utils import compute_wind_speed, compute_wind_direction, compute_hor_width
 from euliaa_proc.measurement import Measurement
+from euliaa_proc.instrumentation import instrumented
     
 c = 299792458  # Speed of light in m/s
 lam = 386.0e-9  # Wavelength in meters
 # theta = 30.0  # Angle of off-zenith telescopes in degrees
 
 
+EPROFILE_L2A_VARS = ['u_mie', 'v_mie', 'w_mie', 'u_mie_err', 'v_mie_err', 'w_mie_err']
+EPROFILE_L2A_FLAGS = ['u_mie_flag', 'v_mie_flag', 'w_mie_flag']
+
+
+def get_cumsums(l2a_zen, var_list=EPROFILE_L2A_VARS, flag_list=EPROFILE_L2A_FLAGS):
+    """
+    Cumulative sums along time of the (time, altitude) fields used for EPROFILE, with a leading row of zeros,
+    so that the mean over profiles [i0, i1) is (cumsum[i1]-cumsum[i0])/(count[i1]-count[i0]).
+    NaNs are ignored (as in xarray's mean). For the flags, the number of non-zero flags is accumulated.
+    Accumulations are done in float64.
+    Output: dict var -> (cumsum, cumcount); flag -> cumcount
+    """
+    cumsums = {}
+    for var in var_list:
+        values = l2a_zen[var].transpose('time', ...).values.astype(np.float64)
+        valid = np.isfinite(values)
+        values = np.where(valid, values, 0)
+        zeros = np.zeros((1,)+values.shape[1:])
+        cumsums[var] = (np.concatenate([zeros, np.cumsum(values, axis=0)]),
+                        np.concatenate([zeros, np.cumsum(valid, axis=0)]))
+    for var in flag_list:
+        flagged = (l2a_zen[var].transpose('time', ...).values != 0)
+        cumsums[var] = np.concatenate([np.zeros((1,)+flagged.shape[1:]), np.cumsum(flagged, axis=0)])
+    return cumsums
+
+
+def get_window_indices(time, window=None):
+    """
+    Start (included) and end (excluded) indices of the consecutive averaging windows
+    Inputs:
+        time: array of times (s since 1970-01-01)
+        window: window length (s); windows are aligned on multiples of window. None -> a single window
+    """
+    if window is None:
+        return np.array([0]), np.array([len(time)])
+    time = np.asarray(time)
+    if np.issubdtype(time.dtype, np.datetime64):
+        time = time.astype('datetime64[ns]').astype(np.int64)/1e9
+    window_index = np.floor(time.astype(np.float64)/window)
+    i_bounds = np.flatnonzero(np.diff(window_index)) + 1
+    return np.concatenate([[0], i_bounds]), np.concatenate([i_bounds, [len(time)]])
+
+
+def window_means(cumsums, i_start, i_end, dtypes=None):
+    """
+    means (and flag sums) of the fields over the windows [i_start, i_end), from the cumulative sums
+    dtypes: dict var -> dtype the means are cast back to (dtype of the L2A fields; the accumulation is in float64)
+    """
+    dtypes = dtypes or {}
+    means = {}
+    for var, cumsum in cumsums.items():
+        if isinstance(cumsum, tuple):
+            sums = cumsum[0][i_end] - cumsum[0][i_start]
+            counts = cumsum[1][i_end] - cumsum[1][i_start]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means[var] = np.where(counts > 0, sums/counts, np.nan).astype(dtypes.get(var, np.float64), copy=False)
+        else:
+            means[var] = cumsum[i_end] - cumsum[i_start]
+    return means
+
+
+def window_sums(cumsums, i_start, i_end):
+    """sums and counts of the fields over the windows [i_start, i_end), from the cumulative sums"""
+    sums = {}
+    for var, cumsum in cumsums.items():
+        if isinstance(cumsum, tuple):
+            sums[var] = tuple(cs[i_end] - cs[i_start] for cs in cumsum)
+        else:
+            sums[var] = cumsum[i_end] - cumsum[i_start]
+    return sums
+
+
 class EProfileMeasurement(Measurement):
     """
     Class to handle the conversion of EProfile measurements to DWL eprofile files.
     Inherits from Measurement class.
     """
 
-    def __init__(self, config_eprofile_path, l2a_data, conf_qc_file=None):
+    def __init__(self, config_eprofile_path, l2a_data=None, conf_qc_file=None):
         super().__init__(config_eprofile_path, conf_qc_file=conf_qc_file)
         self.l2a_data = l2a_data
         
     
-    def load_data(self):
+    @instrumented
+    def load_data(self, window=None, cumsums=None):
         """
         Load the L2A data into the measurement object.
+        Inputs:
+            window: averaging window (s); the profiles are averaged over consecutive windows aligned on multiples of window
+                    (one output profile per window). If None, the whole L2A file is averaged into a single profile.
+            cumsums: output of get_cumsums on the zenith L2A data, to share the cumulative sums between several windows
         """
-        
+
         l2a_zen = self.l2a_data.sel(line_of_sight=0).drop_vars("line_of_sight")
-        l2a_final = l2a_zen.isel(time=[-1])
-        l2a = l2a_zen.mean(dim='time').expand_dims('time')
-        l2a['time']= ('time', l2a_final['time'].values)
+        if cumsums is None:
+            cumsums = get_cumsums(l2a_zen)
+        i_start, i_end = get_window_indices(l2a_zen['time'].values, window)
+        l2a = window_means(cumsums, i_start, i_end, dtypes={var: l2a_zen[var].dtype for var in EPROFILE_L2A_VARS})
+
+        self.fill_profiles(l2a,
+                           time=l2a_zen['time'].values[i_end-1], # time of the last profile in the window
+                           time_bnds=np.stack([l2a_zen.time_bnds.values[i_start, 0], l2a_zen.time_bnds.values[i_end-1, 1]], axis=-1),
+                           height=(l2a_zen.altitude_mie-l2a_zen.station_altitude).values,
+                           lat=l2a_zen.station_latitude.values, lon=l2a_zen.station_longitude.values,
+                           zsl=l2a_zen.station_altitude.values, range_integration=l2a_zen.range_integration.values)
+
 
-        self.add_var({'height': (l2a.altitude_mie-l2a_zen.station_altitude).values,
-            'time': l2a['time'].values,
+    def fill_profiles(self, l2a, time, time_bnds, height, lat, lon, zsl, range_integration):
+        """
+        Fill the EPROFILE variables from averaged (time, height) L2A fields
+        Inputs:
+            l2a: dict of the averaged EPROFILE_L2A_VARS, and of the number of flagged profiles for EPROFILE_L2A_FLAGS
+            time, time_bnds: time stamps (s) and bounds of the averaged profiles
+            height: height above the station (m)
+            lat, lon, zsl, range_integration: station coordinates and vertical resolution
+        """
+        self.add_var({'height': height,
+            'time': time,
             'nv': np.array([0, 1])
             })
 
+        half_range = range_integration/2
         self.add_var({'config': ((), ''),
-                'wspeed': (('time', 'height'), compute_wind_speed(l2a.u_mie, l2a.v_mie).values),
-                'qwind' : (('time', 'height'), xr.where(((l2a.u_mie_flag==0) & (l2a.v_mie_flag==0) & (l2a.w_mie_flag==0)), 1, 0).values),
-                'qu' : (('time', 'height'), xr.where(l2a.u_mie_flag==0, 1, 0).values),
-                'qv' : (('time', 'height'), xr.where(l2a.v_mie_flag==0, 1, 0).values),
-                'qw' : (('time', 'height'), xr.where(l2a.w_mie_flag==0, 1, 0).values),
-                'errwspeed' : (('time', 'height'), np.sqrt(l2a.u_mie_err**2 + l2a.v_mie_err**2).values),
-                'u' : (('time', 'height'), l2a.u_mie.values),
-                'erru' : (('time', 'height'), l2a.u_mie_err.values),
-                'v' : (('time', 'height'), l2a.v_mie.values),
-                'errv' : (('time', 'height'), l2a.v_mie_err.values),
-                'w' : (('time', 'height'), l2a.w_mie.values),
-                'errw' : (('time', 'height'), l2a.w_mie_err.values),
-                'wdir' : (('time', 'height'), compute_wind_direction(l2a.u_mie, l2a.v_mie).values),
-                'errwdir' : (('time', 'height'), np.zeros_like(l2a['w_mie'].values)),
-                'r2' : (('time', 'height'), np.zeros_like(l2a['w_mie'].values)),
-                'nvrad' : (('time', 'height'), np.zeros_like(l2a['w_mie'].values)),
-                'cn' : (('time', 'height'), np.zeros_like(l2a['w_mie'].values)),
-                'lat' : ((), l2a_zen.station_latitude.values),
-                'lon' : ((), l2a_zen.station_longitude.values),
-                'zsl' : ((), l2a_zen.station_altitude.values),
-                'time_bnds' : (('time', 'nv'), l2a.time_bnds.values),
-                # l2a_dwl['time_bnds' : (('time', 'nv'), np.array([[l2a_zen.time[0].values, l2a_zen.time[-1].values]]))
-                'height_bnds' : (('height', 'nv'), np.array([[h-l2a_zen.range_integration/2, h+l2a_zen.range_integration/2] for h in self.data.height.values])),
+                'wspeed': (('time', 'height'), compute_wind_speed(l2a['u_mie'], l2a['v_mie'])),
+                'qwind' : (('time', 'height'), np.where(((l2a['u_mie_flag']==0) & (l2a['v_mie_flag']==0) & (l2a['w_mie_flag']==0)), 1, 0)),
+                'qu' : (('time', 'height'), np.where(l2a['u_mie_flag']==0, 1, 0)),
+                'qv' : (('time', 'height'), np.where(l2a['v_mie_flag']==0, 1, 0)),
+                'qw' : (('time', 'height'), np.where(l2a['w_mie_flag']==0, 1, 0)),
+                'errwspeed' : (('time', 'height'), np.sqrt(l2a['u_mie_err']**2 + l2a['v_mie_err']**2)),
+                'u' : (('time', 'height'), l2a['u_mie']),
+                'erru' : (('time', 'height'), l2a['u_mie_err']),
+                'v' : (('time', 'height'), l2a['v_mie']),
+                'errv' : (('time', 'height'), l2a['v_mie_err']),
+                'w' : (('time', 'height'), l2a['w_mie']),
+                'errw' : (('time', 'height'), l2a['w_mie_err']),
+                'wdir' : (('time', 'height'), compute_wind_direction(l2a['u_mie'], l2a['v_mie'])),
+                'errwdir' : (('time', 'height'), np.zeros_like(l2a['w_mie'])),
+                'r2' : (('time', 'height'), np.zeros_like(l2a['w_mie'])),
+                'nvrad' : (('time', 'height'), np.zeros_like(l2a['w_mie'])),
+                'cn' : (('time', 'height'), np.zeros_like(l2a['w_mie'])),
+                'lat' : ((), lat),
+                'lon' : ((), lon),
+                'zsl' : ((), zsl),
+                'time_bnds' : (('time', 'nv'), time_bnds),
+                'height_bnds' : (('height', 'nv'), np.stack([self.data.height.values-half_range, self.data.height.values+half_range], axis=-1)),
                 'frequency' : ((), c/lam),
-                'vert_res' : ((), l2a_zen.range_integration.values),
+                'vert_res' : ((), range_integration),
                 'hor_width' : (('height',), compute_hor_width(self.data.height.values))
         })
 
@@ -0,0 +1,158 @@
+import numpy as np
+import datetime
+import fcntl
+import glob
+import os
+from euliaa_proc.eprofile import EProfileMeasurement, EPROFILE_L2A_VARS, EPROFILE_L2A_FLAGS, get_cumsums, get_window_indices, window_sums
+from euliaa_proc.write_netcdf import Writer
+from euliaa_proc.log import logger
+
+HOUR = 3600
+
+
+class HourlyEProfileAccumulator():
+    """
+    Running accumulator of the EPROFILE fields over clock hours, kept across files in a small persistent state.
+
+    For every hour, the state file eprofile_hour_<YYYYmmdd_HH>.npz of state_dir holds, per (height) gate, the sums
+    and counts of EPROFILE_L2A_VARS, the number of flagged profiles of EPROFILE_L2A_FLAGS, the time bounds and station
+    metadata, and the sources (files) already accumulated. When the data of a file reaches the end of an hour, the hour
+    is closed: the hourly EPROFILE (means over the hour, as the per-file EPROFILE) is written and its state is replaced
+    by a .done marker, without reloading the earlier L2A files.
+    A source already accumulated in an hour is skipped, so that reprocessing a file does not count it twice.
+    Profiles arriving for an hour that was already emitted are ignored (with a warning).
+    """
+
+    def __init__(self, state_dir, config_eprofile, config_qc=None):
+        self.state_dir = state_dir
+        self.config_eprofile = config_eprofile
+        self.config_qc = config_qc
+        os.makedirs(state_dir, exist_ok=True)
+        self.lock_file = os.path.join(state_dir, 'eprofile_hourly.lock')
+
+    def state_file(self, hour_start):
+        hour_str = datetime.datetime.fromtimestamp(hour_start, tz=datetime.timezone.utc).strftime('%Y%m%d_%H')
+        return os.path.join(self.state_dir, f'eprofile_hour_{hour_str}.npz')
+
+    def is_done(self, hour_start):
+        return os.path.exists(self.state_file(hour_start).replace('.npz', '.done'))
+
+    def load_state(self, hour_start):
+        fname = self.state_file(hour_start)
+        if not os.path.exists(fname):
+            return None
+        with np.load(fname) as state:
+            return {key: state[key] for key in state.files}
+
+    def save_state(self, hour_start, state):
+        fname = self.state_file(hour_start)
+        np.savez(fname + '.tmp.npz', **state)
+        os.replace(fname + '.tmp.npz', fname)
+
+    def add(self, l2a_data, source=None):
+        """
+        Add the zenith profiles of an L2A dataset (time in s since 1970-01-01) to the hourly states
+        source: name of the file of the data (default: its time range), skipped in the hours where it was already added
+        Output: list of the start times (s) of the hours now complete
+        """
+        l2a_zen = l2a_data.sel(line_of_sight=0).drop_vars("line_of_sight")
+        time = l2a_zen['time'].values.astype(np.float64)
+        time_bnds = l2a_zen['time_bnds'].values.astype(np.float64)
+        if np.issubdtype(l2a_zen['time'].dtype, np.datetime64): # decoded times -> s since 1970-01-01
+            time = l2a_zen['time'].values.astype('datetime64[ns]').astype(np.int64)/1e9
+            time_bnds = l2a_zen['time_bnds'].values.astype('datetime64[ns]').astype(np.int64)/1e9
+        if source is None:
+            source = f'{time[0]:.3f}-{time[-1]:.3f}'
+        cumsums = get_cumsums(l2a_zen)
+        i_start, i_end = get_window_indices(time, HOUR)
+        sums = window_sums(cumsums, i_start, i_end)
+        height = (l2a_zen.altitude_mie-l2a_zen.station_altitude).values
+
+        for iw, (i0, i1) in enumerate(zip(i_start, i_end)):
+            hour_start = np.floor(time[i0]/HOUR)*HOUR
+            if self.is_done(hour_start):
+                logger.warning(f'Hour {self.state_file(hour_start)} already emitted, ignoring {i1-i0} late profiles')
+                continue
+            state = self.load_state(hour_start)
+            if state is not None and source in state['sources']:
+                logger.warning(f'{source} already accumulated in hour {self.state_file(hour_start)}, skipping it')
+                continue
+            if state is not None and state['height'].shape != height.shape:
+                logger.warning(f'Altitude grid changed within hour {self.state_file(hour_start)}, restarting the accumulation')
+                state = None
+            if state is None:
+                state = {'hour_start': hour_start, 'height': height,
+                         'lat': l2a_zen.station_latitude.values, 'lon': l2a_zen.station_longitude.values,
+                         'zsl': l2a_zen.station_altitude.values, 'range_integration': l2a_zen.range_integration.values,
+                         'time_last': time[i1-1], 'time_bnds_start': time_bnds[i0, 0], 'time_bnds_end': time_bnds[i1-1, 1],
+                         'sources': np.array([source])}
+                for var in EPROFILE_L2A_VARS:
+                    state[f'{var}_sum'], state[f'{var}_count'] = (s[iw] for s in sums[var])
+                    state[f'{var}_dtype'] = np.array(str(l2a_zen[var].dtype))
+                for var in EPROFILE_L2A_FLAGS:
+                    state[f'{var}_nflagged'] = sums[var][iw]
+            else:
+                for var in EPROFILE_L2A_VARS:
+                    state[f'{var}_sum'] = state[f'{var}_sum'] + sums[var][0][iw]
+                    state[f'{var}_count'] = state[f'{var}_count'] + sums[var][1][iw]
+                for var in EPROFILE_L2A_FLAGS:
+                    state[f'{var}_nflagged'] = state[f'{var}_nflagged'] + sums[var][iw]
+                state['time_last'] = max(state['time_last'], time[i1-1])
+                state['time_bnds_start'] = min(state['time_bnds_start'], time_bnds[i0, 0])
+                state['time_bnds_end'] = max(state['time_bnds_end'], time_bnds[i1-1, 1])
+                state['sources'] = np.append(state['sources'], source)
+            self.save_state(hour_start, state)
+
+        # an hour is closed once the data has reached its end
+        return [hour_start for hour_start in self.open_hours() if hour_start + HOUR <= time_bnds[-1, 1]]
+
+    def open_hours(self):
+        """start times (s) of the hours with a pending state"""
+        hours = []
+        for fname in sorted(glob.glob(os.path.join(self.state_dir, 'eprofile_hour_*.npz'))):
+            if fname.endswith('.tmp.npz'):
+                continue
+            hour_str = os.path.basename(fname).replace('eprofile_hour_', '').replace('.npz', '')
+            hours.append(datetime.datetime.strptime(hour_str, '%Y%m%d_%H').replace(tzinfo=datetime.timezone.utc).timestamp())
+        return hours
+
+    def emit(self, hour_start, output_dir):
+        """write the hourly EPROFILE of hour_start to output_dir (created if needed) and mark the hour as done"""
+        state = self.load_state(hour_start)
+        if state is None:
+            logger.warning(f'No state for hour {self.state_file(hour_start)}, nothing to emit')
+            return None
+        l2a = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for var in EPROFILE_L2A_VARS: # same means as window_means, cast back to the L2A dtype
+                count = state[f'{var}_count']
+                l2a[var] = np.where(count > 0, state[f'{var}_sum']/count, np.nan)[None, :].astype(str(state[f'{var}_dtype']))
+        for var in EPROFILE_L2A_FLAGS:
+            l2a[var] = state[f'{var}_nflagged'][None, :]
+
+        eprofile_meas = EProfileMeasurement(self.config_eprofile, conf_qc_file=self.config_qc)
+        eprofile_meas.fill_profiles(l2a, time=np.array([state['time_last']]),
+                                    time_bnds=np.array([[state['time_bnds_start'], state['time_bnds_end']]]),
+                                    height=state['height'], lat=state['lat'], lon=state['lon'], zsl=state['zsl'],
+                                    range_integration=state['range_integration'])
+        eprofile_meas.set_var_attrs_from_conf()
+        eprofile_meas.set_global_attrs_from_conf()
+        if self.config_qc:
+            eprofile_meas.subsel_altitude_range()
+
+        hour_str = datetime.datetime.fromtimestamp(hour_start, tz=datetime.timezone.utc).strftime('%Y%m%d_%H%M')
+        os.makedirs(output_dir, exist_ok=True)
+        output_file = os.path.join(output_dir, f'L1_EU1WL_{hour_str}.nc')
+        Writer(eprofile_meas, output_file=output_file).write_nc()
+        os.replace(self.state_file(hour_start), self.state_file(hour_start).replace('.npz', '.done'))
+        logger.info(f'Wrote hourly DWL-EPROFILE file successfully to {output_file}')
+        return output_file
+
+    def add_and_emit(self, l2a_data, output_dir, source=None):
+        """add an L2A dataset and write the hourly EPROFILE files of the hours it closes (locked against concurrent workers)"""
+        with open(self.lock_file, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return [self.emit(hour_start, output_dir) for hour_start in self.add(l2a_data, source=source)]
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,171 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from euliaa_proc.log import logger
+
+_ACTIVE = threading.local()
+
+
+def get_rss_mb():
+    """current resident set size of the process (MB)"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/1e6
+
+
+def get_peak_rss_mb():
+    """peak resident set size of the process since its start (MB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3
+
+
+class StageRecorder():
+    """
+    Collects the timing and memory records of the pipeline stages run for one file.
+
+    Each record is also logged as a JSON line {"event": "stage", ...}: wall and CPU time (s), change of the RSS
+    and of the peak RSS over the stage (MB), and the sizes and bytes of the dataset after the stage.
+    Stages called from another stage (e.g. Measurement stages within Runner.run_processing) have a parent.
+    The bytes of the input file and of the products are counted with count_bytes().
+
+    With trace_memory=True (tracemalloc must be tracing, see benchmarks/profile_memory.py), the records also have the
+    change and the peak of the memory traced by tracemalloc over the stage (MB) and its n_top_allocators top allocation
+    sites (memory retained at the end of the stage, attributed to the innermost frame in euliaa_proc).
+    """
+
+    def __init__(self, file_name, trace_memory=False, n_top_allocators=5):
+        self.file_name = file_name
+        self.records = []
+        self.stack = []
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.t_start = time.perf_counter()
+        self.trace_memory = trace_memory and tracemalloc.is_tracing()
+        self.n_top_allocators = n_top_allocators
+        self._traced = [] # per open stage: [traced memory at the start, peak of its sub-stages, snapshot at the start]
+
+    def record(self, stage, **fields):
+        record = {'event': 'stage', 'file': self.file_name, 'stage': stage,
+                  'parent': self.stack[-1] if self.stack else None, **fields}
+        self.records.append(record)
+        logger.info(json.dumps(record))
+
+    def trace_start(self):
+        if not self.trace_memory:
+            return
+        if self._traced: # the peak of the parent so far, before it is reset for this stage
+            self._traced[-1][1] = max(self._traced[-1][1], tracemalloc.get_traced_memory()[1])
+        snapshot = tracemalloc.take_snapshot() if self.n_top_allocators else None # the snapshot itself is traced
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        self._traced.append([current, current, snapshot])
+
+    def trace_stop(self):
+        """tracemalloc fields of the stage that ends (empty without trace_memory)"""
+        if not self.trace_memory:
+            return {}
+        start, peak_sub_stages, snapshot = self._traced.pop()
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, peak_sub_stages)
+        if self._traced:
+            self._traced[-1][1] = max(self._traced[-1][1], peak)
+        fields = {'traced_delta_mb': round((current-start)/1e6, 2), 'traced_peak_delta_mb': round((peak-start)/1e6, 2)}
+        if snapshot is not None:
+            fields['top_allocators'] = self.top_allocators(snapshot)
+        return fields
+
+    def top_allocators(self, snapshot):
+        """[(file:line, MB)] of the largest memory changes since snapshot, by innermost euliaa_proc frame"""
+        sizes = {}
+        for stat in tracemalloc.take_snapshot().compare_to(snapshot, 'traceback'):
+            if stat.traceback[-1].filename == tracemalloc.__file__: # the snapshots
+                continue
+            frame = next((f for f in reversed(stat.traceback) if 'euliaa_proc' in f.filename and not f.filename.endswith('instrumentation.py')),
+                         stat.traceback[-1])
+            site = f'{os.path.relpath(frame.filename)}:{frame.lineno}'
+            sizes[site] = sizes.get(site, 0) + stat.size_diff
+        top = sorted(sizes.items(), key=lambda item: -abs(item[1]))[:self.n_top_allocators]
+        return [(site, round(size/1e6, 2)) for site, size in top]
+
+    def summary(self):
+        """per-file summary: total wall time, per-stage totals of the top-level stages and wall time of the sub-stages"""
+        stages = {}
+        sub_stages = {}
+        for record in self.records:
+            if record['parent'] is not None:
+                sub_stages[record['stage']] = round(sub_stages.get(record['stage'], 0.) + record['wall_time'], 4)
+                continue
+            stage = stages.setdefault(record['stage'], {'wall_time': 0., 'cpu_time': 0., 'peak_rss_delta_mb': 0.})
+            for key in stage:
+                stage[key] = round(stage[key] + record[key], 4)
+        return {'event': 'file_summary', 'file': self.file_name, 'wall_time': round(time.perf_counter()-self.t_start, 4),
+                'peak_rss_mb': round(get_peak_rss_mb(), 2), 'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+                'stages': stages, 'sub_stages': sub_stages}
+
+    def log_summary(self):
+        summary = self.summary()
+        logger.info(json.dumps(summary))
+        for stage, fields in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall_time']):
+            logger.info(f"{stage:<28} {fields['wall_time']:8.2f} s wall {fields['cpu_time']:8.2f} s CPU "
+                        f"{fields['peak_rss_delta_mb']:+8.1f} MB peak RSS")
+        logger.info(f"{'total':<28} {summary['wall_time']:8.2f} s wall, peak RSS {summary['peak_rss_mb']:.0f} MB")
+        return summary
+
+
+def get_active_recorder():
+    return getattr(_ACTIVE, 'recorder', None)
+
+
+def set_active_recorder(recorder):
+    """set the recorder of the current thread, to which the instrumented stages report (None: no recording)"""
+    _ACTIVE.recorder = recorder
+
+
+def count_bytes(read=0, written=0):
+    """add the bytes of an input file read or of a product written to the active recorder (if any)"""
+    recorder = get_active_recorder()
+    if recorder is not None:
+        recorder.bytes_read += read
+        recorder.bytes_written += written
+
+
+def _get_dataset(obj):
+    """dataset of a Measurement (data) or of a Runner (meas.data), None if not available"""
+    data = getattr(obj, 'data', None)
+    if data is None and getattr(obj, 'meas', None) is not None:
+        data = getattr(obj.meas, 'data', None)
+    return data if hasattr(data, 'sizes') and hasattr(data, 'nbytes') else None
+
+
+def instrumented(method):
+    """
+    Decorator of the pipeline stages (methods of Runner and Measurement): records the stage in the active recorder,
+    the one of the Runner (attribute recorder) or the one set for the current thread. No-op without recorder.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        recorder = getattr(self, 'recorder', None) or get_active_recorder()
+        if recorder is None:
+            return method(self, *args, **kwargs)
+        stage = f'{type(self).__name__}.{method.__name__}'
+        previous_recorder = get_active_recorder()
+        set_active_recorder(recorder)
+        recorder.trace_start()
+        rss0, peak0 = get_rss_mb(), get_peak_rss_mb()
+        t0, cpu0 = time.perf_counter(), time.process_time()
+        recorder.stack.append(stage)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            recorder.stack.pop()
+            wall_time, cpu_time = time.perf_counter()-t0, time.process_time()-cpu0
+            traced = recorder.trace_stop()
+            data = _get_dataset(self)
+            recorder.record(stage, wall_time=round(wall_time, 4), cpu_time=round(cpu_time, 4),
+                            rss_delta_mb=round(get_rss_mb()-rss0, 2), peak_rss_delta_mb=round(get_peak_rss_mb()-peak0, 2),
+                            sizes=dict(data.sizes) if data is not None else None,
+                            nbytes=int(data.nbytes) if data is not None else None, **traced)
+            set_active_recorder(previous_recorder)
+    return wrapper
@@ -0,0 +1,99 @@
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from euliaa_proc.log import logger, get_worker_log_queue, init_worker_logging
+
+
+class JobQueue():
+    """
+    Bounded job queue in front of a pool of worker processes.
+
+    submit() only enqueues the job and returns immediately, so that the notification endpoint does not wait
+    for the processing. When the queue is full, submit() waits at most put_timeout seconds and then returns False:
+    the caller can answer with an error status so that the notification is delivered again later (backpressure).
+    n_workers dispatcher threads take the jobs from the queue and run them in the process pool, so that at most
+    n_workers jobs are running and at most queue_size are waiting.
+    initializer(*initargs) runs once in every worker process at its start, e.g. to preload modules.
+    The log records of the workers are written by the log handlers of this process.
+    on_result(args, result) is called in this process after each job, with result None if the job raised.
+    """
+
+    def __init__(self, job_func, n_workers=2, queue_size=100, put_timeout=1., max_tasks_per_worker=None, initializer=None, initargs=(),
+                 on_result=None):
+        self.job_func = job_func
+        self.on_result = on_result
+        self.n_workers = n_workers
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        # spawn: the parent runs server threads, forking it is not safe
+        pool_kwargs = {}
+        if max_tasks_per_worker is not None:
+            if sys.version_info >= (3, 11): # max_tasks_per_child is new in Python 3.11
+                pool_kwargs['max_tasks_per_child'] = max_tasks_per_worker
+            else:
+                logger.warning('max_tasks_per_worker needs Python 3.11 or later, the workers will not be recycled')
+        self.executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=init_worker_logging, initargs=(get_worker_log_queue(), initializer, initargs),
+                                            **pool_kwargs)
+        self.n_running = 0
+        self.n_done = 0
+        self.n_failed = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.dispatchers = [threading.Thread(target=self._dispatch, daemon=True, name=f'job-dispatcher-{i}') for i in range(n_workers)]
+        for dispatcher in self.dispatchers:
+            dispatcher.start()
+
+    def submit(self, *args):
+        """enqueue a job (args of job_func); returns False if the queue stayed full for put_timeout seconds"""
+        try:
+            self.queue.put((time.time(), args), timeout=self.put_timeout)
+        except queue.Full:
+            logger.warning(f'Job queue full ({self.queue.maxsize} jobs waiting), rejecting job {args}')
+            return False
+        logger.info(f'Job queued: {args} ({self.queue.qsize()} waiting)')
+        return True
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            try:
+                t_queued, args = self.queue.get(timeout=1.)
+            except queue.Empty:
+                continue
+            with self._lock:
+                self.n_running += 1
+            result = None
+            try:
+                result = self.executor.submit(self.job_func, *args).result()
+                with self._lock:
+                    self.n_done += 1
+                logger.info(f'Job done: {args} ({time.time()-t_queued:.1f} s after queuing)')
+            except Exception as e:
+                with self._lock:
+                    self.n_failed += 1
+                logger.error(f'Job failed: {args}: {e}')
+            finally:
+                if self.on_result is not None:
+                    try:
+                        self.on_result(args, result)
+                    except Exception as e:
+                        logger.error(f'Error in the result callback of job {args}: {e}')
+                with self._lock:
+                    self.n_running -= 1
+                self.queue.task_done()
+
+    def status(self):
+        with self._lock:
+            return {'waiting': self.queue.qsize(), 'running': self.n_running, 'done': self.n_done, 'failed': self.n_failed}
+
+    def shutdown(self, wait=True):
+        """stop taking jobs; if wait, let the queued jobs finish first"""
+        if wait:
+            self.queue.join()
+        self._stop.set()
+        for dispatcher in self.dispatchers:
+            dispatcher.join()
+        self.executor.shutdown(wait=wait)
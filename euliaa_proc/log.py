@@ -1,14 +1,16 @@
-import datetime as dt
 import os
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import threading
+import multiprocessing
 from sys import stdout
 from euliaa_proc.utils.conf_utils import get_conf
 from euliaa_proc.utils.file_utils import abs_file_path
 
-# get logs config
+LOGGER_NAME = 'euliaa_proc_runner'
+# logs config, read when the first record is logged (importing this module has no side effect on files)
 log_config_file = abs_file_path('euliaa_proc/config/config_log.yaml')
-conf = get_conf(log_config_file)
 
 
 # Colors for the logs console output (Options see color_log-package)
@@ -20,77 +22,172 @@ LOG_COLORS = {
     'CRITICAL': 'red,bg_white',
     }
 
-try:
-    import colorlog
-
-    formatter = colorlog.ColoredFormatter(
-        '%(log_color)s%(asctime)-8s %(levelname)-8s %(message)s',
-        "%Y-%m-%d %H:%M:%S",
-        # datefmt=None,
-        reset=True,
-        log_colors=LOG_COLORS,
-        secondary_log_colors={},
-        style='%',
-    )
-    get_logger = colorlog.getLogger
-
-except Exception as e:  # noqa E841
-    print(e)
-    get_logger = logging.getLogger
-    formatter = logging.Formatter(
-        ' '
-        '%(levelname)-8s %(message)s',
-        '%Y-%m-%d %H:%M:%S',
-    )
-
-# capture warnings in the logger
-logging.captureWarnings(True)
+
+def get_formatter():
+    try:
+        import colorlog
+
+        formatter = colorlog.ColoredFormatter(
+            '%(log_color)s%(asctime)-8s %(levelname)-8s %(message)s',
+            "%Y-%m-%d %H:%M:%S",
+            # datefmt=None,
+            reset=True,
+            log_colors=LOG_COLORS,
+            secondary_log_colors={},
+            style='%',
+        )
+
+    except Exception as e:  # noqa E841
+        print(e)
+        formatter = logging.Formatter(
+            ' '
+            '%(levelname)-8s %(message)s',
+            '%Y-%m-%d %H:%M:%S',
+        )
+    return formatter
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    The logger only puts the records in a queue (non-blocking); a background thread (QueueListener)
+    formats them and writes them to the console and file handlers, so that the processing never waits for log I/O.
+    The config is read and the listener started when the first record is emitted.
+    The records of the worker processes are sent to this process through worker_queue (see get_worker_log_queue),
+    so that a log file is only written by one process.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.listener = None
+        self.worker_queue = None
+        self.worker_listener = None
+        self.output_handlers = []
+        self._setup_lock = threading.Lock()
+
+    def emit(self, record):
+        if self.listener is None:
+            self.setup()
+        super().emit(record)
+
+    def setup(self):
+        with self._setup_lock:
+            if self.listener is not None:
+                return
+            conf = get_conf(log_config_file)
+            formatter = get_formatter()
+
+            # logging to stdout
+            console_handler = logging.StreamHandler(stdout)
+            console_handler.setFormatter(formatter)
+            console_handler.setLevel(conf['loglevel_stdout'])
+            self.output_handlers.append(console_handler)
+
+            # logging to file
+            if conf['write_logfile']:
+                log_filename = conf['logfile_basename'] + conf['logfile_ext']
+                log_file = str(os.path.join(abs_file_path(conf['logfile_path']), log_filename))
+                os.makedirs(os.path.dirname(log_file), exist_ok=True)
+                file_handler = get_file_handler(log_file, conf)
+                file_handler.setFormatter(formatter)
+                file_handler.setLevel(conf['loglevel_file'])
+                self.output_handlers.append(file_handler)
+
+            listener = QueueListener(self.queue, *self.output_handlers, respect_handler_level=True)
+            listener.start()
+            self.listener = listener
+
+    def get_worker_queue(self):
+        """multiprocessing queue of the records of the worker processes, written by a second listener to the same handlers"""
+        if self.listener is None:
+            self.setup()
+        with self._setup_lock:
+            if self.worker_queue is None:
+                self.worker_queue = multiprocessing.get_context('spawn').Queue()
+                self.worker_listener = QueueListener(self.worker_queue, *self.output_handlers, respect_handler_level=True)
+                self.worker_listener.start()
+            return self.worker_queue
+
+    def stop(self):
+        """write the records still in the queues and close the output handlers"""
+        if self.worker_listener is not None:
+            self.worker_listener.stop()
+            self.worker_listener = None
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        for h in self.output_handlers:
+            h.close()
+        self.output_handlers = []
+
+
+def get_file_handler(log_file, conf):
+    """
+    File handler with the rotation of the logs config:
+        rotation: 'size' -> new file when the log reaches rotation_max_bytes
+                  'time' -> new file every rotation_interval rotation_when (e.g. 1 midnight = daily at 00:00 UTC)
+        rotation_backup_count: number of rotated files kept
+    """
+    rotation = conf.get('rotation', 'time')
+    backup_count = conf.get('rotation_backup_count', 30)
+    if rotation == 'size':
+        return RotatingFileHandler(log_file, maxBytes=int(float(conf.get('rotation_max_bytes', 50e6))), backupCount=backup_count, delay=True)
+    elif rotation == 'time':
+        handler = TimedRotatingFileHandler(log_file, when=conf.get('rotation_when', 'midnight'), interval=conf.get('rotation_interval', 1),
+                                           backupCount=backup_count, utc=True, delay=True)
+        handler.suffix = "%Y-%m-%d_%H-%M-%S"
+        return handler
+    raise ValueError(f"Invalid log rotation {rotation}, must be 'size' or 'time'")
+
 
 # general settings
-logger = get_logger(conf['logger_name'])
+logger = logging.getLogger(LOGGER_NAME)
 logger.setLevel(logging.DEBUG)  # set to the lowest possible level, using handler-specific levels for output
+queue_handler = LazyQueueHandler(queue.SimpleQueue())
+logger.addHandler(queue_handler)
 
-# logging to stdout
-console_handler = logging.StreamHandler(stdout)
-console_formatter = formatter
-console_handler.setFormatter(console_formatter)
-console_handler.setLevel(conf['loglevel_stdout'])
-logger.addHandler(console_handler)
-
-# add the built-in warnings logger to the console handler
-# this will capture all warnings and send them to the console
+# add the built-in warnings logger to the queue, to capture all warnings and send them to the console and file
 warnings_logger = logging.getLogger("py.warnings")
-warnings_logger.addHandler(console_handler)
+warnings_logger.addHandler(queue_handler)
 warnings_logger.setLevel(logging.WARNING)
 
+logging.captureWarnings(True)  # capture warnings in the logger
+
+forward_queue = None # in a worker process, queue of the parent process the records are sent to
 
-# logging to file
-if conf['write_logfile']:
-    act_time_str = dt.datetime.now(tz=dt.timezone(dt.timedelta(0))).strftime(conf['logfile_timestamp_format'])
-    log_filename = conf['logfile_basename'] + conf['logfile_ext']
-    # log_filename = conf['logfile_basename'] + format(act_time_str) + conf['logfile_ext']
-    log_file = str(os.path.join(abs_file_path(conf['logfile_path']), log_filename))
 
-    file_handler = TimedRotatingFileHandler(log_file, when='M', interval=1, utc=True)
-    file_handler.suffix = "%Y-%m-%d_%H-%M-%S"
-    file_handler_formatter = formatter
-    file_handler.setFormatter(file_handler_formatter)
-    file_handler.setLevel(conf['loglevel_file'])
-    logger.addHandler(file_handler)
+def get_worker_log_queue():
+    """
+    Queue to pass to the worker processes (e.g. in the initargs of a pool, see init_worker_logging), through which
+    their records are written by the log handlers of this process (or of its parent, in a worker)
+    """
+    if forward_queue is not None:
+        return forward_queue
+    return queue_handler.get_worker_queue()
 
-    # add the built-in warnings logger to the file handler
-    # this will capture all warnings and send them to the file
-    warnings_logger = logging.getLogger("py.warnings")
-    warnings_logger.addHandler(file_handler)
-    warnings_logger.setLevel(logging.WARNING)
 
+def forward_logs(log_queue):
+    """in a worker process: send the log records to log_queue (get_worker_log_queue of the parent) instead of writing them"""
+    global forward_queue
+    forward_queue = log_queue
+    queue_handler.stop()
+    forward_handler = QueueHandler(log_queue)
+    for lg in [logger, warnings_logger]:
+        lg.removeHandler(queue_handler)
+        lg.addHandler(forward_handler)
+
+
+def init_worker_logging(log_queue, initializer=None, initargs=()):
+    """pool initializer: forward the log records of the worker to log_queue, then run initializer(*initargs)"""
+    forward_logs(log_queue)
+    if initializer is not None:
+        initializer(*initargs)
 
-logging.captureWarnings(True)  # capture warnings in the logger
 
-# Ensure clean shutdown
+# Ensure clean shutdown: the listener writes the records still in the queue before the handlers are closed
 import atexit
 @atexit.register
 def cleanup_logger():
+    queue_handler.stop()
     for h in logger.handlers[:]:
         h.close()
-        logger.removeHandler(h)
\ No newline at end of file
+        logger.removeHandler(h)
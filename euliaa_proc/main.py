@@ -1,65 +1,86 @@
-from euliaa_proc.measurement import H5Reader
-from euliaa_proc.write_netcdf import Writer
 from euliaa_proc.log import logger
-from euliaa_proc.nc2bufr import write_bufr
-from euliaa_proc.quicklooks import plot_quicklooks
+from euliaa_proc.instrumentation import instrumented, StageRecorder
+import os
+
+# The modules of the stages (xarray/netCDF4, eccodes, matplotlib) are imported by the stages that use them,
+# so that importing the Runner stays cheap (see benchmarks/bench_import_time.py)
 
 class Runner:
 
     def __init__(self, args):
         self.args = args
         self.meas = None
+        self.products = []
+        # timing and memory records of the stages, logged as JSON (disabled with instrumentation: false)
+        self.recorder = StageRecorder(os.path.basename(args.hdf5_file)) if getattr(args, 'instrumentation', True) else None
 
+    @instrumented
     def run_processing(self):
+        from euliaa_proc.measurement import H5Reader
+        from euliaa_proc.stage_graph import get_requested_products, plan_stages, run_stage
         logger.info(f'Reading measurement from hdf5 file {self.args.hdf5_file}')
-        self.meas = H5Reader(self.args.config, self.args.hdf5_file,conf_qc_file=self.args.config_qc)
+        altitude_window = {scat: getattr(self.args, f'altitude_window_{scat}', None) for scat in ['mie', 'ray']}
+        self.meas = H5Reader(self.args.config, self.args.hdf5_file,conf_qc_file=self.args.config_qc, precision=getattr(self.args, 'precision', None) or 'float64',
+                             altitude_window=altitude_window, noise_full_profile=getattr(self.args, 'noise_full_profile', None) is not False)
+        # only the stages (and variables) needed by the requested products are run, see stage_graph
+        self.products = get_requested_products(self.args)
+        plan_products = self.products + (['l2a'] if getattr(self.args, 'batch_merge_l2a', False) else []) # the batch L2A needs everything
+        load_vars, stages = plan_stages(plan_products, self.meas.qc_conf)
+        if load_vars is not None:
+            logger.info(f'Products {self.products}: running stages {[stage for stage, _ in stages]}')
+        if getattr(self.args, 'stage_cache_dir', None):
+            from euliaa_proc.stage_cache import StageCache, run_stages_cached
+            cache = StageCache(self.args.stage_cache_dir, max_size_mb=getattr(self.args, 'stage_cache_max_size_mb', None) or 2000)
+            run_stages_cached(self.meas, load_vars, stages, cache)
+            return
         self.meas.read_hdf5_file()
         self.meas.load_attrs()
-        self.meas.load_data()
-        self.meas.add_lat_lon()
-        self.meas.add_time_bnds()
-
-        logger.info('Computing noise level and SNR')
-        self.meas.add_noise_and_snr()
-
-        logger.info('Adding basic quality flag')
-        self.meas.add_quality_flag()
-
-        logger.info('Cloud detection (for now, only transparent clouds)')
-        self.meas.add_clouds()
-
-        logger.info('Completing quality flag')
-        self.meas.add_flag_below_cloud_top()
-        self.meas.add_flag_missing_data()
+        self.meas.load_data(var_list=load_vars)
+        for stage, variables in stages:
+            run_stage(self.meas, stage, variables)
 
 
+    @instrumented
     def make_quicklooks(self):
         """
         Plot quicklooks for L2A and L2B
         """
+        if 'quicklook' not in self.products:
+            return
+        from euliaa_proc.quicklooks import plot_quicklooks
         logger.info('Plotting quicklooks')
         fig_title = self.args.output_nc_l2A.split('/')[-1].replace('.nc', '')
-        plot_quicklooks(self.args.output_nc_l2A, self.args.fig_dir, fig_title)
+        resolution = getattr(self.args, 'quicklook_resolution', None) or 'high'
+        plot_quicklooks(self.args.output_nc_l2A, self.args.fig_dir, fig_title, resolution=resolution)
+        if getattr(self.args, 'daily_cache_dir', None):
+            from euliaa_proc.daily_quicklooks import update_daily_quicklook
+            daily_fig_dir = getattr(self.args, 'daily_fig_dir', None) or self.args.fig_dir
+            update_daily_quicklook(self.args.output_nc_l2A, self.args.daily_cache_dir, daily_fig_dir, resolution=resolution)
         # plot_quicklooks(self.args.output_nc_l2B, self.args.fig_dir, self.args.fig_name, self.args.ylim)
         logger.info('Plotted quicklooks successfully\n')
 
 
+    @instrumented
     def write_l2a_and_l2b(self):
         """
         Write L2A and L2B netCDF files
         """
-        logger.info(f'Writing L2A {self.args.output_nc_l2A}')
-        nc_writer = Writer(self.meas,output_file=self.args.output_nc_l2A)#,conf_file=self.args.config)
-        nc_writer.write_nc()
-        logger.info('Wrote L2A successfully\n')
-
-        logger.info(f'Writing L2B {self.args.output_nc_l2B}')
-        self.meas.subsel_stripped_profile()
+        from euliaa_proc.write_netcdf import Writer
+        if 'l2a' in self.products:
+            logger.info(f'Writing L2A {self.args.output_nc_l2A}')
+            nc_writer = Writer(self.meas,output_file=self.args.output_nc_l2A)#,conf_file=self.args.config)
+            nc_writer.write_nc()
+            logger.info('Wrote L2A successfully\n')
+
+        self.meas.subsel_stripped_profile() # also the profile encoded in BUFR
         self.meas.set_invalid_to_nan() # set invalid data to NaN for L2B
-        nc_writer_l2b = Writer(self.meas,output_file=self.args.output_nc_l2B)#,conf_file=self.args.config)
-        nc_writer_l2b.write_nc()
-        logger.info('Wrote L2B successfully\n')
+        if 'l2b' in self.products:
+            logger.info(f'Writing L2B {self.args.output_nc_l2B}')
+            nc_writer_l2b = Writer(self.meas,output_file=self.args.output_nc_l2B)#,conf_file=self.args.config)
+            nc_writer_l2b.write_nc()
+            logger.info('Wrote L2B successfully\n')
 
+    @instrumented
     def encode_bufr(self):
         """
         Encode BUFR file (if specified)
@@ -70,36 +91,80 @@ class Runner:
         elif not (self.args.output_bufr[-5:] == '.bufr'):
             logger.warning(f'BUFR file name must end with ".bufr", skipping encoding')
             return
+        bufr_types = [bufr_type for bufr_type in self.args.bufr_types if f'bufr_{bufr_type}' in self.products]
+        if not bufr_types:
+            return
+        from euliaa_proc.nc2bufr import write_bufr
+        if 'line_of_sight' in self.meas.data.dims: # profile not stripped yet (write_l2a_and_l2b not run)
+            self.meas.subsel_stripped_profile()
         self.meas.set_invalid_to_nan() # set invalid data to NaN for BUFR  TO DO refine this, change quality flags for BUFR
-        for bufr_type in self.args.bufr_types:
+        for bufr_type in bufr_types:
             bufr_name=self.args.output_bufr.replace('.bufr', f'_{bufr_type}.bufr')
             logger.info(f'Writing BUFR message {bufr_name}')
             write_bufr(self.meas.data, bufr_name, bufr_type=bufr_type)
         logger.info('Wrote BUFR message successfully\n')
 
 
+    @instrumented
     def write_dwl_eprofile(self):
         """
         Write DWL eprofile file
         """
-        from euliaa_proc.eprofile import EProfileMeasurement
+        from euliaa_proc.eprofile import EProfileMeasurement, get_cumsums
+        from euliaa_proc.write_netcdf import Writer
+        if 'eprofile' not in self.products:
+            return
         logger.info('Writing DWL eprofile file')
         if not hasattr(self.args, 'config_eprofile') or self.args.config_eprofile is None:
-            logger.error('No config_eprofile specified, exiting')
-            exit()
-
-        eprofile_meas = EProfileMeasurement(self.args.config_eprofile, self.meas.data, conf_qc_file=self.args.config_qc)
-        eprofile_meas.load_data()
-        eprofile_meas.set_var_attrs_from_conf()
-        eprofile_meas.set_global_attrs_from_conf()
-        eprofile_meas.subsel_altitude_range()
-        eprofile_writer = Writer(eprofile_meas, output_file=self.args.output_nc_eprofile)
-        eprofile_writer.write_nc()
-        logger.info(f'Wrote DWL-EPROFILE file successfully to {self.args.output_nc_eprofile}\n')
+            raise ValueError('No config_eprofile specified, cannot write the DWL eprofile file')
+
+        # averaging windows (min); None -> one profile averaged over the whole file
+        windows = getattr(self.args, 'eprofile_windows', None) or [None]
+        l2a_zen = self.meas.data.sel(line_of_sight=0).drop_vars("line_of_sight")
+        cumsums = get_cumsums(l2a_zen) # shared by all windows
+        for window in windows:
+            if window is None:
+                output_file = self.args.output_nc_eprofile
+            else:
+                output_file = self.args.output_nc_eprofile.replace('.nc', f'_{window}min.nc')
+            eprofile_meas = EProfileMeasurement(self.args.config_eprofile, self.meas.data, conf_qc_file=self.args.config_qc)
+            eprofile_meas.load_data(window=None if window is None else window*60, cumsums=cumsums)
+            eprofile_meas.set_var_attrs_from_conf()
+            eprofile_meas.set_global_attrs_from_conf()
+            eprofile_meas.subsel_altitude_range()
+            eprofile_writer = Writer(eprofile_meas, output_file=output_file)
+            eprofile_writer.write_nc()
+            logger.info(f'Wrote DWL-EPROFILE file successfully to {output_file}\n')
+
+    @instrumented
+    def write_hourly_eprofile(self):
+        """
+        Add the current file to the hourly DWL eprofile accumulator, and write the hourly files of the hours it closes
+        """
+        from euliaa_proc.eprofile_hourly import HourlyEProfileAccumulator
+        if not getattr(self.args, 'eprofile_state_dir', None):
+            logger.warning('No eprofile_state_dir specified, skipping hourly DWL eprofile')
+            return
+        if 'eprofile_hourly' not in self.products:
+            return
+        logger.info('Accumulating hourly DWL eprofile')
+        accumulator = HourlyEProfileAccumulator(self.args.eprofile_state_dir, self.args.config_eprofile, config_qc=self.args.config_qc)
+        # own directory: the hourly files would otherwise overwrite the per-file EPROFILE of the files starting at HH:00
+        output_dir = os.path.join(os.path.dirname(self.args.output_nc_eprofile), 'hourly')
+        output_files = accumulator.add_and_emit(self.meas.data, output_dir, source=os.path.basename(self.args.hdf5_file))
+        for output_file in output_files:
+            logger.info(f'Hour closed, wrote {output_file}')
+
+    def log_stage_summary(self):
+        """
+        Log the per-file summary of the stage timings (JSON record and table); returns the summary dict
+        """
+        if self.recorder is None:
+            return None
+        return self.recorder.log_summary()
 
 
 if __name__=='__main__':
-    import os
     cwd = os.getcwd()
 
     import argparse
@@ -111,15 +176,30 @@ if __name__=='__main__':
     parser.add_argument('--output_nc_l2A', type=str, help='Path to the output netCDF file for L2A', default=os.path.join(cwd,'data/TestNC_L2A.nc'))
     parser.add_argument('--output_nc_l2B', type=str, help='Path to the output netCDF file for L2B', default=os.path.join(cwd,'data/TestNC_L2B.nc'))
     parser.add_argument('--output_nc_eprofile', type=str, help='Path to the output netCDF file for DWL eprofile', default=os.path.join(cwd,'data/TestNC_EPROFILE.nc'))
+    parser.add_argument('--eprofile_windows', nargs='+', type=int, help='Averaging windows (min) of the DWL eprofile files, e.g. 5 10 30 (whole file averaged if not set)', default=None)
+    parser.add_argument('--eprofile_state_dir', type=str, help='Directory of the hourly DWL eprofile accumulator state (hourly files disabled if not set)', default=None)
     parser.add_argument('--bufr_types', nargs='+', default=['wind', 'temperature'])
     parser.add_argument('--output_bufr', type=str, help='Path to the output BUFR file', default=os.path.join(cwd,'data/Test_BUFR.bufr'))
     parser.add_argument('--fig_dir', type=str, help='Path to the directory where quicklooks are saved', default=os.path.join(cwd,'quicklooks/'))
     parser.add_argument('--fig_prefix', type=str, help='Prefix of the quicklook figure', default='quicklook')
+    parser.add_argument('--daily_cache_dir', type=str, help='Directory of the cached daily quicklook rasters (daily quicklooks disabled if not set)', default=None)
+    parser.add_argument('--daily_fig_dir', type=str, help='Path to the directory where daily quicklooks are saved (fig_dir if not set)', default=None)
+    parser.add_argument('--products', nargs='+', help='Products to make, among l2a, l2b, eprofile, bufr and quicklook (all if not set)', default=None)
+    parser.add_argument('--stage_cache_dir', type=str, help='Directory of the cached intermediate states (no cache if not set)', default=None)
+    parser.add_argument('--stage_cache_max_size_mb', type=int, help='Size of the cache of intermediate states (MB), least recently used states evicted first', default=2000)
+    parser.add_argument('--precision', type=str, help='Processing precision (float64, or float32 where the output type allows)', default='float64', choices=['float64', 'float32'])
+    parser.add_argument('--altitude_window_mie', nargs=2, type=float, help='Altitude window (m) of the Mie gates read and processed, e.g. 0 60000 (all gates if not set)', default=None)
+    parser.add_argument('--altitude_window_ray', nargs=2, type=float, help='Altitude window (m) of the Rayleigh gates read and processed (all gates if not set)', default=None)
+    parser.add_argument('--noise_on_window', dest='noise_full_profile', action='store_false', help='Estimate the noise levels on the altitude window only, not on the full profiles')
+    parser.add_argument('--quicklook_resolution', type=str, help='Resolution tier of the quicklooks (low, medium, high)', default='high')
     args = parser.parse_args()
 
     runner = Runner(args)
     runner.run_processing()
     runner.write_dwl_eprofile()
+    if args.eprofile_state_dir:
+        runner.write_hourly_eprofile()
     runner.write_l2a_and_l2b()
     runner.encode_bufr()
     runner.make_quicklooks()
+    runner.log_stage_summary()
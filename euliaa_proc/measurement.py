@@ -1,15 +1,24 @@
 import xarray as xr
 from netCDF4 import Dataset
-import pandas as pd
 import numpy as np
+import os
 from euliaa_proc.utils.conf_utils import get_conf, correct_dim_scalar_fields
 from euliaa_proc.utils.data_utils import check_var_in_ds, compute_lat_lon, flag_var, get_noise_vect_from_da
 from euliaa_proc.utils.cloud_detection import in_house_cloud_detection
 from euliaa_proc.log import logger
+from euliaa_proc.instrumentation import instrumented, count_bytes
+
+FLAG_DTYPE_FLOAT32 = np.int8 # flags are sums of 1, 2, 4, 8 or -9
+CLOUD_FLOAT_VARS = ['below_cloud_top', 'above_cloud_base', 'cloud_base_height', 'cloud_top_height'] # processing precision
 
 class Measurement():
-    def __init__(self, conf_file, data=None, conf_qc_file=None):
+    def __init__(self, conf_file, data=None, conf_qc_file=None, precision='float64'):
+        """
+        precision: 'float64', or 'float32' to keep the processing in float32 wherever the output type of config_nc
+        is float32 (ingest, noise/SNR, lat/lon, cloud fields) and the flags in int8
+        """
         self.conf = get_conf(conf_file)
+        self.precision = precision
         if data:
             self.data = data
         else:
@@ -26,6 +35,57 @@ class Measurement():
             raise ValueError('No dimensions defined in the config file')
         correct_dim_scalar_fields(self.conf['variables'])
 
+    @property
+    def float32(self):
+        return self.precision == 'float32'
+
+    def precision_dtype(self, var, dtype):
+        """float32 for the float variables in float32 mode, unless their output type is float64"""
+        if not self.float32 or not np.issubdtype(dtype, np.floating):
+            return dtype
+        if self.conf['variables'].get(var, {}).get('type') == 'float64':
+            return dtype
+        return np.dtype(np.float32)
+
+    def to_precision(self, var, values):
+        """float values of var in float32 in float32 mode, unless its output type is float64"""
+        return values.astype(self.precision_dtype(var, values.dtype), copy=False)
+
+    def cast_to_precision(self, var_list=None):
+        """cast the float variables of var_list (default: all) to the processing precision"""
+        if not self.float32:
+            return
+        for var in var_list if var_list is not None else list(self.data.data_vars):
+            if var in self.data and np.issubdtype(self.data[var].dtype, np.floating):
+                self.data[var] = self.data[var].copy(data=self.to_precision(var, self.data[var].values))
+
+
+    def allocate_var(self, var, dims=None, dtype=np.float64, fill_value=np.nan):
+        """
+        Preallocate var in the dataset, with the sizes of its dimensions in the dataset, for a stage to fill in place
+        (fill_var) instead of assigning or merging a new array
+        dims: default the dims of var in config_nc; if var is in config_nc with the same set of dims, they are
+        ordered as in config_nc
+        fill_value: initial value, None to leave the buffer uninitialised (every element then has to be filled)
+        Output: the buffer (numpy array) of var
+        """
+        config_dims = self.conf['variables'].get(var, {}).get('dim')
+        if dims is None or (config_dims is not None and set(dims) == set(config_dims)):
+            dims = config_dims
+        shape = tuple(self.data.sizes[dim] for dim in dims)
+        buffer = np.empty(shape, dtype=dtype) if fill_value is None else np.full(shape, fill_value, dtype=dtype)
+        self.data[var] = (dims, buffer)
+        return buffer
+
+    def fill_var(self, var, values, **index):
+        """
+        Write values (DataArray, or array in the dim order of var) into the buffer of var, in place
+        index: position along some dims of var (e.g. line_of_sight=0), the other dims being written entirely
+        """
+        variable = self.data.variables[var]
+        if isinstance(values, xr.DataArray):
+            values = values.transpose(*[dim for dim in variable.dims if dim not in index]).values
+        variable.values[tuple(index.get(dim, slice(None)) for dim in variable.dims)] = values
 
     def add_var(self, var_dict):
         """if additional var should be added separately
@@ -35,10 +95,13 @@ class Measurement():
         for var_name, var_data in var_dict.items():
             self.data[var_name] = var_data
 
+    @instrumented
     def add_lat_lon(self):
         self.data['latitude_mie'], self.data['longitude_mie'] = compute_lat_lon(lat_station=self.data.station_latitude, lon_station=self.data.station_longitude, altitude=self.data.altitude_mie)
         self.data['latitude_ray'], self.data['longitude_ray'] = compute_lat_lon(lat_station=self.data.station_latitude, lon_station=self.data.station_longitude, altitude=self.data.altitude_ray)
+        self.cast_to_precision(['latitude_mie', 'longitude_mie', 'latitude_ray', 'longitude_ray'])
 
+    @instrumented
     def add_time_bnds(self):
         if not ('time_bnds' in self.data.keys()) and ('time_integration' in self.data.keys()):
             time_start = self.data['time'].values - self.data['time_integration'].values/2
@@ -46,12 +109,18 @@ class Measurement():
             self.data['time_bnds'] = (('time', 'bnds'), np.stack([time_start, time_stop], axis=-1))
             logger.info('Time bounds added to the dataset')
 
-    def add_noise_and_snr(self):
-        for scat in ['mie', 'ray']:
+    @instrumented
+    def add_noise_and_snr(self, scat_list=['mie', 'ray']):
+        for scat in scat_list:
             if f'signal_{scat}' in self.data.keys():
-                self.data[f'noise_level_{scat}'] = get_noise_vect_from_da(self.data[f'signal_{scat}'])
-                self.data[f'snr_{scat}'] = self.data[f'signal_{scat}']/self.data[f'noise_level_{scat}']
-
+                signal = self.data[f'signal_{scat}']
+                if f'noise_level_{scat}' not in self.data: # else estimated at the ingest on the full profiles (see H5Reader)
+                    self.data[f'noise_level_{scat}'] = get_noise_vect_from_da(signal, dtype=np.float32 if self.float32 else None)
+                noise = self.data[f'noise_level_{scat}']
+                snr = self.allocate_var(f'snr_{scat}', dims=signal.dims, dtype=np.result_type(signal.dtype, noise.dtype), fill_value=None)
+                np.divide(signal.values, noise.broadcast_like(signal).transpose(*signal.dims).values, out=snr)
+
+    @instrumented
     def add_clouds(self,**kwargs):
         """
         Add cloud detection to the dataset
@@ -65,17 +134,20 @@ class Measurement():
         if 'backscatter_coef_flag' in self.data.keys():
             data_zen = data_zen.where(self.data.backscatter_coef_flag==0, np.nan)
         # self.data['bscnew'] = data_zen
-        if 'line_of_sight' in self.data.keys() and len(self.data.line_of_sight)>1:
-            cloud_ds_list = []
-            for i, los in enumerate(self.data.line_of_sight.values):
-                cloud_ds_list.append(in_house_cloud_detection(data_zen[:,:,i],**kwargs))
-            self.data = xr.merge([self.data, xr.concat(cloud_ds_list, dim='line_of_sight')])
-        else:
-            cloud_ds = in_house_cloud_detection(data_zen,**kwargs)
-            self.data = xr.merge([self.data, cloud_ds])
+        # the cloud fields are preallocated at the first line of sight and filled in place (no merge of the dataset)
+        los_index = range(len(self.data.line_of_sight)) if 'line_of_sight' in data_zen.dims else [None]
+        for i in los_index:
+            cloud_ds = in_house_cloud_detection(data_zen if i is None else data_zen.isel(line_of_sight=i), **kwargs)
+            index = {} if i is None else {'line_of_sight': i}
+            for var, values in cloud_ds.data_vars.items():
+                if not i:
+                    dtype = self.precision_dtype(var, values.dtype) if var in CLOUD_FLOAT_VARS else values.dtype
+                    self.allocate_var(var, dims=values.dims + tuple(index), dtype=dtype, fill_value=None)
+                self.fill_var(var, values, **index)
 
 
 
+    @instrumented
     def add_quality_flag(self, var_list = ['u_mie', 'v_mie', 'w_mie', 'temperature_int', 'backscatter_coef']):
         """
         Add quality flag to the variables in var_list
@@ -87,9 +159,13 @@ class Measurement():
         0 = no flag
         -9 = missing data
         """
+        flag_dtype = FLAG_DTYPE_FLOAT32 if self.float32 else None
         for var in var_list:
             scat = 'mie' if any('_mie' in d for d in self.data[var].dims) else 'ray'
-            flag_invalid = flag_var(self.data, var, var_min_thres=self.qc_conf['THRES_MIN'][var], var_max_thres=self.qc_conf['THRES_MAX'][var]) # -> flag = 1
+            dims = self.data[var].dims
+            flag_invalid = flag_var(self.data, var, var_min_thres=self.qc_conf['THRES_MIN'][var], var_max_thres=self.qc_conf['THRES_MAX'][var], dtype=flag_dtype) # -> flag = 1
+            flag = self.allocate_var(f'{var}_flag', dims=dims, dtype=flag_invalid.dtype, fill_value=0) # filled in place, one flag at a time
+            flag += flag_invalid.transpose(*dims).values
             if not ('line_of_sight' in self.data[var].dims):
                 if 'line_of_sight' in self.conf['variables'][var]['attributes']:
                     snr_los = self.conf['variables'][var]['attributes']['line_of_sight']
@@ -99,11 +175,11 @@ class Measurement():
                     snr_los = None
             else:
                 snr_los = 'all'
-            flag_snr = flag_var(self.data, var, snr_key=f'snr_{scat}',snr_thres=self.qc_conf['SNR_THRES'][var], snr_los=snr_los) # -> flag = 2
-            flag_err = flag_var(self.data, var, err_key=f'{var}_err', var_err_thres=self.qc_conf['ERR_THRES'][var])  # -> flag = 4
-            self.data[f'{var}_flag'] = flag_err + flag_snr + flag_invalid
+            flag += flag_var(self.data, var, snr_key=f'snr_{scat}',snr_thres=self.qc_conf['SNR_THRES'][var], snr_los=snr_los, dtype=flag_dtype).transpose(*dims).values # -> flag = 2
+            flag += flag_var(self.data, var, err_key=f'{var}_err', var_err_thres=self.qc_conf['ERR_THRES'][var], dtype=flag_dtype).transpose(*dims).values  # -> flag = 4
 
 
+    @instrumented
     def add_flag_below_cloud_top(self, var_list = ['temperature_int']):
         """
         Add cloud flag to the variables in var_list
@@ -113,15 +189,17 @@ class Measurement():
         if not ('below_cloud_top' in self.data.keys()):
             logger.warning('No cloud top data available, skipping cloud flag')
             return
-        cloud_flag = xr.where(self.data['below_cloud_top'] > 0, 8, 0)
         for var in var_list:
-            self.data[f'{var}_flag'] += cloud_flag
+            flag = self.data.variables[f'{var}_flag']
+            flag.values[self.data['below_cloud_top'].transpose(*flag.dims).values > 0] += 8
         return
 
+    @instrumented
     def add_flag_missing_data(self):
         for var in self.data.data_vars.keys():
             if f'{var}_flag' in self.data.keys():
-                self.data[f'{var}_flag'] = self.data[f'{var}_flag'].where(~xr.ufuncs.isnan(self.data[var]), -9) # flag = -9 if NaN
+                flag = self.data.variables[f'{var}_flag']
+                flag.values[np.isnan(self.data[var].transpose(*flag.dims).values)] = -9 # flag = -9 if NaN
 
 
     def add_quality_flag_old(self):
@@ -141,6 +219,7 @@ class Measurement():
             for var in ['u_mie', 'v_mie', 'w_mie', 'temperature_int', 'backscatter_coef']:
                 self.data[var] = self.data[var].where(self.data[var+'_flag']<1, np.nan)
 
+    @instrumented
     def set_invalid_to_nan(self):
         """
         Set the variables to NaN if the flag is > 0
@@ -151,6 +230,7 @@ class Measurement():
             self.data[var] = self.data[var].where(self.data[var+'_flag']==0, np.nan)
 
 
+    @instrumented
     def subsel_stripped_profile(self, los=0):
         """
         Subset the data to keep only a profile in one field of view and the altitude range + variable list specified in the qc config
@@ -159,9 +239,10 @@ class Measurement():
         self.data = self.data.sel(line_of_sight=los)
         self.data = self.data.sel(altitude_mie=slice(0,self.qc_conf['MAX_ALTITUDE']))
         self.data = self.data.isel(time=0)
-        self.data = self.data[self.qc_conf['VARS_TO_KEEP']]
+        self.data = self.data[[var for var in self.qc_conf['VARS_TO_KEEP'] if var in self.data]] # all of them unless the L2B was not requested
 
 
+    @instrumented
     def set_var_attrs_from_conf(self):
         """
         Set the attributes of the variables in the dataset from the config file
@@ -175,6 +256,7 @@ class Measurement():
                     var_attrs[key] = self.conf['variables'][var][key]
             self.data[var].attrs.update(var_attrs)
 
+    @instrumented
     def set_global_attrs_from_conf(self):
         """
         Set the global attributes of the dataset from the config file
@@ -184,11 +266,21 @@ class Measurement():
 
 class H5Reader(Measurement):
 
-    def __init__(self, conf_file, h5_data_file,**kwargs):
+    def __init__(self, conf_file, h5_data_file, altitude_window=None, noise_full_profile=True, **kwargs):
+        """
+        altitude_window: {'mie': [min, max], 'ray': [min, max]} (m), only the gates of each grid within its window are read
+        and processed (None, missing grid or bound: no limit)
+        noise_full_profile: with an altitude window, the noise levels are estimated at the ingest on the full signal
+        profiles, as without window (the noise estimation needs the noise-only gates); False: on the window only
+        """
         super().__init__(conf_file,**kwargs)
         self.data_file = h5_data_file
+        self.altitude_window = {scat: window for scat, window in (altitude_window or {}).items() if window}
+        self.noise_full_profile = noise_full_profile
+        self.gate_slices = {}
 
 
+    @instrumented
     def read_hdf5_file(self, load_units=False):
         """load hdf5 produced by IAP routine
         Inputs:
@@ -200,6 +292,7 @@ class H5Reader(Measurement):
         """
         print(f'Loading hdf5 file {self.data_file}')
         nc = Dataset(self.data_file, diskless=True, persist=False)
+        count_bytes(read=os.path.getsize(self.data_file))
 
         # nc2 = Dataset(self.data_file.replace('3.h5','2.h5'), diskless=True, persist=False) # For now I had to hardcode this because of an error in the first file - to be removed
         nc2 = nc #Dataset('/home/bia/Data/IAP/BankExport2.h5', diskless=True, persist=False)
@@ -210,6 +303,7 @@ class H5Reader(Measurement):
             self.units_rec = xr.open_dataset(xr.backends.NetCDF4DataStore(nc.groups.get('units').groups.get('rec')))
 
 
+    @instrumented
     def load_attrs(self):
         """prepare list of attributes; checks whether value should be fetched in hdf5"""
         ds_attrs = self.conf['attributes'].copy()
@@ -227,10 +321,44 @@ class H5Reader(Measurement):
         self.data.attrs = ds_attrs
 
 
-    def load_data(self):
-        """load the data from the hdf5 file or config"""
-
+    def get_gate_slices(self):
+        """slices of the gates of each altitude dimension within the altitude window, from the altitudes of the hdf5 file"""
+        self.gate_slices = {}
+        for scat, window in self.altitude_window.items():
+            specs = self.conf['variables'][f'altitude_{scat}']['original_hdf5']
+            hdf5_ds = self.rec if specs['hdf5_group'] == 'rec' else self.glo
+            altitude = hdf5_ds[specs['hdf5_var_name']].values
+            alt_min = -np.inf if window[0] is None else window[0]
+            alt_max = np.inf if window[1] is None else window[1]
+            gates = np.flatnonzero((altitude >= alt_min) & (altitude <= alt_max))
+            if not len(gates):
+                raise ValueError(f'No {scat} gate within the altitude window {window}')
+            self.gate_slices[f'altitude_{scat}'] = slice(gates[0], gates[-1] + 1)
+            logger.info(f'Altitude window {window}: {len(gates)} of {len(altitude)} {scat} gates read')
+
+    def read_hdf5_var(self, hdf5_ds, hdf5_var, dims, window=True):
+        """values of hdf5_var, whose dimensions are dims in config_nc; only the gates of the altitude window if window"""
+        index = tuple(self.gate_slices.get(dim, slice(None)) for dim in dims)
+        if not window or hdf5_ds[hdf5_var].ndim != len(dims) or not any(dim in self.gate_slices for dim in dims):
+            return hdf5_ds[hdf5_var].data
+        return hdf5_ds[hdf5_var][index].data # only the window is read from the file
+
+    def load_noise_level_full_profile(self, var, values, dims):
+        """noise level of the signal var from its full profiles (values), before the altitude window is applied"""
+        scat = var.split('_')[-1]
+        self.data[f'noise_level_{scat}'] = get_noise_vect_from_da(xr.DataArray(values, dims=dims), dtype=np.float32 if self.float32 else None)
+        return values[tuple(self.gate_slices.get(dim, slice(None)) for dim in dims)].copy() # the full profiles are not kept
+
+    @instrumented
+    def load_data(self, var_list=None):
+        """
+        load the data from the hdf5 file or config (only the variables of var_list if given, see stage_graph),
+        on the gates of the altitude window
+        """
+        self.get_gate_slices()
         for var, specs in self.conf['variables'].items():
+            if var_list is not None and var not in var_list:
+                continue
             if var in ['latitude_mie', 'latitude_ray', 'longitude_mie', 'longitude_ray']:
                 logger.info('lat/lon computed at the end')
                 continue
@@ -252,12 +380,18 @@ class H5Reader(Measurement):
             if not check_var_in_ds(hdf5_ds, hdf5_var):
                 logger.warning(f'{var}: No corresponding variable in original hdf5 file')
                 continue
+            # signal read on all gates if its noise level is estimated on the full profiles
+            full_noise = self.noise_full_profile and var in ['signal_mie', 'signal_ray'] and any(dim in self.gate_slices for dim in specs['dim'])
             if type(hdf5_var)==list:
-                self.data[var] = (specs['dim'], np.stack([hdf5_ds[var_los].data for var_los in hdf5_var],axis=-1))
+                values = np.stack([self.to_precision(var, self.read_hdf5_var(hdf5_ds, var_los, specs['dim'][:-1], window=not full_noise))
+                                   for var_los in hdf5_var],axis=-1)
             elif hdf5_ds[hdf5_var].ndim == 0 and len(specs['dim'])>0:
-                self.data[var] = (specs['dim'], np.full(tuple([len(self.data[d]) for d in specs['dim']]), hdf5_ds[hdf5_var].data))
+                values = np.full(tuple([len(self.data[d]) for d in specs['dim']]), hdf5_ds[hdf5_var].data)
             else:
-                self.data[var] = (specs['dim'],  hdf5_ds[hdf5_var].data)
+                values = self.to_precision(var, self.read_hdf5_var(hdf5_ds, hdf5_var, specs['dim'], window=not full_noise))
+            if full_noise:
+                values = self.load_noise_level_full_profile(var, values, specs['dim'])
+            self.data[var] = (specs['dim'], values)
 
 
 
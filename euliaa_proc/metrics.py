@@ -0,0 +1,120 @@
+import threading
+import time
+import datetime
+
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]
+
+
+class Histogram():
+    """cumulative histogram in the Prometheus sense (counts of observations <= each bucket bound)"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0]*len(self.buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class PipelineMetrics():
+    """
+    Metrics of the processing service, updated in the server process from the results of the worker jobs,
+    and rendered in the Prometheus text format (exposition format 0.0.4) by render().
+
+    The end-to-end latency goes from the S3 event time of a notification (or its reception if the event has no time)
+    to the end of the job that processed the file, i.e. after all its products are uploaded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.n_notifications = 0
+        self.n_processed = 0
+        self.n_failed = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.stage_latency = {}
+        self.end_to_end_latency = Histogram()
+        self.event_times = {}
+
+    def notification_received(self, file_id, event_time=None):
+        """file_id: (bucket, key, etag); event_time: ISO 8601 time of the S3 event (eventTime field)"""
+        t_event = time.time()
+        if event_time:
+            try:
+                t_event = datetime.datetime.fromisoformat(event_time.replace('Z', '+00:00')).timestamp()
+            except ValueError:
+                pass
+        with self._lock:
+            self.n_notifications += 1
+            self.event_times[tuple(file_id)] = t_event
+
+    def forget(self, file_id):
+        """drop a notification that was not queued (rejected)"""
+        with self._lock:
+            self.event_times.pop(tuple(file_id), None)
+
+    def file_done(self, file_id, success, summary=None):
+        """record the result of a file; summary: per-file stage summary of the Runner (see instrumentation)"""
+        with self._lock:
+            t_event = self.event_times.pop(tuple(file_id), None)
+            if not success:
+                self.n_failed += 1
+                return
+            self.n_processed += 1
+            if t_event is not None:
+                self.end_to_end_latency.observe(time.time() - t_event)
+            if summary is None:
+                return
+            self.bytes_read += summary.get('bytes_read', 0)
+            self.bytes_written += summary.get('bytes_written', 0)
+            stages = {stage: fields['wall_time'] for stage, fields in summary['stages'].items()}
+            stages.update(summary.get('sub_stages', {}))
+            for stage, wall_time in stages.items():
+                self.stage_latency.setdefault(stage, Histogram()).observe(wall_time)
+
+    def render(self, queue_status=None, n_pending=0):
+        """
+        Prometheus text exposition of the metrics
+        queue_status: JobQueue.status() (waiting, running, done, failed jobs); n_pending: notifications waiting in the batcher
+        """
+        lines = []
+
+        def add_metric(name, metric_type, help_str, samples):
+            lines.append(f'# HELP {name} {help_str}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for suffix, labels, value in samples:
+                label_str = '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}' if labels else ''
+                lines.append(f'{name}{suffix}{label_str} {value}')
+
+        def histogram_samples(histogram, labels):
+            samples = [('_bucket', {**labels, 'le': str(bound)}, count) for bound, count in zip(histogram.buckets, histogram.counts)]
+            samples.append(('_bucket', {**labels, 'le': '+Inf'}, histogram.count))
+            samples.append(('_sum', labels, round(histogram.sum, 6)))
+            samples.append(('_count', labels, histogram.count))
+            return samples
+
+        with self._lock:
+            add_metric('euliaa_notifications_total', 'counter', 'Notifications of new HDF5 files received',
+                       [('', {}, self.n_notifications)])
+            add_metric('euliaa_files_processed_total', 'counter', 'Files processed successfully', [('', {}, self.n_processed)])
+            add_metric('euliaa_files_failed_total', 'counter', 'Files whose processing failed', [('', {}, self.n_failed)])
+            add_metric('euliaa_bytes_read_total', 'counter', 'Bytes of input files read', [('', {}, self.bytes_read)])
+            add_metric('euliaa_bytes_written_total', 'counter', 'Bytes of products written (netCDF, BUFR, quicklooks)',
+                       [('', {}, self.bytes_written)])
+            if queue_status is not None:
+                add_metric('euliaa_queue_depth', 'gauge', 'Jobs waiting for a worker', [('', {}, queue_status['waiting'])])
+                add_metric('euliaa_jobs_running', 'gauge', 'Jobs being processed', [('', {}, queue_status['running'])])
+            add_metric('euliaa_notifications_pending', 'gauge', 'Notifications waiting to be batched', [('', {}, n_pending)])
+            samples = []
+            for stage in sorted(self.stage_latency):
+                samples += histogram_samples(self.stage_latency[stage], {'stage': stage})
+            add_metric('euliaa_stage_duration_seconds', 'histogram', 'Wall time of the pipeline stages per file', samples)
+            add_metric('euliaa_end_to_end_latency_seconds', 'histogram', 'Time from the S3 event to the end of the processing of the file',
+                       histogram_samples(self.end_to_end_latency, {}))
+        return '\n'.join(lines) + '\n'
@@ -2,6 +2,7 @@ import xarray as xr
 import eccodes as ec
 import datetime
 import numpy as np
+from euliaa_proc.instrumentation import count_bytes
 
 
 def bufr_encode_header(ibufr, dst):
@@ -311,6 +312,8 @@ def write_bufr(ds, output_name, bufr_type='wind') :
         import tempfile
         with tempfile.NamedTemporaryFile(suffix=".bufr") as tmpfile:
             ec.codes_write(bid,tmpfile)
+            tmpfile.flush()
+            count_bytes(written=tmpfile.tell())
             tmpfile.seek(0)
             # write to S3 using fsspec
             with fsspec.open(output_name, mode='wb',s3=dict(profile='default')) as outfile:
@@ -319,6 +322,7 @@ def write_bufr(ds, output_name, bufr_type='wind') :
     else:
         with open(output_name, "wb") as fout:
             ec.codes_write(bid,fout)
+            count_bytes(written=fout.tell())
 
 
 
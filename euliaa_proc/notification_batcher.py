@@ -0,0 +1,82 @@
+import threading
+import time
+from euliaa_proc.log import logger
+
+
+class NotificationBatcher():
+    """
+    Collects notifications over a short window and hands them over as one batch.
+
+    The first notification of a batch opens a window of `window` seconds; the batch is flushed at the end of the
+    window, or as soon as it holds max_batch_size notifications (bursts after an upload backlog).
+    flush_func(batch) receives the list of the added items and returns False if it could not take the batch
+    (e.g. job queue full): the batch is then kept and flushed again later. At most max_pending items are kept,
+    add() returns False beyond, so that the caller can reject the notification (backpressure).
+    """
+
+    def __init__(self, flush_func, window=5., max_batch_size=20, max_pending=200, retry_delay=5.):
+        self.flush_func = flush_func
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.pending = []
+        self.t_first = None
+        self._cond = threading.Condition()
+        self._stop = False
+        self.thread = threading.Thread(target=self._run, daemon=True, name='notification-batcher')
+        self.thread.start()
+
+    def add(self, item):
+        """add a notification to the current batch; returns False if too many notifications are pending"""
+        with self._cond:
+            if len(self.pending) >= self.max_pending:
+                logger.warning(f'{len(self.pending)} notifications pending, rejecting {item}')
+                return False
+            self.pending.append(item)
+            if self.t_first is None:
+                self.t_first = time.time()
+            if len(self.pending) >= self.max_batch_size:
+                self._cond.notify()
+        return True
+
+    def _next_batch(self):
+        """wait for a full batch or the end of the window; returns the batch (None when stopping with nothing pending)"""
+        with self._cond:
+            while True:
+                if self.pending and (len(self.pending) >= self.max_batch_size or self._stop
+                                     or time.time() - self.t_first >= self.window):
+                    batch = self.pending[:self.max_batch_size]
+                    del self.pending[:self.max_batch_size]
+                    self.t_first = time.time() if self.pending else None
+                    return batch
+                if self._stop:
+                    return None
+                timeout = self.window - (time.time() - self.t_first) if self.pending else None
+                self._cond.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                accepted = self.flush_func(batch)
+            except Exception as e:
+                logger.error(f'Error flushing batch of {len(batch)} notifications: {e}')
+                accepted = True # the batch is dropped, it would fail again
+            if not accepted:
+                with self._cond:
+                    if self._stop:
+                        logger.error(f'Dropping batch of {len(batch)} notifications at shutdown: {batch}')
+                        continue
+                    self.pending[:0] = batch
+                    self.t_first = time.time() - self.window + self.retry_delay
+                time.sleep(self.retry_delay)
+
+    def shutdown(self):
+        """flush the pending notifications and stop"""
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self.thread.join()
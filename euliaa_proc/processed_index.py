@@ -0,0 +1,128 @@
+import sqlite3
+import time
+import os
+from euliaa_proc.log import logger
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class ProcessedIndex():
+    """
+    SQLite index of the notified files, identified by (bucket, key, etag), with their processing status and timings.
+
+    Notifications are delivered at least once: claim() is called before queuing a file and only returns True
+    for a new file, for a file whose previous processing failed, or for a queued/running entry older than
+    stale_after seconds (e.g. left behind by a crashed worker). Any other notification is a duplicate.
+    The database can be shared by several processes (WAL journal, one short transaction per call).
+    """
+
+    def __init__(self, db_file, stale_after=3600):
+        self.db_file = db_file
+        self.stale_after = stale_after
+        if os.path.dirname(db_file):
+            os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        with self.connect() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('''CREATE TABLE IF NOT EXISTS files (
+                               bucket TEXT, key TEXT, etag TEXT,
+                               status TEXT, n_attempts INTEGER,
+                               t_notified REAL, t_queued REAL, t_started REAL, t_finished REAL, t_updated REAL,
+                               error TEXT,
+                               PRIMARY KEY (bucket, key, etag))''')
+
+    def connect(self):
+        return sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+
+    def claim(self, bucket, key, etag=''):
+        """register a notification; returns True if the file must be (re)processed, False if it is a duplicate"""
+        now = time.time()
+        con = self.connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            row = con.execute('SELECT status, t_updated FROM files WHERE bucket=? AND key=? AND etag=?', (bucket, key, etag)).fetchone()
+            if row is None:
+                con.execute('INSERT INTO files VALUES (?, ?, ?, ?, 1, ?, ?, NULL, NULL, ?, NULL)', (bucket, key, etag, QUEUED, now, now, now))
+                claimed = True
+            elif row[0] == FAILED or (row[0] in [QUEUED, RUNNING] and now - row[1] > self.stale_after):
+                con.execute('''UPDATE files SET status=?, n_attempts=n_attempts+1, t_queued=?, t_started=NULL, t_finished=NULL, t_updated=?, error=NULL
+                               WHERE bucket=? AND key=? AND etag=?''', (QUEUED, now, now, bucket, key, etag))
+                logger.info(f'Retrying {bucket}/{key} (previous status: {row[0]})')
+                claimed = True
+            else:
+                logger.info(f'Duplicate notification for {bucket}/{key} (status: {row[0]}), skipping')
+                claimed = False
+            con.execute('COMMIT')
+        except Exception:
+            con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+        return claimed
+
+    def set_status(self, bucket, key, etag, status, error=None):
+        now = time.time()
+        column = {RUNNING: 't_started', DONE: 't_finished', FAILED: 't_finished', QUEUED: 't_queued'}[status]
+        con = self.connect()
+        try:
+            con.execute(f'UPDATE files SET status=?, {column}=?, t_updated=?, error=? WHERE bucket=? AND key=? AND etag=?',
+                        (status, now, now, error, bucket, key, etag))
+        finally:
+            con.close()
+
+    def mark_running(self, bucket, key, etag=''):
+        self.set_status(bucket, key, etag, RUNNING)
+
+    def mark_done(self, bucket, key, etag=''):
+        self.set_status(bucket, key, etag, DONE)
+
+    def mark_failed(self, bucket, key, etag='', error=None):
+        self.set_status(bucket, key, etag, FAILED, error=error)
+
+    def summary(self, since=None):
+        """
+        Counts per status, backlog and throughput of the files notified after since (s since 1970-01-01, all if None)
+        """
+        since = since or 0.
+        con = self.connect()
+        try:
+            counts = dict(con.execute('SELECT status, COUNT(*) FROM files WHERE t_notified>=? GROUP BY status', (since,)).fetchall())
+            t_first, t_last, n_finished = con.execute('''SELECT MIN(t_finished), MAX(t_finished), COUNT(*) FROM files
+                                                        WHERE status=? AND t_notified>=?''', (DONE, since)).fetchone()
+            durations = [row[0] for row in con.execute('''SELECT t_finished-t_started FROM files
+                                                          WHERE status=? AND t_notified>=? AND t_started IS NOT NULL''', (DONE, since))]
+            latencies = [row[0] for row in con.execute('''SELECT t_finished-t_queued FROM files
+                                                          WHERE status=? AND t_notified>=?''', (DONE, since))]
+            failures = con.execute('''SELECT bucket, key, n_attempts, error FROM files WHERE status=? AND t_notified>=?
+                                      ORDER BY t_finished DESC LIMIT 10''', (FAILED, since)).fetchall()
+        finally:
+            con.close()
+        summary = {'counts': counts,
+                   'backlog': counts.get(QUEUED, 0) + counts.get(RUNNING, 0),
+                   'throughput_per_hour': 3600*(n_finished-1)/(t_last-t_first) if n_finished > 1 and t_last > t_first else None,
+                   'median_processing_time': sorted(durations)[len(durations)//2] if durations else None,
+                   'median_latency': sorted(latencies)[len(latencies)//2] if latencies else None,
+                   'last_failures': failures}
+        return summary
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the status of the processed-files index')
+    parser.add_argument('--db', type=str, help='Path to the SQLite index', default='/tmp/euliaa_processed_index.sqlite')
+    parser.add_argument('--hours', type=float, default=None, help='Only files notified in the last HOURS hours')
+    args = parser.parse_args()
+
+    index = ProcessedIndex(args.db)
+    since = time.time() - args.hours*3600 if args.hours else None
+    summary = index.summary(since=since)
+    print(f"Files per status: {summary['counts']}")
+    print(f"Backlog (queued + running): {summary['backlog']}")
+    if summary['throughput_per_hour'] is not None:
+        print(f"Throughput: {summary['throughput_per_hour']:.1f} files/hour")
+    if summary['median_processing_time'] is not None:
+        print(f"Median processing time: {summary['median_processing_time']:.1f} s, median latency from queuing: {summary['median_latency']:.1f} s")
+    for bucket, key, n_attempts, error in summary['last_failures']:
+        print(f'FAILED {bucket}/{key} ({n_attempts} attempts): {error}')
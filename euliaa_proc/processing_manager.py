@@ -1,4 +1,4 @@
-from flask import Flask, request
+from flask import Flask, request, Response
 import json
 from waitress import serve
 from euliaa_proc.log import logger
@@ -9,8 +9,115 @@ import os
 import time 
 import re
 import subprocess
+from euliaa_proc.job_queue import JobQueue
+from euliaa_proc.processed_index import ProcessedIndex
+from euliaa_proc.notification_batcher import NotificationBatcher
+from euliaa_proc.metrics import PipelineMetrics
 
 app = Flask(__name__)
+CONFIG_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config/config_main_s3.yaml')
+CONFIG_EPROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config/config_eprofile.yaml') # default config_eprofile
+job_queue = None
+processed_index = None
+batcher = None
+metrics = PipelineMetrics()
+
+
+def get_job_queue(config_template=CONFIG_TEMPLATE):
+    """
+    Create (at first call) the queue and worker pool running the processing pipeline.
+    Sizes from the main config: n_workers, queue_size, queue_put_timeout (s), max_tasks_per_worker
+    """
+    global job_queue
+    if job_queue is None:
+        config = get_conf(config_template)
+        initializer = preload_worker if config.get('preload_workers', True) else None
+        job_queue = JobQueue(process_notified_files, n_workers=config.get('n_workers', 2), queue_size=config.get('queue_size', 100),
+                             put_timeout=config.get('queue_put_timeout', 1.), max_tasks_per_worker=config.get('max_tasks_per_worker'),
+                             initializer=initializer, initargs=(config_template,), on_result=record_job_result)
+        logger.info(f'Started job queue with {job_queue.n_workers} workers')
+    return job_queue
+
+
+def get_batcher(config_template=CONFIG_TEMPLATE):
+    """
+    Create (at first call) the batcher grouping the notifications of bursts into one job, None if batch_window is 0 or empty.
+    Config keys: batch_window (s), batch_max_size (files per job)
+    """
+    global batcher
+    if batcher is None:
+        config = get_conf(config_template)
+        if not config.get('batch_window'):
+            return None
+        queue = get_job_queue(config_template)
+        batcher = NotificationBatcher(lambda batch: queue.submit(batch, config_template), window=config['batch_window'],
+                                      max_batch_size=config.get('batch_max_size', 20), max_pending=config.get('queue_size', 100))
+        logger.info(f"Batching notifications over {config['batch_window']} s")
+    return batcher
+
+
+def preload_worker(config_template=CONFIG_TEMPLATE):
+    """
+    Worker initializer: import and initialise once per worker process what every pipeline run needs, so that
+    the first file of a (re)started worker does not pay for it: the heavy modules and the lazily imported ones
+    (eprofile, daily quicklooks, boto3, fsspec), the eccodes BUFR sample, the Agg quicklook template and the parsed configs
+    """
+    t0 = time.time()
+    import eccodes
+    import euliaa_proc.measurement
+    import euliaa_proc.write_netcdf
+    import euliaa_proc.nc2bufr
+    import euliaa_proc.eprofile
+    import euliaa_proc.eprofile_hourly
+    import euliaa_proc.daily_quicklooks
+    from euliaa_proc.quicklooks import get_quicklook_template
+    for module in ['boto3', 'fsspec', 's3fs']: # only needed with S3 outputs
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+    bid = eccodes.codes_bufr_new_from_samples('BUFR4')
+    eccodes.codes_release(bid)
+    get_quicklook_template()
+
+    config = get_conf(config_template)
+    for conf_key in ['config', 'config_eprofile', 'config_qc']:
+        if config.get(conf_key) and os.path.exists(config[conf_key]):
+            get_conf(config[conf_key])
+    get_processed_index(config_template)
+    logger.info(f'Worker {os.getpid()} preloaded in {time.time()-t0:.1f} s')
+
+
+def get_processed_index(config_template=CONFIG_TEMPLATE):
+    """open (at first call in each process) the index of processed files, None if processed_index_db is not configured"""
+    global processed_index
+    if processed_index is None:
+        config = get_conf(config_template)
+        if not config.get('processed_index_db'):
+            return None
+        processed_index = ProcessedIndex(config['processed_index_db'], stale_after=config.get('processed_index_stale_after', 3600))
+    return processed_index
+
+
+def record_job_result(args, result):
+    """update the metrics with the result of a job of process_notified_files (None if the job raised)"""
+    files = args[0]
+    if result is None:
+        for file_id in files:
+            metrics.file_done(file_id, False)
+        return
+    for file_id, success, summary in result:
+        metrics.file_done(file_id, success, summary)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    queue_status = job_queue.status() if job_queue is not None else None
+    n_pending = len(batcher.pending) if batcher is not None else 0
+    return Response(metrics.render(queue_status, n_pending), mimetype='text/plain; version=0.0.4')
+
 
 @app.route('/', methods=['POST']) # This is the endpoint that will receive the POST requests
 def catch_root_post():
@@ -25,16 +132,29 @@ def catch_root_post():
         # Extract the file name if the structure matches
         key = notification['Records'][0]['s3']['object']['key']
         bucket_name = notification['Records'][0]['s3']['bucket']['name']
+        etag = notification['Records'][0]['s3']['object'].get('eTag', '')
         # process_uploaded_file(key)
         if not key.endswith('.h5'):
             logger.info(f"File {key} is not an HDF5 file, skipping processing.")
             return 'OK', 200
-        filepath= f's3://{bucket_name}/{key}'
-        
-        curr_file_path = os.path.dirname(os.path.abspath(__file__))
-        run_processing_pipeline(filepath, os.path.join(curr_file_path,'config/config_main_s3.yaml'))
-        
 
+        # skip notifications delivered again for a file already processed (or being processed)
+        index = get_processed_index()
+        if index is not None and not index.claim(bucket_name, key, etag):
+            return 'OK', 200
+
+        # the processing runs in the worker pool, the notification is acknowledged immediately
+        metrics.notification_received((bucket_name, key, etag), notification['Records'][0].get('eventTime'))
+        batcher = get_batcher()
+        if batcher is not None:
+            accepted = batcher.add((bucket_name, key, etag))
+        else:
+            accepted = get_job_queue().submit([(bucket_name, key, etag)], CONFIG_TEMPLATE)
+        if not accepted:
+            metrics.forget((bucket_name, key, etag))
+            if index is not None:
+                index.mark_failed(bucket_name, key, etag, error='queue full')
+            return 'Processing queue full, retry later', 503
 
     except Exception as e:
         logger.error("Error processing notification:", e)
@@ -42,57 +162,147 @@ def catch_root_post():
     return 'OK', 200
 
 
+def process_notified_files(files, config_template):
+    """
+    Run the processing pipeline for a batch of notified S3 objects, list of (bucket_name, key, etag) (in a worker process),
+    keeping their status in the processed-files index
+    Output: list of ((bucket_name, key, etag), success, stage summary) per file
+    """
+    time.sleep(2) # give the notified objects time to be readable from S3
+    index = get_processed_index(config_template)
+    if index is not None:
+        for bucket_name, key, etag in files:
+            index.mark_running(bucket_name, key, etag)
+    summaries = []
+    results = run_processing_batch([f's3://{bucket_name}/{key}' for bucket_name, key, _ in files], config_template, summaries=summaries)
+    if index is not None:
+        for (bucket_name, key, etag), success in zip(files, results):
+            if success:
+                index.mark_done(bucket_name, key, etag)
+            else:
+                index.mark_failed(bucket_name, key, etag, error='processing error, see log')
+    return [(tuple(file_id), success, summary) for file_id, success, summary in zip(files, results, summaries)]
+
+
+def process_notified_file(bucket_name, key, etag, config_template):
+    """
+    Run the processing pipeline for a notified S3 object (in a worker process), keeping its status in the processed-files index
+    """
+    return process_notified_files([(bucket_name, key, etag)], config_template)
+
+
 def run_processing_pipeline(filepath, config_template):
     """
     Run the processing pipeline for the given file.
+    Returns True if the processing succeeded, False otherwise
     """
+    return run_processing_batch([filepath], config_template)[0]
 
-    time.sleep(2)
-    try:
-        logger.info('####################################################################################')
-        logger.info(f'Retrieval triggered for file: {filepath}')
 
-        remove_file = False
-        if filepath.startswith('s3://'): # if we read from S3, then make a local copy because loading properly the h5 file from S3 is not working
-            subprocess.call(['s3cmd', 'get', filepath, '/tmp/', '--config=/home/acbr/.s3cfg'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            filepath = os.path.join('/tmp/', os.path.basename(filepath))
-            logger.info(f'File downloaded to: {filepath}')
-            remove_file = True
-        
+def download_files(filepaths):
+    """
+    Make local copies of the S3 files (loading properly the h5 file from S3 is not working), with a single s3cmd call
+    Output: list of local paths, list of the paths to remove after processing
+    """
+    s3_files = [filepath for filepath in filepaths if filepath.startswith('s3://')]
+    if s3_files:
+        subprocess.call(['s3cmd', 'get', '--force'] + s3_files + ['/tmp/', '--config=/home/acbr/.s3cfg'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    local_files = [os.path.join('/tmp/', os.path.basename(filepath)) if filepath.startswith('s3://') else filepath for filepath in filepaths]
+    for filepath in s3_files:
+        logger.info(f'File downloaded to: {os.path.join("/tmp/", os.path.basename(filepath))}')
+    return local_files, [os.path.join('/tmp/', os.path.basename(filepath)) for filepath in s3_files]
 
-        config = get_conf(config_template)
 
-        # date_str = re.search("([0-9]{4}\-[0-9]{2}\-[0-9]{2}\_[0-9]{2}\-[0-9]{2}\-[0-9]{2})", filepath)
-        date_str = re.search("([0-9]{4}[0-9]{2}[0-9]{2}\_[0-9]{2}[0-9]{2}[0-9]{2})", filepath)
-        config['hdf5_file'] = filepath
-        config['output_nc_l2A'] = os.path.join(config['output_nc_dir'], 'L2A_' + date_str.group(1) + '.nc')
-        config['output_nc_l2B'] = os.path.join(config['output_nc_dir'], 'L2B_' + date_str.group(1) + '.nc')
-        config['output_nc_eprofile'] = os.path.join(config['output_nc_dir'], 'L1_EU1WL_' + date_str.group(1)[:-2] + '.nc')
-        config['output_bufr'] = os.path.join(config['output_bufr_dir'], 'BUFR_' + date_str.group(1) + '.bufr')
-        args = SimpleNamespace(**config)
-
-        runner = Runner(args)
-        runner.run_processing()
-        print("Run processing completed.")
-        runner.write_dwl_eprofile()
-        print("DWL eprofile written.")
-        runner.write_l2a_and_l2b()
-        print("L2A and L2B files written.")
-        runner.encode_bufr()
-        runner.make_quicklooks()
-        # a = 1/0  # This is just to test the error handling, remove this line in production
-        logger.info('Processing completed successfully.')
-        if remove_file:
-            os.remove(filepath)
-            logger.info(f'File removed: {filepath}')
+def get_file_args(config, filepath):
+    """arguments of the Runner for the file filepath, output names derived from its date"""
+    config = dict(config)
+    # date_str = re.search("([0-9]{4}\-[0-9]{2}\-[0-9]{2}\_[0-9]{2}\-[0-9]{2}\-[0-9]{2})", filepath)
+    date_str = re.search("([0-9]{4}[0-9]{2}[0-9]{2}\_[0-9]{2}[0-9]{2}[0-9]{2})", filepath)
+    config['hdf5_file'] = filepath
+    if not config.get('config_eprofile'):
+        config['config_eprofile'] = CONFIG_EPROFILE
+    config['output_nc_l2A'] = os.path.join(config['output_nc_dir'], 'L2A_' + date_str.group(1) + '.nc')
+    config['output_nc_l2B'] = os.path.join(config['output_nc_dir'], 'L2B_' + date_str.group(1) + '.nc')
+    config['output_nc_eprofile'] = os.path.join(config['output_nc_dir'], 'L1_EU1WL_' + date_str.group(1)[:-2] + '.nc')
+    config['output_bufr'] = os.path.join(config['output_bufr_dir'], 'BUFR_' + date_str.group(1) + '.bufr')
+    return SimpleNamespace(**config)
 
+
+def run_processing_batch(filepaths, config_template, summaries=None):
+    """
+    Run the processing pipeline for a batch of files, sharing the config loading and the download of the S3 files.
+    If batch_merge_l2a is set in the config, an L2A file aggregating the whole batch is also written.
+    If summaries is a list, the stage summary of each file (None if it failed) is appended to it.
+    Returns a list of booleans, True where the processing succeeded
+    """
+
+    logger.info('####################################################################################')
+    logger.info(f'Retrieval triggered for {len(filepaths)} file(s): {filepaths}')
+    config = get_conf(config_template)
+    try:
+        local_files, files_to_remove = download_files(filepaths)
     except Exception as e:
-        logger.error(f"Error during processing: {str(e)}. This file will be ignored.")
-        if remove_file and os.path.exists(filepath):
+        logger.error(f"Error downloading {filepaths}: {str(e)}. These files will be ignored.")
+        if summaries is not None:
+            summaries.extend([None]*len(filepaths))
+        return [False]*len(filepaths)
+
+    results = []
+    l2a_batch = []
+    for filepath in local_files:
+        try:
+            logger.info(f'Processing file: {filepath}')
+            args = get_file_args(config, filepath)
+            runner = Runner(args)
+            runner.run_processing()
+            print("Run processing completed.")
+            if config.get('batch_merge_l2a'):
+                l2a_batch.append((args, runner.meas.conf, runner.meas.data.copy()))
+            runner.write_dwl_eprofile()
+            print("DWL eprofile written.")
+            if getattr(args, 'eprofile_state_dir', None):
+                runner.write_hourly_eprofile()
+            runner.write_l2a_and_l2b()
+            print("L2A and L2B files written.")
+            runner.encode_bufr()
+            runner.make_quicklooks()
+            summary = runner.log_stage_summary()
+            # a = 1/0  # This is just to test the error handling, remove this line in production
+            logger.info('Processing completed successfully.')
+            results.append(True)
+        except Exception as e:
+            logger.error(f"Error during processing of {filepath}: {str(e)}. This file will be ignored.")
+            results.append(False)
+            summary = None
+        if summaries is not None:
+            summaries.append(summary)
+
+    if len(l2a_batch) > 1:
+        try:
+            write_merged_l2a(l2a_batch)
+        except Exception as e:
+            logger.error(f"Error writing the merged L2A of the batch: {str(e)}")
+
+    for filepath in files_to_remove:
+        if os.path.exists(filepath):
             os.remove(filepath)
-            logger.info(f'File removed after error: {filepath}')
-        return
+            logger.info(f'File removed: {filepath}')
     logger.info('####################################################################################')
+    return results
+
+
+def write_merged_l2a(l2a_batch):
+    """write one L2A file aggregating the L2A datasets of a batch, list of (args, conf, data), named after its first and last files"""
+    import xarray as xr
+    from euliaa_proc.write_netcdf import Writer
+    l2a_batch = sorted(l2a_batch, key=lambda item: item[0].output_nc_l2A)
+    first_args, conf, _ = l2a_batch[0]
+    last_args = l2a_batch[-1][0]
+    data = xr.concat([item[2] for item in l2a_batch], dim='time', data_vars='minimal', coords='minimal', compat='override', join='outer')
+    output_file = first_args.output_nc_l2A.replace('.nc', '_' + os.path.basename(last_args.output_nc_l2A).replace('L2A_', ''))
+    logger.info(f'Writing merged L2A of {len(l2a_batch)} files {output_file}')
+    Writer(SimpleNamespace(conf=conf, data=data), output_file=output_file).write_nc()
+    logger.info('Wrote merged L2A successfully\n')
 
 
 def process_uploaded_file(filename):
@@ -103,5 +313,7 @@ def process_uploaded_file(filename):
 
 if __name__ == '__main__':
     # app.run(debug=True, host='0.0.0.0', port=8080) # Uncomment this line to run the Flask app directly
+    get_job_queue() # start the workers before accepting notifications
+    get_batcher()
     serve(app, host='0.0.0.0', port=8080) # Use Waitress to serve the app, this is more production-ready (waitress is a WSGI server)
     # run_processing_pipeline('s3://euliaa-l2/TESTS/BankExport_20250522_214000.h5', '/home/acbr/euliaa_proc/euliaa_proc/config/config_main_s3.yaml')
@@ -0,0 +1,201 @@
+import xarray as xr
+import numpy as np
+import glob
+import json
+import os
+from matplotlib import colormaps
+import matplotlib.colors as colors
+from matplotlib.image import imsave
+from euliaa_proc.quicklooks import QUICKLOOK_PANELS, mask_flagged
+from euliaa_proc.log import logger
+
+
+class TilePyramid():
+    """
+    Multi-resolution time-altitude pyramid of the quicklook fields, for browsing long time ranges.
+
+    Level 0 has a time resolution of base_time_res; level k averages blocks of 2**k level-0 bins.
+    Each level is cut along time in tiles of tile_size columns and every tile stores the sums and counts
+    of the (flag-masked) values, so that block averages stay exact when new L2A files are added:
+        store_dir/<var>/L<k>/<tile_index>.npz  (sum, count: arrays of shape (n_alt, tile_size))
+    The tile index is counted from 1970-01-01, tile i of level k covers
+    [i*tile_size*base_time_res*2**k, (i+1)*tile_size*base_time_res*2**k) seconds.
+    The contribution of each source file is kept in store_dir/sources/<file name>.npz, so that a reprocessed or
+    redelivered file replaces its previous contribution instead of being counted twice.
+    The colour limits of the panels without fixed limits are computed once per pyramid (stored in pyramid.json),
+    so that the colours are comparable between tiles and levels.
+    """
+
+    def __init__(self, store_dir, base_time_res=60, alt_res=150, alt_max=50000, tile_size=256, n_levels=8):
+        self.store_dir = store_dir
+        self.meta_file = os.path.join(store_dir, 'pyramid.json')
+        meta = {}
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as f:
+                meta = json.load(f)
+            base_time_res, alt_res, alt_max, tile_size, n_levels = (meta['base_time_res'], meta['alt_res'], meta['alt_max'],
+                                                                    meta['tile_size'], meta['n_levels'])
+        self.base_time_res = base_time_res
+        self.alt_res = alt_res
+        self.alt_max = alt_max
+        self.tile_size = tile_size
+        self.n_levels = n_levels
+        self.n_alt = int(np.ceil(alt_max/alt_res))
+        self.color_limits = meta.get('color_limits', {})
+
+    def write_meta(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(self.meta_file, 'w') as f:
+            json.dump({'base_time_res': self.base_time_res, 'alt_res': self.alt_res, 'alt_max': self.alt_max,
+                       'tile_size': self.tile_size, 'n_levels': self.n_levels, 'color_limits': self.color_limits}, f)
+
+    def source_file(self, source):
+        return os.path.join(self.store_dir, 'sources', f'{source}.npz')
+
+    def tile_file(self, var, level, tile_index):
+        return os.path.join(self.store_dir, var, f'L{level}', f'{tile_index}.npz')
+
+    def load_tile(self, var, level, tile_index):
+        """return (sum, count) of a tile, zeros if the tile does not exist yet"""
+        fname = self.tile_file(var, level, tile_index)
+        if not os.path.exists(fname):
+            return np.zeros((self.n_alt, self.tile_size)), np.zeros((self.n_alt, self.tile_size), dtype=np.int32)
+        with np.load(fname) as tile:
+            return tile['sum'], tile['count']
+
+    def save_tile(self, var, level, tile_index, tile_sum, tile_count):
+        fname = self.tile_file(var, level, tile_index)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        np.savez(fname + '.tmp.npz', sum=tile_sum, count=tile_count)
+        os.replace(fname + '.tmp.npz', fname)
+
+    def add_to_tiles(self, var, level, bin_min, level_sum, level_count, sign=1):
+        """add (sign=1) or subtract (sign=-1) the sums and counts of the level bins starting at bin_min to the tiles"""
+        n_bins = level_sum.shape[1]
+        for tile_index in range(bin_min//self.tile_size, (bin_min+n_bins-1)//self.tile_size+1):
+            tile_start = tile_index*self.tile_size
+            i0 = max(bin_min, tile_start)
+            i1 = min(bin_min+n_bins, tile_start+self.tile_size)
+            tile_sum, tile_count = self.load_tile(var, level, tile_index)
+            tile_sum[:, i0-tile_start:i1-tile_start] += sign*level_sum[:, i0-bin_min:i1-bin_min]
+            tile_count[:, i0-tile_start:i1-tile_start] += sign*level_count[:, i0-bin_min:i1-bin_min]
+            self.save_tile(var, level, tile_index, tile_sum, tile_count)
+
+    def remove_source(self, source):
+        """subtract the recorded contribution of the file source from the tiles"""
+        fname = self.source_file(source)
+        with np.load(fname) as contribution:
+            for var, _, _ in QUICKLOOK_PANELS:
+                for level in range(self.n_levels):
+                    key = f'{var}_L{level}'
+                    self.add_to_tiles(var, level, int(contribution[f'{key}_bin_min']), contribution[f'{key}_sum'],
+                                      contribution[f'{key}_count'], sign=-1)
+        os.remove(fname)
+
+    def add_dataset(self, ds, source=None):
+        """
+        block-average the flag-masked fields of the L2A dataset ds into all the levels of the pyramid
+        source: name of the file of ds; if it already contributed, its previous contribution is replaced
+        """
+        if source is not None and os.path.exists(self.source_file(source)):
+            logger.info(f'{source} already in the quicklook pyramid, replacing its contribution')
+            self.remove_source(source)
+        contribution = {}
+        seconds = ds['time'].values.astype('datetime64[ns]').astype(np.int64)/1e9
+        ibin0 = (seconds//self.base_time_res).astype(np.int64)
+        iz = (ds['altitude_mie'].values//self.alt_res).astype(int)
+        valid_z = (iz >= 0) & (iz < self.n_alt)
+        iz = iz[valid_z]
+
+        for var, los, _ in QUICKLOOK_PANELS:
+            da = ds[var]
+            if los is not None:
+                da = da.sel(line_of_sight=los)
+            values = da.transpose('altitude_mie', 'time').values[valid_z]
+            finite = np.isfinite(values)
+
+            for level in range(self.n_levels):
+                ibin = ibin0//(2**level)
+                bin_min = ibin.min()
+                n_bins = ibin.max() - bin_min + 1
+                # sums and counts over the time bins touched by ds, at this level
+                cell = (iz[:, None]*n_bins + (ibin - bin_min)[None, :])[finite]
+                level_sum = np.bincount(cell, weights=values[finite], minlength=self.n_alt*n_bins).reshape(self.n_alt, n_bins)
+                level_count = np.bincount(cell, minlength=self.n_alt*n_bins).reshape(self.n_alt, n_bins).astype(np.int32)
+                self.add_to_tiles(var, level, bin_min, level_sum, level_count)
+                contribution.update({f'{var}_L{level}_bin_min': bin_min, f'{var}_L{level}_sum': level_sum,
+                                     f'{var}_L{level}_count': level_count})
+
+        if source is not None:
+            fname = self.source_file(source)
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            np.savez(fname + '.tmp.npz', **contribution)
+            os.replace(fname + '.tmp.npz', fname)
+
+    def add_file(self, fname):
+        logger.info(f'Adding {fname} to the quicklook pyramid {self.store_dir}')
+        with xr.load_dataset(fname, engine='h5netcdf') as ds:
+            self.add_dataset(mask_flagged(ds), source=os.path.basename(fname))
+        self.write_meta()
+
+    def read_tile(self, var, level, tile_index):
+        """mean values of a tile (NaN where no data)"""
+        tile_sum, tile_count = self.load_tile(var, level, tile_index)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(tile_count > 0, tile_sum/tile_count, np.nan)
+
+    def get_color_limits(self, var, offset=0):
+        """
+        colour limits of a panel without fixed limits: range of the level-0 means, computed at the first render
+        and kept in pyramid.json so that later renders use the same colours
+        """
+        if var not in self.color_limits:
+            vmin, vmax = np.inf, -np.inf
+            for fname in glob.glob(os.path.join(self.store_dir, var, 'L0', '*.npz')):
+                values = self.read_tile(var, 0, int(os.path.basename(fname).replace('.npz', ''))) + offset
+                if np.any(np.isfinite(values)):
+                    vmin, vmax = min(vmin, np.nanmin(values)), max(vmax, np.nanmax(values))
+            if not np.isfinite(vmin):
+                return None, None
+            self.color_limits[var] = [float(vmin), float(vmax)]
+            self.write_meta()
+        return self.color_limits[var]
+
+    def render_png_tiles(self, var_list=None):
+        """write a colored PNG next to every tile of the store (altitude increasing upwards)"""
+        for var, _, kwargs in QUICKLOOK_PANELS:
+            if var_list and var not in var_list:
+                continue
+            norm = kwargs.get('norm')
+            if norm is None:
+                vmin, vmax = kwargs.get('vmin'), kwargs.get('vmax')
+                if vmin is None or vmax is None:
+                    vmin, vmax = self.get_color_limits(var, offset=kwargs.get('offset', 0))
+                norm = colors.Normalize(vmin=vmin, vmax=vmax)
+            cmap = colormaps[kwargs['cmap']]
+            for fname in glob.glob(os.path.join(self.store_dir, var, 'L*', '*.npz')):
+                level = int(os.path.basename(os.path.dirname(fname))[1:])
+                tile_index = int(os.path.basename(fname).replace('.npz', ''))
+                values = self.read_tile(var, level, tile_index) + kwargs.get('offset', 0)
+                rgba = cmap(norm(np.ma.masked_invalid(values)))
+                rgba[~np.isfinite(values)] = 0  # transparent where no data
+                imsave(fname.replace('.npz', '.png'), rgba[::-1])
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build the multi-resolution quicklook pyramid from L2A files')
+    parser.add_argument('l2a_files', nargs='+', help='Path(s) to the L2A file(s)')
+    parser.add_argument('--store_dir', type=str, help='Directory of the tile store')
+    parser.add_argument('--base_time_res', type=int, default=60, help='Time resolution of level 0 (s)')
+    parser.add_argument('--alt_res', type=int, default=150, help='Altitude resolution (m)')
+    parser.add_argument('--ylim', type=int, default=50000, help='Top of the pyramid (m)')
+    parser.add_argument('--n_levels', type=int, default=8, help='Number of levels (level k averages 2**k level-0 bins)')
+    parser.add_argument('--png', action='store_true', help='Also write colored PNG tiles')
+    args = parser.parse_args()
+
+    pyramid = TilePyramid(args.store_dir, base_time_res=args.base_time_res, alt_res=args.alt_res, alt_max=args.ylim, n_levels=args.n_levels)
+    for l2a_file in sorted(args.l2a_files):
+        pyramid.add_file(l2a_file)
+    if args.png:
+        pyramid.render_png_tiles()
@@ -1,45 +1,162 @@
 import xarray as xr
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.colors as colors
 import matplotlib.dates as mdates
+import threading
 import re
 import numpy as np
-import os 
+import os
+from io import BytesIO
+from euliaa_proc.instrumentation import count_bytes
+
+# Resolution tiers (dpi) for the quicklooks; 'high' corresponds to the historical dpi=300 output
+QUICKLOOK_RESOLUTIONS = {
+    'low': 72,
+    'medium': 150,
+    'high': 300,
+}
+
+# Panels of the quicklook: (variable, line_of_sight to select or None, plotting kwargs)
+QUICKLOOK_PANELS = [
+    ('backscatter_coef', 0, {'norm': colors.LogNorm(vmin=1e-9, vmax=1e-5), 'cmap': 'viridis', 'extend': 'both',
+                             'label': 'Backscatter coefficient [m-1 sr-1]'}),
+    ('w_mie', None, {'vmin': -6, 'vmax': 6, 'cmap': 'seismic', 'label': 'Upward air velocity\n (Mie) [m s-1]'}),
+    ('u_mie', None, {'cmap': 'viridis', 'label': 'Eastward wind\n (Mie) [m s-1]'}),
+    ('v_mie', None, {'cmap': 'viridis', 'label': 'Northward wind\n (Mie) [m s-1]'}),
+    ('temperature_int', 0, {'vmin': -60, 'vmax': 30, 'cmap': 'turbo', 'offset': -273.15,
+                            'label': 'Temperature from\n Rayleigh integration [deg C]'}),
+]
+
+# Figure templates are built once and reused for all renders (the waitress service renders one quicklook per file)
+_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
+
+
+class QuicklookTemplate():
+    """
+    Agg-only figure template for the L2A quicklooks.
+    The figure, axes and colorbars are created once; each render only swaps the rasterized meshes,
+    so no pyplot global state is involved and no figure accumulates across calls.
+    """
+
+    def __init__(self, figsize=(12, 14)):
+        self.fig = Figure(figsize=figsize)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.fig.subplots_adjust(left=0.08, right=0.93, bottom=0.04, top=0.97, hspace=0.35)
+        self.axs = self.fig.subplots(len(QUICKLOOK_PANELS))
+        self.meshes = [None]*len(QUICKLOOK_PANELS)
+        self.cbars = [None]*len(QUICKLOOK_PANELS)
+        self.lock = threading.Lock()
+
+    def render(self, ds, fig_title, ylim=50000):
+        """draw the panels of ds (already masked with the flags) into the template"""
+        for i, (var, los, kwargs) in enumerate(QUICKLOOK_PANELS):
+            ax = self.axs[i]
+            da = ds[var]
+            if los is not None:
+                da = da.sel(line_of_sight=los)
+            da = da.transpose('altitude_mie', 'time')
+            values = da.values + kwargs.get('offset', 0)
+
+            if self.meshes[i] is not None:
+                self.meshes[i].remove()
+            norm = kwargs.get('norm')
+            if norm is None:
+                vmin = kwargs.get('vmin', np.nanmin(values) if np.any(np.isfinite(values)) else 0)
+                vmax = kwargs.get('vmax', np.nanmax(values) if np.any(np.isfinite(values)) else 1)
+                norm = colors.Normalize(vmin=vmin, vmax=vmax)
+            self.meshes[i] = ax.pcolormesh(da['time'].values, da['altitude_mie'].values, values,
+                                           norm=norm, cmap=kwargs['cmap'], shading='auto', rasterized=True)
+
+            if self.cbars[i] is None:
+                label = kwargs.get('label', f"{da.attrs.get('long_name', var)} [{da.attrs.get('units', '')}]")
+                self.cbars[i] = self.fig.colorbar(self.meshes[i], ax=ax, extend=kwargs.get('extend', 'neither'), label=label)
+            else:
+                self.cbars[i].update_normal(self.meshes[i])
+
+            ax.set_xlim(da['time'].values[0], da['time'].values[-1])
+            ax.set_ylim(0, ylim)
+            ax.set_title('')
+            ax.set_ylabel('Altitude [m]')
+            ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+            ax.set_xlabel('Time [UTC]')
+
+        self.axs[0].set_title(fig_title)
+
+    def savefig(self, fname_or_buffer, dpi):
+        self.fig.savefig(fname_or_buffer, dpi=dpi, facecolor='w', format='png')
+
+    def close(self):
+        """release the meshes and the figure"""
+        for mesh in self.meshes:
+            if mesh is not None:
+                mesh.remove()
+        self.meshes = [None]*len(QUICKLOOK_PANELS)
+        self.fig.clear()
+
+
+def get_quicklook_template():
+    """get the shared quicklook template (created at first use)"""
+    with _TEMPLATES_LOCK:
+        if 'l2a' not in _TEMPLATES:
+            _TEMPLATES['l2a'] = QuicklookTemplate()
+        return _TEMPLATES['l2a']
+
+
+def close_quicklook_templates():
+    """close all cached figure templates (e.g. at service shutdown)"""
+    with _TEMPLATES_LOCK:
+        for template in _TEMPLATES.values():
+            template.close()
+        _TEMPLATES.clear()
+
+
+def mask_flagged(ds, var_list=['backscatter_coef', 'w_mie', 'u_mie', 'v_mie', 'temperature_int']):
+    """copy of ds with the plotted variables set to NaN where their flag is not 0 (ds itself is not modified)"""
+    ds = ds.copy() # shallow: the masked variables are new arrays, the others are shared
+    for var in var_list:
+        ds[var] = ds[var].where(ds[var+'_flag']==0, np.nan)
+    return ds
+
+
+def render_quicklooks(ds, fig_title, ylim=50000, resolution='high'):
+    """
+    Render the quicklook of the L2A dataset ds and return it as PNG bytes
+    Inputs:
+        ds: L2A xarray Dataset (the flagged values are masked here)
+        fig_title: title of the figure
+        ylim: upper limit of the altitude axis (m)
+        resolution: one of QUICKLOOK_RESOLUTIONS keys ('low', 'medium', 'high')
+    """
+    if resolution not in QUICKLOOK_RESOLUTIONS:
+        raise ValueError(f'resolution must be one of {list(QUICKLOOK_RESOLUTIONS)}, not {resolution}')
+    ds = mask_flagged(ds)
+    template = get_quicklook_template()
+    with template.lock:
+        template.render(ds, fig_title, ylim=ylim)
+        buffer = BytesIO()
+        try:
+            template.savefig(buffer, dpi=QUICKLOOK_RESOLUTIONS[resolution])
+            return buffer.getvalue()
+        finally:
+            buffer.close()
+
+
+def plot_quicklooks(fname, fig_dir, fig_title, ylim=50000, resolution='high'):
 
-def plot_quicklooks(fname, fig_dir, fig_title, ylim=50000):
-    
     if not os.path.exists(fig_dir) and not fig_dir.startswith('s3://'):
     # Create the directory if it does not exist
         os.makedirs(fig_dir)
     fig_name = os.path.join(fig_dir, os.path.basename(fname).replace('.nc', '.png'))
 
-    ds = xr.load_dataset(fname, engine='h5netcdf')
-    fig,axs = plt.subplots(5,figsize=(12,14))
-    for var in ['backscatter_coef','w_mie','u_mie','v_mie','temperature_int']:
-        ds[var] = ds[var].where(ds[var+'_flag']==0, np.nan)
-
-    ds.backscatter_coef.sel(line_of_sight=0).plot(x='time',norm=colors.LogNorm(vmin=1e-9,vmax=1e-5),ax=axs[0], cbar_kwargs={'label': 'Backscatter coefficient [m-1 sr-1]', 'extend':'both'})
-    ds.w_mie.plot(x='time',vmin=-6,vmax=6,ax=axs[1],cmap='seismic')
-    ds.u_mie.plot(x='time',ax=axs[2])
-    ds.v_mie.plot(x='time',ax=axs[3])
-    (ds.temperature_int.sel(line_of_sight=0)-273.15).plot(x='time',ax=axs[4],cbar_kwargs={'label': 'Temperature from\n Rayleigh integration [deg C]'},vmin=-60,vmax=30,cmap='turbo')
-    for ax in axs:
-        ax.set_ylim(0, ylim)  # Updated to use ylim argument
-        ax.set_title('')
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-        ax.set_xlabel('Time [UTC]')
-
-    axs[0].set_title(fig_title)
-    fig.tight_layout()
+    with xr.load_dataset(fname, engine='h5netcdf') as ds:
+        png = render_quicklooks(ds, fig_title, ylim=ylim, resolution=resolution)
+    count_bytes(written=len(png))
 
     if fig_name.startswith('s3://'):
-        # Save the figure to an in-memory buffer
+        # Upload the in-memory png
         import boto3
-        from io import BytesIO
-
-        buffer = BytesIO()
-        fig.savefig(buffer, dpi=300, bbox_inches='tight', facecolor='w', format='png')
-        buffer.seek(0)
 
         # Parse the S3 bucket and key from the fig_name
         s3 = boto3.client('s3')
@@ -47,12 +164,13 @@ def plot_quicklooks(fname, fig_dir, fig_title, ylim=50000):
         key = '/'.join(fig_name.split('/')[3:])
 
         # Upload the figure to the S3 bucket
-        s3.upload_fileobj(buffer, bucket_name, key)
-        buffer.close()
+        with BytesIO(png) as buffer:
+            s3.upload_fileobj(buffer, bucket_name, key)
 
     else:
         # Save the figure locally
-        fig.savefig(fig_name,dpi=300,bbox_inches='tight',facecolor='w')
+        with open(fig_name, 'wb') as f:
+            f.write(png)
 
 if __name__=='__main__':
     import argparse
@@ -60,6 +178,7 @@ if __name__=='__main__':
     parser.add_argument('--l2a_file', type=str, help='Path to the L2A file')
     parser.add_argument('--fig_dir', type=str, help='Path to the directory where quicklooks are saved')
     parser.add_argument('--ylim', type=int, default=50000, help='Y-axis limit for the plots')  # Added ylim argument
+    parser.add_argument('--resolution', type=str, default='high', choices=list(QUICKLOOK_RESOLUTIONS), help='Resolution tier of the quicklook')
     args = parser.parse_args()
 
     # fname='/data/euliaa-l2/TESTS/L2A_2025-04-14_12-40-01.nc'
@@ -67,4 +186,4 @@ if __name__=='__main__':
     fig_name = args.l2a_file.split('/')[-1]
     fig_name = 'L2A_'+re.search("([0-9]{4}\-[0-9]{2}\-[0-9]{2})", fig_name).group(1)
     # fig_name = 'L2A_2025-04-17'
-    plot_quicklooks(args.l2a_file, args.fig_dir, fig_name, args.ylim)  # Pass ylim to the function
+    plot_quicklooks(args.l2a_file, args.fig_dir, fig_name, args.ylim, resolution=args.resolution)  # Pass ylim to the function
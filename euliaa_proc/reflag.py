@@ -0,0 +1,143 @@
+import multiprocessing
+import datetime
+import os
+import xarray as xr
+from netCDF4 import Dataset
+from concurrent.futures import ProcessPoolExecutor
+from euliaa_proc.log import logger, get_worker_log_queue, init_worker_logging
+from euliaa_proc.measurement import Measurement
+from euliaa_proc.stage_graph import QC_VARS, get_requested_products
+from euliaa_proc.utils.conf_utils import get_conf
+from euliaa_proc.processing_manager import get_file_args
+
+
+def load_l2a(l2a_file, config, config_qc):
+    """
+    Measurement of an L2A file, as at the end of run_processing: time not decoded (s since 1970-01-01),
+    fill values as NaN and no netCDF encoding kept (the outputs are encoded from config_nc)
+    """
+    data = xr.load_dataset(l2a_file, decode_times=False)
+    for var in data.variables.values():
+        var.encoding = {}
+    meas = Measurement(config, conf_qc_file=config_qc)
+    meas.data = data
+    return meas
+
+
+def reflag(meas, recompute_clouds=False):
+    """
+    Recompute the quality flags of an L2A Measurement with its config_qc, from the stored values, errors, SNR and
+    cloud fields. The cloud detection uses the flagged backscatter: with recompute_clouds, the cloud fields are
+    also recomputed from the stored backscatter (needed if the backscatter thresholds changed)
+    """
+    meas.add_quality_flag(var_list=[var for var in QC_VARS if var in meas.data])
+    if recompute_clouds:
+        meas.data = meas.data.drop_vars([var for var in ['cloud_mask', 'below_cloud_top'] if var in meas.data])
+        meas.add_clouds()
+    meas.add_flag_below_cloud_top()
+    meas.add_flag_missing_data()
+
+
+def write_flags_in_place(meas, l2a_file, config_qc, variables):
+    """rewrite only the flag variables of the L2A file, recording the re-flagging in its history"""
+    with Dataset(l2a_file, 'r+') as nc:
+        for var in variables:
+            nc_var = nc.variables[var]
+            nc_var[:] = meas.data[var].transpose(*nc_var.dimensions).values.astype(nc_var.dtype)
+        now = datetime.datetime.now(tz=datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+        history = nc.getncattr('history') if 'history' in nc.ncattrs() else ''
+        nc.setncattr('history', f'{history}\nRe-flagged {now} with {config_qc}'.strip())
+
+
+def write_flags_sidecar(meas, config, sidecar_file, variables):
+    """write the flag variables (and their coordinates) to a sidecar file next to the L2A"""
+    from euliaa_proc.write_netcdf import Writer
+    sidecar = Measurement(config)
+    sidecar.data = meas.data[variables]
+    sidecar.data.attrs = dict(meas.data.attrs)
+    Writer(sidecar, output_file=sidecar_file).write_nc()
+
+
+def reflag_file(l2a_file, config, sidecar=False, recompute_clouds=False):
+    """
+    Re-flag one L2A file with config['config_qc'] and regenerate its L2B and BUFR messages (if they are products of config)
+    config: main config (as for the processing manager)
+    Output: list of the files written
+    """
+    from euliaa_proc.write_netcdf import Writer
+    args = get_file_args(config, l2a_file)
+    products = get_requested_products(args)
+    meas = load_l2a(l2a_file, args.config, args.config_qc)
+    reflag(meas, recompute_clouds=recompute_clouds)
+
+    flag_vars = [f'{var}_flag' for var in QC_VARS if f'{var}_flag' in meas.data]
+    if recompute_clouds:
+        flag_vars += [var for var in ['cloud_mask', 'below_cloud_top'] if var in meas.data]
+    if sidecar:
+        output_file = l2a_file.replace('.nc', '_flags.nc')
+        write_flags_sidecar(meas, args.config, output_file, flag_vars)
+    else:
+        output_file = l2a_file
+        write_flags_in_place(meas, l2a_file, args.config_qc, flag_vars)
+    written = [output_file]
+    logger.info(f'Re-flagged {l2a_file} ({output_file})')
+
+    meas.subsel_stripped_profile()
+    meas.set_invalid_to_nan()
+    if 'l2b' in products:
+        Writer(meas, output_file=args.output_nc_l2B).write_nc()
+        written.append(args.output_nc_l2B)
+    bufr_types = [bufr_type for bufr_type in (getattr(args, 'bufr_types', None) or []) if f'bufr_{bufr_type}' in products]
+    if bufr_types and args.output_bufr:
+        from euliaa_proc.nc2bufr import write_bufr
+        for bufr_type in bufr_types:
+            bufr_name = args.output_bufr.replace('.bufr', f'_{bufr_type}.bufr')
+            write_bufr(meas.data, bufr_name, bufr_type=bufr_type)
+            written.append(bufr_name)
+    return written
+
+
+def reflag_task(l2a_file, config, sidecar, recompute_clouds):
+    """worker task: (l2a_file, files written or None if it failed)"""
+    try:
+        return l2a_file, reflag_file(l2a_file, config, sidecar=sidecar, recompute_clouds=recompute_clouds)
+    except Exception as e:
+        logger.error(f'Re-flagging {l2a_file} failed: {e}')
+        return l2a_file, None
+
+
+def run_reflag(l2a_files, config_main, config_qc=None, sidecar=False, recompute_clouds=False, n_workers=1):
+    """
+    Re-flag L2A files over a pool of n_workers processes, with config_qc (default: the one of config_main)
+    Output: number of files re-flagged, number of failures
+    """
+    config = get_conf(config_main)
+    if config_qc:
+        config['config_qc'] = config_qc
+    n_done, n_failed = 0, 0
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker_logging, initargs=(get_worker_log_queue(),)) as executor:
+        futures = [executor.submit(reflag_task, l2a_file, config, sidecar, recompute_clouds) for l2a_file in l2a_files]
+        for future in futures:
+            _, written = future.result()
+            n_done += written is not None
+            n_failed += written is None
+    logger.info(f'Re-flagged {n_done} L2A files ({n_failed} failed)')
+    return n_done, n_failed
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Recompute the quality flags of existing L2A files with a new QC config, and regenerate their L2B and BUFR')
+    parser.add_argument('l2a_files', nargs='+', help='Path(s) to the L2A file(s)')
+    parser.add_argument('--config_main', type=str, help='Main config (as for the processing manager): config_nc, outputs, products',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config/config_main.yaml'))
+    parser.add_argument('--config_qc', type=str, default=None, help='QC config of the new flags (default: config_qc of the main config)')
+    parser.add_argument('--sidecar', action='store_true', help='Write the flags to <L2A>_flags.nc instead of rewriting them in the L2A')
+    parser.add_argument('--recompute_clouds', action='store_true', help='Also recompute the cloud fields (needed if the backscatter thresholds changed)')
+    parser.add_argument('--n_workers', type=int, default=1, help='Number of worker processes')
+    args = parser.parse_args()
+
+    n_done, n_failed = run_reflag(args.l2a_files, args.config_main, config_qc=args.config_qc, sidecar=args.sidecar,
+                                  recompute_clouds=args.recompute_clouds, n_workers=args.n_workers)
+    print(f'Re-flagged: {n_done}, failed: {n_failed}')
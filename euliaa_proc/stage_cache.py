@@ -0,0 +1,179 @@
+import hashlib
+import pickle
+import fcntl
+import json
+import os
+from euliaa_proc.log import logger
+
+CACHE_VERSION = 2 # bump when the code of a cached stage changes, so that the states it cached are not reused
+
+# Checkpoints of run_processing, latest last: the stage after which the state is saved (None: after the ingest) and
+# the stages whose results the state holds. The clouds state is saved without the *_flag variables, so that the
+# quality flags are always recomputed with the current config_qc.
+CHECKPOINTS = {
+    'ingest': {'after': None, 'holds': ['lat_lon', 'time_bnds']},
+    'snr': {'after': 'noise_and_snr', 'holds': ['lat_lon', 'time_bnds', 'noise_and_snr']},
+    'clouds': {'after': 'clouds', 'holds': ['lat_lon', 'time_bnds', 'noise_and_snr', 'clouds']},
+}
+QC_KEYS = ['THRES_MIN', 'THRES_MAX', 'SNR_THRES', 'ERR_THRES']
+
+
+def hash_file(filepath, block_size=2**20):
+    """sha256 of the content of a file"""
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def hash_dict(content):
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_ingest_conf(conf):
+    """subset of config_nc read by the ingest (not the attributes and types used by the writer only)"""
+    variables = {var: {key: specs.get(key) for key in ['dim', 'value', 'original_hdf5']} for var, specs in conf['variables'].items()}
+    attributes = {attr: value['original_hdf5'] for attr, value in conf['attributes'].items()
+                  if type(value) == dict and 'original_hdf5' in value}
+    return {'dimensions': conf['dimensions'], 'variables': variables, 'attributes': attributes}
+
+
+def get_checkpoint_keys(meas, file_hash, load_vars, stages):
+    """
+    Cache key of each checkpoint of the planned stages (see stage_graph.plan_stages): hash of the input file, of the
+    config subset each checkpoint depends on and of the planned variables, chained from one checkpoint to the next
+    Output: dict {checkpoint: key}, for the checkpoints whose stage is planned
+    """
+    planned = dict(stages)
+    keys = {}
+    key = hash_dict({'version': CACHE_VERSION, 'file': file_hash, 'conf': get_ingest_conf(meas.conf), 'precision': meas.precision,
+                     'altitude_window': meas.altitude_window, 'noise_full_profile': meas.noise_full_profile,
+                     'load_vars': load_vars, 'stages': {stage: planned.get(stage, 'skipped') for stage in CHECKPOINTS['ingest']['holds']}})
+    keys['ingest'] = key
+    if 'noise_and_snr' in planned:
+        key = hash_dict({'previous': key, 'noise_and_snr': planned['noise_and_snr']})
+        keys['snr'] = key
+        if 'clouds' in planned:
+            # the cloud detection only uses the backscatter flagged with the backscatter thresholds
+            qc_conf = {qc_key: meas.qc_conf[qc_key].get('backscatter_coef') for qc_key in QC_KEYS if qc_key in meas.qc_conf}
+            keys['clouds'] = hash_dict({'previous': key, 'qc': qc_conf, 'quality_flag': planned.get('quality_flag')})
+    return keys
+
+
+class StageCache():
+    """
+    Content-addressed on-disk cache of the Measurement datasets at the checkpoints of run_processing.
+
+    Each state is pickled in cache_dir as <key>.pkl, the key being a hash of the input file content and of the config
+    subset the state depends on, so that a rerun with only QC or writer changes restarts from the latest cached state.
+    The cache is evicted in least-recently-used order (modification time, updated on every hit) when it exceeds
+    max_size_mb. The cache directory must be local and only writable by the processing (the states are pickles).
+    """
+
+    def __init__(self, cache_dir, max_size_mb=2000):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb*1e6
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock_file = os.path.join(cache_dir, 'stage_cache.lock')
+
+    def entry_file(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def get(self, key):
+        """cached dataset of key, None if missing or unreadable"""
+        fname = self.entry_file(key)
+        try:
+            with open(fname, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f'Could not read cached state {fname} ({e}), ignoring it')
+            return None
+        try:
+            os.utime(fname) # most recently used
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """cache the dataset data under key (atomic replace), then evict the least recently used states if needed"""
+        fname = self.entry_file(key)
+        tmp_file = f'{fname}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, fname)
+        self.evict()
+
+    def evict(self):
+        with open(self.lock_file, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = []
+            for fname in os.listdir(self.cache_dir):
+                if not fname.endswith('.pkl'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, fname))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, fname))
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, fname in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_dir, fname))
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+                logger.info(f'Evicted cached state {fname}')
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def refresh_static_attrs(meas):
+    """global attributes of a cached state that are set in config_nc rather than read from the hdf5 file"""
+    for attr, value in meas.conf['attributes'].items():
+        if type(value) == dict:
+            continue
+        meas.data.attrs[attr] = '' if value is None else value
+
+
+def run_stages_cached(meas, load_vars, stages, cache):
+    """
+    Run the planned stages on the H5Reader meas (see stage_graph.plan_stages), restarting from the latest state cached
+    for this file and config, and caching the states of the checkpoints computed
+    """
+    from euliaa_proc.stage_graph import run_stage
+    keys = get_checkpoint_keys(meas, hash_file(meas.data_file), load_vars, stages)
+    done = set()
+    for checkpoint in reversed(list(keys)):
+        data = cache.get(keys[checkpoint])
+        if data is not None:
+            logger.info(f'Restarting from the cached {checkpoint} state')
+            meas.data = data
+            refresh_static_attrs(meas)
+            done = set(CHECKPOINTS[checkpoint]['holds'])
+            break
+    else:
+        meas.read_hdf5_file()
+        meas.load_attrs()
+        meas.load_data(var_list=load_vars)
+
+    to_save = [checkpoint for checkpoint in keys if not set(CHECKPOINTS[checkpoint]['holds']) <= done]
+    planned = [stage for stage, _ in stages]
+    for i, (stage, variables) in enumerate(stages + [(None, None)]):
+        for checkpoint in list(to_save):
+            specs = CHECKPOINTS[checkpoint]
+            # the state is complete once the stages it holds are run, and not yet modified by a later stage
+            if all(held in done or held not in planned for held in specs['holds']) and stage not in specs['holds']:
+                if specs['after'] is None or specs['after'] in done:
+                    state = meas.data
+                    if checkpoint == 'clouds':
+                        state = state.drop_vars([var for var in state.data_vars if var.endswith('_flag')])
+                    cache.put(keys[checkpoint], state)
+                to_save.remove(checkpoint)
+        if stage is None or stage in done:
+            continue
+        run_stage(meas, stage, variables)
+        done.add(stage)
@@ -0,0 +1,135 @@
+from euliaa_proc.log import logger
+from euliaa_proc.eprofile import EPROFILE_L2A_VARS, EPROFILE_L2A_FLAGS
+
+QC_VARS = ['u_mie', 'v_mie', 'w_mie', 'temperature_int', 'backscatter_coef'] # variables flagged by add_quality_flag
+CLOUD_VARS = ['cloud_mask', 'below_cloud_top', 'above_cloud_base', 'cloud_base', 'cloud_top', 'cloud_base_height', 'cloud_top_height']
+COORD_VARS = ['time', 'altitude_mie', 'altitude_ray', 'line_of_sight'] # always loaded (dimensions of the other variables)
+BUFR_HEADER_VARS = ['time', 'altitude_mie', 'station_latitude', 'station_longitude', 'station_altitude',
+                    'range_integration', 'time_integration']
+
+# Stages of Runner.run_processing after the ingest, in execution order. For each variable a stage provides or updates,
+# requires gives the variables it is computed from.
+STAGES = {
+    'lat_lon': {
+        'provides': ['latitude_mie', 'latitude_ray', 'longitude_mie', 'longitude_ray'],
+        'requires': lambda var: ['station_latitude', 'station_longitude', 'altitude_' + var.split('_')[-1]],
+    },
+    'time_bnds': {
+        'provides': ['time_bnds'],
+        'requires': lambda var: ['time', 'time_integration'],
+    },
+    'noise_and_snr': {
+        'provides': ['noise_level_mie', 'snr_mie', 'noise_level_ray', 'snr_ray'],
+        'requires': lambda var: ['signal_' + var.split('_')[-1]],
+    },
+    'quality_flag': {
+        'provides': [f'{var}_flag' for var in QC_VARS],
+        'requires': lambda var: [var[:-len('_flag')], var[:-len('_flag')] + '_err', 'snr_mie'], # all on the Mie gates
+    },
+    'clouds': {
+        'provides': CLOUD_VARS,
+        'requires': lambda var: ['backscatter_coef', 'backscatter_coef_flag'],
+    },
+    'flag_below_cloud_top': {
+        'updates': ['temperature_int_flag'],
+        'requires': lambda var: ['below_cloud_top'],
+    },
+    'flag_missing_data': {
+        'updates': [f'{var}_flag' for var in QC_VARS],
+        'requires': lambda var: [var[:-len('_flag')]],
+    },
+}
+
+
+def get_product_vars(product, qc_conf):
+    """
+    Variables a product needs from the measurement, None for all of them
+    Products: l2a, l2b, eprofile, eprofile_hourly, bufr_<bufr type>, quicklook (drawn from the L2A file)
+    """
+    if product in ['l2a', 'quicklook']:
+        return None
+    if product == 'l2b':
+        return qc_conf['VARS_TO_KEEP'] + ['time', 'altitude_mie']
+    if product in ['eprofile', 'eprofile_hourly']:
+        return EPROFILE_L2A_VARS + EPROFILE_L2A_FLAGS + ['time', 'time_bnds', 'altitude_mie', 'station_altitude',
+                                                         'station_latitude', 'station_longitude', 'range_integration']
+    if product.startswith('bufr_'): # the BUFR messages are encoded from the L2B profile
+        bufr_type = product[len('bufr_'):]
+        fields = {'wind': ['u_mie', 'v_mie', 'w_mie'], 'temperature': ['temperature_int'],
+                  'wind_and_temperature': ['u_mie', 'v_mie', 'w_mie', 'temperature_int']}[bufr_type]
+        return BUFR_HEADER_VARS + fields + [f'{var}_flag' for var in fields]
+    raise ValueError(f'Unknown product {product}')
+
+
+def get_requested_products(args):
+    """
+    Products of a run: the products list of the config (l2a, l2b, eprofile, bufr, quicklook), all of them if not set.
+    bufr expands to one product per type of bufr_types; eprofile_hourly is added with eprofile if eprofile_state_dir is set
+    """
+    products = getattr(args, 'products', None) or ['l2a', 'l2b', 'eprofile', 'bufr', 'quicklook']
+    requested = []
+    for product in products:
+        if product == 'bufr':
+            requested += [f'bufr_{bufr_type}' for bufr_type in (getattr(args, 'bufr_types', None) or [])]
+        else:
+            requested.append(product)
+        if product == 'eprofile' and getattr(args, 'eprofile_state_dir', None):
+            requested.append('eprofile_hourly')
+    if 'quicklook' in requested and 'l2a' not in requested:
+        requested.append('l2a')
+    return requested
+
+
+def plan_stages(products, qc_conf):
+    """
+    Stages needed for the products, from the variables each product needs
+    Outputs:
+        load_vars: variables to load from the hdf5 file (None: all)
+        stages: list of (stage, variables of the stage needed), in execution order (None: all its variables)
+    """
+    product_vars = [get_product_vars(product, qc_conf) for product in products]
+    if any(variables is None for variables in product_vars):
+        return None, [(stage, None) for stage in STAGES]
+
+    needed = set(var for variables in product_vars for var in variables)
+    stage_vars = {stage: set() for stage in STAGES}
+    todo = list(needed)
+    while todo:
+        var = todo.pop()
+        for stage, specs in STAGES.items():
+            if var in specs.get('provides', []) + specs.get('updates', []):
+                stage_vars[stage].add(var)
+                for required in specs['requires'](var):
+                    if required not in needed:
+                        needed.add(required)
+                        todo.append(required)
+
+    computed = set(var for specs in STAGES.values() for var in specs.get('provides', []))
+    load_vars = sorted((needed - computed) | set(COORD_VARS))
+    stages = [(stage, sorted(variables)) for stage, variables in stage_vars.items() if variables]
+    return load_vars, stages
+
+
+def run_stage(meas, stage, variables=None):
+    """run a stage on a Measurement, restricted to the variables needed (None: all)"""
+    if stage == 'lat_lon':
+        meas.add_lat_lon()
+    elif stage == 'time_bnds':
+        meas.add_time_bnds()
+    elif stage == 'noise_and_snr':
+        logger.info('Computing noise level and SNR')
+        meas.add_noise_and_snr(scat_list=[scat for scat in ['mie', 'ray'] if variables is None or f'snr_{scat}' in variables
+                                          or f'noise_level_{scat}' in variables])
+    elif stage == 'quality_flag':
+        logger.info('Adding basic quality flag')
+        meas.add_quality_flag(var_list=[var for var in QC_VARS if variables is None or f'{var}_flag' in variables])
+    elif stage == 'clouds':
+        logger.info('Cloud detection (for now, only transparent clouds)')
+        meas.add_clouds()
+    elif stage == 'flag_below_cloud_top':
+        logger.info('Completing quality flag')
+        meas.add_flag_below_cloud_top()
+    elif stage == 'flag_missing_data':
+        meas.add_flag_missing_data()
+    else:
+        raise ValueError(f'Unknown stage {stage}')
@@ -0,0 +1,227 @@
+import datetime
+import os
+import numpy as np
+from euliaa_proc.utils.conf_utils import get_conf
+from euliaa_proc.utils.file_utils import abs_file_path
+
+DEFAULT_CONFIG_NC = abs_file_path('euliaa_proc/config/config_nc.yaml')
+LOS_ZENITH_ANGLES = [0., 30., 30.] # zenith, eastward, northward (see compute_lat_lon)
+
+
+def get_hdf5_mapping(conf):
+    """
+    Variables and attributes of the BankExport file according to the original_hdf5 mapping of the netCDF config
+    Output: dict {config variable or attribute name: (hdf5 group, hdf5 variable name or list of names per LOS)}
+    """
+    mapping = {}
+    for name, specs in list(conf['variables'].items()) + list(conf['attributes'].items()):
+        if not isinstance(specs, dict) or not specs.get('original_hdf5'):
+            continue
+        hdf5_group = specs['original_hdf5'].get('hdf5_group')
+        hdf5_var = specs['original_hdf5'].get('hdf5_var_name')
+        if hdf5_group and hdf5_var:
+            mapping[name] = (hdf5_group, hdf5_var)
+    return mapping
+
+
+def standard_temperature(alt):
+    """temperature (K) of the US standard atmosphere up to 47 km, isothermal above"""
+    return np.interp(alt, [0., 11e3, 20e3, 32e3, 47e3], [288.15, 216.65, 216.65, 228.65, 270.65])
+
+
+def random_cloud_layers(rng, n_time, n_clouds, alt_range=(1.5e3, 10e3)):
+    """
+    Cloud layers with a random base, thickness, optical depth and period of presence
+    Output: list of dicts (base, top in m, backscatter in m-1 sr-1, optical depth, time mask)
+    """
+    layers = []
+    for _ in range(n_clouds):
+        base = rng.uniform(*alt_range)
+        start = rng.integers(0, n_time)
+        duration = rng.integers(max(n_time//4, 1), n_time+1)
+        in_time = np.zeros(n_time, dtype=bool)
+        in_time[start:start+duration] = True
+        layers.append({'base': base, 'top': base + rng.uniform(300., 1500.),
+                       'backscatter': 10**rng.uniform(-5.5, -4.), 'optical_depth': rng.uniform(0.05, 0.5),
+                       'in_time': in_time})
+    return layers
+
+
+def backscatter_profiles(alt, n_time, layers):
+    """
+    Molecular and particle backscatter coefficients (m-1 sr-1) and two-way transmission on (time, altitude):
+    exponential molecular profile, boundary layer aerosols and the cloud layers (attenuating the signal above them)
+    """
+    beta_mol = np.broadcast_to(1.5e-6*np.exp(-alt/8e3), (n_time, len(alt)))
+    beta_part = np.broadcast_to(3e-7*np.exp(-alt/1.5e3), (n_time, len(alt))).copy()
+    optical_depth = np.zeros((n_time, len(alt)))
+    for layer in layers:
+        in_cloud = (alt >= layer['base']) & (alt <= layer['top'])
+        beta_part[np.ix_(layer['in_time'], in_cloud)] += layer['backscatter']
+        fraction = np.clip((alt - layer['base'])/(layer['top'] - layer['base']), 0., 1.)
+        optical_depth[layer['in_time']] += layer['optical_depth']*fraction
+    return beta_mol, beta_part, np.exp(-2*optical_depth)
+
+
+def expected_counts(beta, transmission, alt, zenith_angle, n_photons, background):
+    """mean counts of a lidar channel: range-corrected backscatter with incomplete overlap, plus a constant background"""
+    r = alt/np.cos(np.deg2rad(zenith_angle))
+    overlap = 1 - np.exp(-r/500.)
+    return n_photons*beta/beta[..., :1]*transmission*overlap*(1e3/r)**2 + background
+
+
+def make_bankexport_fields(n_time=60, n_alt_mie=400, n_alt_ray=400, n_los=3, n_clouds=2, start_time=None,
+                           delta_alt=150, delta_time=60, first_alt=200., latitude=46.81, longitude=6.94, seed=0,
+                           dtype=np.float32):
+    """
+    Synthetic BankExport fields, keyed by the netCDF variable names of the config
+    Outputs:
+        fields: dict {config variable name: array} with the (time, altitude, los) arrays of the measurements,
+                the (time, altitude) arrays of the wind components and the scalars/coordinates of the glo group
+        layers: the cloud layers (see random_cloud_layers)
+    dtype: dtype of the measurement arrays (float64 e.g. to check the float32 processing mode)
+    """
+    rng = np.random.default_rng(seed)
+    start_time = start_time or datetime.datetime(2025, 5, 22, 12, tzinfo=datetime.timezone.utc)
+    if start_time.tzinfo is None:
+        start_time = start_time.replace(tzinfo=datetime.timezone.utc)
+    alt_mie = first_alt + delta_alt*np.arange(n_alt_mie)
+    alt_ray = first_alt + delta_alt*np.arange(n_alt_ray)
+    time = start_time.timestamp() + delta_time*(np.arange(n_time) + 0.5)
+
+    layers = random_cloud_layers(rng, n_time, n_clouds)
+    beta_mol, beta_part, transmission = backscatter_profiles(alt_mie, n_time, layers)
+    beta_mol_ray, _, transmission_ray = backscatter_profiles(alt_ray, n_time, layers)
+    temperature = standard_temperature(alt_mie)
+    u_true = 10 + 20*np.exp(-((alt_mie - 11e3)/4e3)**2)
+    v_true = 5*np.sin(2*np.pi*alt_mie/20e3)
+
+    fields = {name: [] for name in ['signal_mie', 'signal_ray', 'backscatter_coef', 'backscatter_coef_err',
+                                    'backscatter_ratio', 'backscatter_ratio_err', 'temperature_int', 'temperature_int_err',
+                                    'width_mie', 'width_mie_err', 'wind', 'wind_err']}
+    for i_los in range(n_los):
+        zenith_angle = LOS_ZENITH_ANGLES[i_los % len(LOS_ZENITH_ANGLES)]
+        counts_mie = expected_counts(beta_mol + beta_part, transmission, alt_mie, zenith_angle, 2e5, 50.)
+        counts_ray = expected_counts(beta_mol_ray, transmission_ray, alt_ray, zenith_angle, 5e5, 80.)
+        fields['signal_mie'].append(rng.poisson(counts_mie))
+        fields['signal_ray'].append(rng.poisson(counts_ray))
+
+        # errors of the retrievals from the photon noise (Rayleigh counts on the Mie gates for the temperature)
+        rel_err = np.minimum(np.sqrt(counts_mie)/np.maximum(counts_mie - 50., 1e-3), 1.)
+        counts_ray_mie = expected_counts(beta_mol, transmission, alt_mie, zenith_angle, 5e5, 0.)
+        temperature_err = np.minimum(100./np.sqrt(counts_ray_mie), 50.)
+        width_err = 0.05 + 0.5*rel_err
+        wind_err = np.minimum(0.5 + 20*rel_err, 50.)
+
+        noise = np.exp(rel_err*rng.standard_normal(rel_err.shape) - rel_err**2/2) # keeps the backscatter positive
+        bsc = np.maximum((beta_mol + beta_part)*noise - beta_mol, 1e-3*beta_part)
+        fields['backscatter_coef'].append(bsc)
+        fields['backscatter_coef_err'].append((beta_mol + beta_part)*rel_err)
+        fields['backscatter_ratio'].append((beta_mol + bsc)/beta_mol)
+        fields['backscatter_ratio_err'].append((beta_mol + beta_part)/beta_mol*rel_err)
+        fields['temperature_int'].append(temperature + temperature_err*rng.standard_normal(temperature_err.shape))
+        fields['temperature_int_err'].append(temperature_err)
+        fields['width_mie'].append(1. + width_err*rng.standard_normal(width_err.shape))
+        fields['width_mie_err'].append(width_err)
+        wind_true = [0.*u_true, u_true, v_true][i_los % 3] # w, u, v along the zenith, eastward and northward LOS
+        fields['wind'].append(wind_true + wind_err*rng.standard_normal(wind_err.shape))
+        fields['wind_err'].append(wind_err)
+
+    fields = {name: np.stack(arrays, axis=-1).astype(dtype) for name, arrays in fields.items()}
+    for i_los, component in enumerate(['w', 'u', 'v'][:n_los]):
+        fields[f'{component}_mie'] = fields['wind'][..., i_los]
+        fields[f'{component}_mie_err'] = fields['wind_err'][..., i_los]
+    del fields['wind'], fields['wind_err']
+    fields.update({
+        'time': time, 'time_mean': time + rng.uniform(-1., 1., n_time),
+        'altitude_mie': alt_mie.astype(np.float32), 'altitude_ray': alt_ray.astype(np.float32),
+        'station_latitude': latitude, 'station_longitude': longitude,
+        'range_integration': np.int64(delta_alt), 'time_integration': np.int64(delta_time),
+        'operation_mode': 'synthetic', 'retrieval_code_version': 'synthetic',
+    })
+    return fields, layers
+
+
+def write_bankexport(filepath, fields, config_nc=DEFAULT_CONFIG_NC):
+    """
+    Write the fields in a BankExport-like HDF5 file (rec/glo groups, written with netCDF4 as read by H5Reader),
+    under the hdf5 names of the original_hdf5 mapping of the netCDF config.
+    The variables with one hdf5 name per LOS are split along the last axis; the LOS beyond the number generated are not written.
+    """
+    from netCDF4 import Dataset
+    conf = get_conf(config_nc)
+    mapping = get_hdf5_mapping(conf)
+    hdf5_dims = {'time': 'time', 'altitude_mie': 'alt_mie', 'altitude_ray': 'alt_ray'}
+    with Dataset(filepath, 'w', format='NETCDF4') as nc:
+        groups = {'rec': nc.createGroup('rec'), 'glo': nc.createGroup('glo')}
+        for group in groups.values():
+            for dim, hdf5_dim in hdf5_dims.items():
+                group.createDimension(hdf5_dim, len(fields[dim]))
+
+        for name, (hdf5_group, hdf5_var) in mapping.items():
+            if name not in fields:
+                continue
+            group = groups[hdf5_group]
+            value = fields[name]
+            if isinstance(value, str): # attributes
+                group.createVariable(hdf5_var, str, ())[0] = value
+                continue
+            value = np.asarray(value)
+            # one hdf5 variable per LOS, without the line_of_sight dimension (scalars are broadcast by the reader)
+            dims = tuple(hdf5_dims[d] for d in conf['variables'][name]['dim'] if d != 'line_of_sight') if value.ndim else ()
+            arrays = [value[..., i] for i in range(value.shape[-1])] if isinstance(hdf5_var, list) else [value]
+            names = hdf5_var if isinstance(hdf5_var, list) else [hdf5_var]
+            for var_name, array in zip(names, arrays):
+                if var_name in group.variables: # e.g. the same name listed twice in the config
+                    continue
+                group.createVariable(var_name, array.dtype, dims)[...] = array
+
+
+def generate_bankexport(out_dir, start_time=None, config_nc=DEFAULT_CONFIG_NC, **kwargs):
+    """
+    Write one synthetic BankExport_YYYYmmdd_HHMMSS.h5 file in out_dir (kwargs: see make_bankexport_fields)
+    Output: path of the file
+    """
+    start_time = start_time or datetime.datetime(2025, 5, 22, 12)
+    fields, _ = make_bankexport_fields(start_time=start_time, **kwargs)
+    os.makedirs(out_dir, exist_ok=True)
+    filepath = os.path.join(out_dir, f'BankExport_{start_time:%Y%m%d_%H%M%S}.h5')
+    write_bankexport(filepath, fields, config_nc=config_nc)
+    return filepath
+
+
+def generate_bankexport_series(out_dir, n_files, start_time=None, seed=0, **kwargs):
+    """
+    Write n_files consecutive synthetic files (each covering n_time*delta_time s), e.g. an archive to backfill
+    Output: list of file paths
+    """
+    start_time = start_time or datetime.datetime(2025, 5, 22, 12)
+    file_duration = kwargs.get('n_time', 60)*kwargs.get('delta_time', 60)
+    return [generate_bankexport(out_dir, start_time=start_time + datetime.timedelta(seconds=i*file_duration), seed=seed+i, **kwargs)
+            for i in range(n_files)]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Write synthetic BankExport HDF5 files (e.g. for benchmarks at scale)')
+    parser.add_argument('out_dir', help='Output directory')
+    parser.add_argument('--n_files', type=int, default=1, help='Number of consecutive files')
+    parser.add_argument('--start', type=str, default='2025-05-22T12:00', help='Start time of the first file (UTC)')
+    parser.add_argument('--n_time', type=int, default=60, help='Number of profiles per file')
+    parser.add_argument('--n_alt_mie', type=int, default=400, help='Number of Mie altitude gates')
+    parser.add_argument('--n_alt_ray', type=int, default=400, help='Number of Rayleigh altitude gates')
+    parser.add_argument('--n_los', type=int, default=3, help='Number of lines of sight (at most the number of hdf5 names per LOS in the config)')
+    parser.add_argument('--n_clouds', type=int, default=2, help='Number of cloud layers')
+    parser.add_argument('--delta_alt', type=int, default=150, help='Range resolution (m)')
+    parser.add_argument('--delta_time', type=int, default=60, help='Time resolution (s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float64'], help='dtype of the measurement arrays')
+    parser.add_argument('--config_nc', type=str, default=str(DEFAULT_CONFIG_NC), help='netCDF config with the original_hdf5 mapping')
+    args = parser.parse_args()
+
+    files = generate_bankexport_series(args.out_dir, args.n_files, start_time=datetime.datetime.fromisoformat(args.start),
+                                       seed=args.seed, config_nc=args.config_nc, n_time=args.n_time, n_alt_mie=args.n_alt_mie,
+                                       n_alt_ray=args.n_alt_ray, n_los=args.n_los, n_clouds=args.n_clouds,
+                                       delta_alt=args.delta_alt, delta_time=args.delta_time, dtype=args.dtype)
+    for filepath in files:
+        print(filepath)
@@ -1,9 +1,6 @@
 import xarray as xr
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
 from scipy import signal
-import aprofiles as apro
 from euliaa_proc.log import logger
 
 def cloud_aprofiles(path, zmin=0, thr_noise = 1.5, thr_clouds = 2, verbose = False, time_avg = 0):
@@ -25,6 +22,7 @@ def cloud_aprofiles(path, zmin=0, thr_noise = 1.5, thr_clouds = 2, verbose = Fal
 
     """
 
+    import aprofiles as apro # optional method, slow to import
     profile = apro.reader.ReadProfiles(path).read()
     profile.clouds(method="vg",zmin=zmin, thr_noise=thr_noise,
                    thr_clouds=thr_clouds, verbose=verbose,time_avg=time_avg)
@@ -32,14 +30,25 @@ def cloud_aprofiles(path, zmin=0, thr_noise = 1.5, thr_clouds = 2, verbose = Fal
 
 
 def savgol(x,F,K):
-    xf = xr.zeros_like(x)*np.nan
-    y = xr.zeros_like(x)*np.nan
-
+    """
+    Savitzky-Golay smoothed signal and gradient along the last axis.
+    savgol_filter cannot fit its edge polynomials on NaNs (e.g. flagged gates): the profiles with non-finite values are
+    extended with their edge values instead, the NaNs spreading to the gates whose filter window contains them.
+    The complete profiles are filtered as usual
+    """
+    x = np.asarray(x)
     # if F%2==0:
     #     F+=1
-    xf = signal.savgol_filter(x,F,K,deriv = 0) # smoothed backscatter
-    y = signal.savgol_filter(xf,F,K,deriv = 1) # smoothed gradient
-
+    if np.all(np.isfinite(x)):
+        xf = signal.savgol_filter(x,F,K,deriv = 0) # smoothed backscatter
+        y = signal.savgol_filter(xf,F,K,deriv = 1) # smoothed gradient
+        return xf, y
+
+    xf = signal.savgol_filter(x,F,K,deriv = 0, mode='nearest')
+    y = signal.savgol_filter(xf,F,K,deriv = 1, mode='nearest')
+    complete = np.all(np.isfinite(x), axis=-1)
+    if x.ndim > 1 and np.any(complete):
+        xf[complete], y[complete] = savgol(x[complete], F, K)
     return xf, y
 
 
@@ -120,7 +129,11 @@ def refine_cloud_detection(bsc, cb, ct, F0 = 5, K0 = 3,bsc_thres = 1e-8, vg_thre
         y[1:-1][xf[2:]<np.log(bsc_thres)] = np.nan # abs threshold on backscatter NB to do check indexing
         y[1:-1][~((y[2:]-y[1:-1]<0) & (y[:-2]-y[1:-1]<0))] = np.nan # sign threshold on gradient
 
-        if np.nanmax(y[1:-1])<vg_thres: # max gradient below threshold, no satisfactory cloud top
+        if len(y) < 3: # next cloud base on the adjacent gate, no room for a cloud top
+            cb[ii] = 0
+            logger.info('no cloud top detected, removing cloud base')
+
+        elif np.nanmax(y[1:-1])<vg_thres: # max gradient below threshold, no satisfactory cloud top
             cb[ii] = 0 # no cloud top detected, removing cloud base
             logger.info('no cloud top detected, removing cloud base')
 
@@ -162,6 +175,8 @@ def find_cloud_mask(bsc, cloud_base, cloud_top, return_below_cloud_top = False,
 
 
 def plot_cloud(ds,ymax=30000,name_bsc_var = 'attenuated_backscatter_0', savefig=None):
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
 
     fig,ax = plt.subplots(figsize = (15,4))
     im=ds[name_bsc_var].plot(x='time',vmin=1e-9,vmax=1e-5,norm=colors.LogNorm(),cmap='plasma')
@@ -1,10 +1,20 @@
-import yaml
+import copy
+import os
+
+_CONF_CACHE = {}
 
 def get_conf(file):
-    """get config dictionary from yaml files"""
-    with open(file) as f:
-        conf = yaml.load(f, Loader=yaml.FullLoader)
-    return conf
+    """
+    get config dictionary from yaml files
+    The parsed files are cached per process (reparsed if modified); callers get a copy they may modify
+    """
+    key = os.path.abspath(file)
+    mtime = os.path.getmtime(key)
+    if key not in _CONF_CACHE or _CONF_CACHE[key][0] != mtime:
+        import yaml
+        with open(file) as f:
+            _CONF_CACHE[key] = (mtime, yaml.load(f, Loader=yaml.FullLoader))
+    return copy.deepcopy(_CONF_CACHE[key][1])
 
 def correct_dim_scalar_fields(conf):
     """scalar fields are assigned dimension=()"""
@@ -29,14 +29,14 @@ def compute_lat_lon(lat_station = 0, lon_station = 0, altitude = np.zeros(1), th
     return (latitude_arr_3los, longitude_arr_3los)
 
 
-def flag_var(dsz,var_key, err_key=None, snr_key=None, var_min_thres = -np.inf, var_max_thres = np.inf, var_err_thres = np.inf, snr_thres = 1., snr_los='all'):
-    da_flag = xr.zeros_like(dsz[var_key])
+def flag_var(dsz,var_key, err_key=None, snr_key=None, var_min_thres = -np.inf, var_max_thres = np.inf, var_err_thres = np.inf, snr_thres = 1., snr_los='all', dtype=None):
+    da_flag = xr.zeros_like(dsz[var_key], dtype=dtype) # dtype of the variable if None
     if (var_min_thres > -np.inf) or (var_max_thres < np.inf): # Invalid data flag -> 1
         data_invalid = (dsz[var_key]<var_min_thres ) | (dsz[var_key]>var_max_thres)# | (xr.ufuncs.isnan(dsz[var_key]))
         da_flag = da_flag.where(~data_invalid,1)
     if snr_key: # Low SNR flag -> 2
         if not (snr_los):
-            da_flag = da_flag*0.
+            da_flag = da_flag*0
         else:
             if snr_los == 'all':
                 snr = dsz[snr_key]
@@ -79,7 +79,12 @@ def get_los_var(da):
     return los_var
 
 
-def get_noise_vect_from_da(power_in,n_avg=1, calc_stdv = False,perc_npts_min = 0.25,perc_to_rm=0.05):
+def get_noise_vect_from_da(power_in,n_avg=1, calc_stdv = False,perc_npts_min = 0.25,perc_to_rm=0.05, dtype=None):
+    """
+    Noise level of each (time, los) profile of power_in, from the longest white-noise part of the sorted profile
+    dtype: dtype of the working copy and of the outputs (float32 processing mode); the cumulative sums are then
+    computed in float64. None: dtype of power_in
+    """
 
     alt_var = get_alt_var(power_in)
     los_var = get_los_var(power_in)
@@ -94,7 +99,8 @@ def get_noise_vect_from_da(power_in,n_avg=1, calc_stdv = False,perc_npts_min = 0
         lnoise = np.zeros((len(power_in['time']), len(power_in[los_var])))+np.nan
         var = np.zeros((len(power_in['time']), len(power_in[los_var])))+np.nan
 
-    power = power_in.values*1.
+    power = power_in.values*1. if dtype is None else power_in.values.astype(dtype)
+    acc_dtype = None if dtype is None else np.float64
 
     power[power==0]=np.nan
     power[power<=np.expand_dims(np.nanquantile(power,perc_to_rm,axis=axis_alt),1)]=np.nan
@@ -105,8 +111,8 @@ def get_noise_vect_from_da(power_in,n_avg=1, calc_stdv = False,perc_npts_min = 0
     nsamples = np.nancumsum(sorted_power>0,axis=axis_alt)+1
 
     # Compute partial averages and variances
-    mean_rolling = np.nancumsum(sorted_power, axis=axis_alt)/nsamples
-    mean2_rolling = np.nancumsum(sorted_power**2, axis=axis_alt)/nsamples
+    mean_rolling = np.nancumsum(sorted_power, axis=axis_alt, dtype=acc_dtype)/nsamples
+    mean2_rolling = np.nancumsum(np.square(sorted_power, dtype=acc_dtype), axis=axis_alt, dtype=acc_dtype)/nsamples
     var_rolling = mean2_rolling - mean_rolling**2
     condi = var_rolling * n_avg <= mean_rolling**2.
 
@@ -123,6 +129,8 @@ def get_noise_vect_from_da(power_in,n_avg=1, calc_stdv = False,perc_npts_min = 0
             var[:,i] = var_rolling[np.arange(len(power_in['time'])),first_notwn[:,i],i]
             var[condi_npts[:,i],i] = var_rolling[condi_npts[:,i],npts_min[condi_npts[:,i],i]-1,i]
 
+    if dtype is not None:
+        lnoise, var = lnoise.astype(dtype), var.astype(dtype)
     if calc_stdv:
         return (('time', los_var),lnoise), (('time', los_var),var)
     else:
@@ -1,7 +1,9 @@
 from euliaa_proc.utils.conf_utils import correct_dim_scalar_fields
 import datetime
 from euliaa_proc.log import logger
+from euliaa_proc.instrumentation import instrumented, count_bytes
 import tempfile
+import os
 ENC_NO_FILLVALUE = None
 
 class Writer():
@@ -46,6 +48,7 @@ class Writer():
         self.data.attrs['processing_date'] = current_time_str
 
 
+    @instrumented
     def write_nc(self):
         """write netCDF file - for clean nc writing"""
         self.data.encoding.update(
@@ -74,6 +77,7 @@ class Writer():
             import fsspec
             with tempfile.NamedTemporaryFile(suffix=".nc") as tmpfile:
                 self.data.to_netcdf(tmpfile.name, encoding=encoding_dict)
+                count_bytes(written=os.path.getsize(tmpfile.name))
                 tmpfile.seek(0)
                 # write to S3 using fsspec
                 try:
@@ -92,6 +96,7 @@ class Writer():
         else:
             # write to local file
             self.data.to_netcdf(self.output_file, encoding=encoding_dict) # valid encodings: {'least_significant_digit', 'endian', 'compression', 'quantize_mode', 'blosc_shuffle', 'shuffle', 'szip_pixels_per_block', 'contiguous', 'significant_digits', 'zlib', 'fletcher32', 'dtype', 'complevel', 'chunksizes', 'szip_coding', '_FillValue'}
+            count_bytes(written=os.path.getsize(self.output_file))
 
 
 if __name__=='__main__':
@@ -0,0 +1,68 @@
+"""
+The float32 processing mode (precision: float32) against the default float64 mode, on a small synthetic BankExport
+file with float64 measurements (euliaa_proc.synthetic_bankexport), processed with the production QC config.
+The L2A and L2B files are compared variable by variable:
+    - float variables: the missing values must match (up to MAX_MISMATCH), and the differences of the valid values must
+      be within ATOL + RTOL x |float64 value| (float32 rounding, with the noise sums kept in float64)
+    - flags and cloud fields: the fraction of differing values (values on a QC threshold or a cloud edge
+      classified differently) must not exceed MAX_MISMATCH
+"""
+import os
+import warnings
+import numpy as np
+import pytest
+import xarray as xr
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'euliaa_proc', 'config')
+DISCRETE_VARS = ['cloud_mask', 'below_cloud_top'] # compared as the flags
+RTOL = 1e-4
+ATOL = 1e-12
+MAX_MISMATCH = 1e-3
+
+
+def run_precision(hdf5_file, precision, out_dir):
+    """process hdf5_file with the given precision; output: L2A and L2B paths, bytes of the processed dataset"""
+    from euliaa_proc.main import Runner
+    from euliaa_proc.processing_manager import get_file_args
+    config = {'config': os.path.join(CONFIG_DIR, 'config_nc.yaml'), 'config_qc': os.path.join(CONFIG_DIR, 'config_qc1.yaml'),
+              'bufr_types': [], 'instrumentation': False, 'precision': precision,
+              'output_nc_dir': out_dir, 'output_bufr_dir': out_dir, 'fig_dir': out_dir}
+    os.makedirs(out_dir, exist_ok=True)
+    args = get_file_args(config, hdf5_file)
+    runner = Runner(args)
+    runner.run_processing()
+    nbytes = runner.meas.data.nbytes
+    runner.write_l2a_and_l2b()
+    return {'l2a': args.output_nc_l2A, 'l2b': args.output_nc_l2B, 'nbytes': nbytes}
+
+
+@pytest.fixture(scope='module')
+def runs(tmp_path_factory):
+    from euliaa_proc.synthetic_bankexport import generate_bankexport
+    tmp_dir = str(tmp_path_factory.mktemp('float32'))
+    hdf5_file = generate_bankexport(tmp_dir, n_time=20, n_alt_mie=150, n_alt_ray=150, seed=0, dtype=np.float64)
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='All-NaN slice encountered')
+        return {precision: run_precision(hdf5_file, precision, os.path.join(tmp_dir, precision)) for precision in ['float64', 'float32']}
+
+
+def test_float32_smaller_dataset(runs):
+    assert runs['float32']['nbytes'] < runs['float64']['nbytes']
+
+
+@pytest.mark.parametrize('level', ['l2a', 'l2b'])
+def test_float32_within_bounds(runs, level):
+    with xr.open_dataset(runs['float64'][level], decode_times=False) as ds64, \
+         xr.open_dataset(runs['float32'][level], decode_times=False) as ds32:
+        assert set(ds64.data_vars) == set(ds32.data_vars)
+        for var in ds64.data_vars:
+            a, b = ds64[var].values, ds32[var].values
+            if not a.size:
+                continue
+            if var.endswith('_flag') or var in DISCRETE_VARS:
+                both_missing = ~np.isfinite(a) & ~np.isfinite(b)
+                assert np.mean((a != b) & ~both_missing) <= MAX_MISMATCH, var
+            elif np.issubdtype(a.dtype, np.floating):
+                assert np.mean(np.isfinite(a) != np.isfinite(b)) <= MAX_MISMATCH, var
+                valid = np.isfinite(a) & np.isfinite(b)
+                np.testing.assert_allclose(b[valid], a[valid], rtol=RTOL, atol=ATOL, err_msg=var)
@@ -0,0 +1,85 @@
+import json
+import pytest
+from euliaa_proc import processing_manager
+from euliaa_proc.metrics import PipelineMetrics
+
+METRIC_FAMILIES = ['euliaa_notifications_total', 'euliaa_files_processed_total', 'euliaa_files_failed_total',
+                   'euliaa_bytes_read_total', 'euliaa_bytes_written_total', 'euliaa_queue_depth', 'euliaa_jobs_running',
+                   'euliaa_notifications_pending', 'euliaa_stage_duration_seconds', 'euliaa_end_to_end_latency_seconds']
+
+
+class InlineJobQueue():
+    """job queue running the jobs at submission, with a fake processing returning a stage summary"""
+
+    def __init__(self):
+        self.n_done = 0
+
+    def submit(self, files, config_template):
+        summary = {'bytes_read': 1000, 'bytes_written': 500,
+                   'stages': {'Runner.run_processing': {'wall_time': 0.3}, 'Runner.write_l2a_and_l2b': {'wall_time': 0.1}}}
+        processing_manager.record_job_result((files, config_template), [(tuple(file_id), True, summary) for file_id in files])
+        self.n_done += len(files)
+        return True
+
+    def status(self):
+        return {'waiting': 0, 'running': 0, 'done': self.n_done, 'failed': 0}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(processing_manager, 'metrics', PipelineMetrics())
+    monkeypatch.setattr(processing_manager, 'job_queue', InlineJobQueue())
+    monkeypatch.setattr(processing_manager, 'batcher', None)
+    monkeypatch.setattr(processing_manager, 'get_job_queue', lambda config_template=None: processing_manager.job_queue)
+    monkeypatch.setattr(processing_manager, 'get_batcher', lambda config_template=None: None)
+    monkeypatch.setattr(processing_manager, 'get_processed_index', lambda config_template=None: None)
+    return processing_manager.app.test_client()
+
+
+def parse_samples(text):
+    """samples of a Prometheus text exposition, {name{labels}: value}"""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def notification(key):
+    return json.dumps({'Records': [{'eventTime': '2025-05-22T12:30:00.000Z',
+                                    's3': {'bucket': {'name': 'euliaa-l1'}, 'object': {'key': key, 'eTag': 'abc'}}}]})
+
+
+def test_metrics_families(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    for family in METRIC_FAMILIES:
+        assert f'# TYPE {family} ' in text
+
+
+def test_metrics_after_processed_request(client):
+    before = parse_samples(client.get('/metrics').get_data(as_text=True))
+    assert before['euliaa_files_processed_total'] == 0
+    assert before['euliaa_end_to_end_latency_seconds_count'] == 0
+
+    response = client.post('/', data=notification('TESTS/BankExport_20250522_120000.h5'))
+    assert response.status_code == 200
+
+    after = parse_samples(client.get('/metrics').get_data(as_text=True))
+    assert after['euliaa_notifications_total'] == 1
+    assert after['euliaa_files_processed_total'] == 1
+    assert after['euliaa_files_failed_total'] == 0
+    assert after['euliaa_bytes_read_total'] == 1000
+    assert after['euliaa_bytes_written_total'] == 500
+    assert after['euliaa_end_to_end_latency_seconds_count'] == 1
+    assert after['euliaa_stage_duration_seconds_count{stage="Runner.run_processing"}'] == 1
+    assert after['euliaa_stage_duration_seconds_bucket{stage="Runner.run_processing",le="0.5"}'] == 1
+
+
+def test_metrics_ignores_non_hdf5(client):
+    client.post('/', data=notification('TESTS/readme.txt'))
+    samples = parse_samples(client.get('/metrics').get_data(as_text=True))
+    assert samples['euliaa_notifications_total'] == 0